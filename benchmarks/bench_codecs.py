@@ -0,0 +1,56 @@
+"""
+Compares snapshot size, store time and load time of a worker state with a million integer inputs (and of the same
+inputs as strings) across codecs of the file system store.
+
+Run from the repository root with: python -m benchmarks.bench_codecs
+"""
+import os
+import tempfile
+import time
+
+from pylo.codec import get_codec
+from pylo.state import PyloExecutionState, PyloFileSystemExecutionStore
+
+NUMBER_OF_INPUTS = 1000000
+FINISHED_FRACTION = 0.9
+
+INTEGER_CODECS = ['pickle', 'int64', 'varint', 'pickle+gzip', 'int64+gzip', 'varint+gzip']
+STRING_CODECS = ['pickle', 'lines', 'pickle+gzip', 'lines+gzip']
+
+
+def run(codec, task_inputs):
+    finished_count = int(len(task_inputs) * FINISHED_FRACTION)
+    state = PyloExecutionState(1, task_inputs[:finished_count], task_inputs[finished_count:])
+
+    with tempfile.TemporaryDirectory() as store_dir:
+        store = PyloFileSystemExecutionStore(store_dir, codec=codec)
+
+        start = time.perf_counter()
+        store.store_worker_state(execution_id=1, worker_id=1, task_execution_state=state)
+        store_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        loaded_state = store.load_worker_state(execution_id=1, worker_id=1)
+        load_seconds = time.perf_counter() - start
+
+        assert loaded_state == state
+        return os.path.getsize(os.path.join(store_dir, '1', '1')), store_seconds, load_seconds
+
+
+def available(codec):
+    try:
+        get_codec(codec)
+        return True
+    except ImportError:
+        return False
+
+
+if __name__ == '__main__':
+    integer_inputs = list(range(NUMBER_OF_INPUTS))
+    string_inputs = [f'movie-{i}' for i in integer_inputs]
+    for inputs_type, task_inputs, codecs in [('int', integer_inputs, INTEGER_CODECS + ['varint+zstd']),
+                                             ('str', string_inputs, STRING_CODECS + ['lines+zstd'])]:
+        print(f'{inputs_type} inputs:')
+        for codec in filter(available, codecs):
+            size, store_seconds, load_seconds = run(codec, task_inputs)
+            print(f'  {codec:12} size: {size / 2 ** 10:9.1f}KB  store: {store_seconds:.3f}s  load: {load_seconds:.3f}s')
@@ -0,0 +1,256 @@
+"""
+Benchmarks executors and execution stores, so that regressions in scheduling or in the cost of flushes and snapshots
+show up as numbers which can be compared across commits:
+
+- executor_throughput: PyloLocalMultiThreadExecutor throughput by number of workers, executions_before_flush and
+  distribution of task latency
+- store_scaling: PyloFileSystemExecutionStore store and load time of a worker state, from 10^3 to 10^7 inputs
+- exception_heavy: throughput of executions in which most tasks fail, with and without deduplication of exceptions
+- resume_cost: time to resume an execution which left a few inputs unfinished, by number of inputs
+- cost_ordering: makespan of a rerun with skewed task latency, with inputs split in order and by recorded durations
+- tiered_store: throughput of trivial tasks flushed after every task, with and without an in-memory tier in front of
+  the store
+
+Everything runs offline, in temporary directories. Results are printed as JSON lines (one per case, with sorted keys),
+preceded by a line which describes the environment, so that runs can be diffed or loaded into a dataframe.
+
+Run from the repository root with: python -m benchmarks.bench_suite [--quick] [--only NAME] [--output FILE]
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from pylo.execution import Pylo
+from pylo.metrics import PyloMetrics
+from pylo.state import PyloExecutionState, PyloFileSystemExecutionStore
+
+SEED = 42
+
+
+def _constant_latency(rng):
+    return 0.001
+
+
+def _exponential_latency(rng):
+    return rng.expovariate(1000)
+
+
+def _skewed_latency(rng):
+    # most tasks are fast, a few are up to a hundred times slower
+    return min(0.0002 * rng.paretovariate(1.5), 0.02)
+
+
+LATENCY_DISTRIBUTIONS = {
+    'none': None,
+    'constant_1ms': _constant_latency,
+    'exponential_1ms': _exponential_latency,
+    'pareto': _skewed_latency,
+}
+
+
+def bench_executor_throughput(quick):
+    number_of_inputs = 500 if quick else 2000
+    workers_counts = [1, 4] if quick else [1, 2, 4, 8, 16]
+    flush_intervals = [1, 100] if quick else [1, 10, 100, 1000]
+    for latency_name, latency in LATENCY_DISTRIBUTIONS.items():
+        # the same latencies for every configuration, so that only the configuration differs
+        rng = random.Random(SEED)
+        latencies = [latency(rng) if latency is not None else 0.0 for _ in range(number_of_inputs)]
+
+        def task(n):
+            if latencies[n]:
+                time.sleep(latencies[n])
+
+        for number_of_workers in workers_counts:
+            for executions_before_flush in flush_intervals:
+                with tempfile.TemporaryDirectory() as store_dir:
+                    pylo = Pylo.local_multithread(store_dir, number_of_workers=number_of_workers,
+                                                  task_executions_before_flush=executions_before_flush)
+                    seconds = _timed(pylo.start_from_scratch, list(range(number_of_inputs)), task)
+
+                yield {
+                    'benchmark': 'executor_throughput',
+                    'params': {'inputs': number_of_inputs, 'workers': number_of_workers,
+                               'executions_before_flush': executions_before_flush, 'latency': latency_name},
+                    'seconds': seconds,
+                    'tasks_per_second': number_of_inputs / seconds,
+                }
+
+
+def bench_store_scaling(quick):
+    sizes = [10 ** 3, 10 ** 4, 10 ** 5] if quick else [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]
+    for number_of_inputs in sizes:
+        for codec in ['pickle', 'varint']:
+            # most inputs are finished, as they are through most of an execution
+            finished_count = number_of_inputs * 9 // 10
+            state = PyloExecutionState(1, list(range(finished_count)), range(finished_count, number_of_inputs))
+            with tempfile.TemporaryDirectory() as store_dir:
+                store = PyloFileSystemExecutionStore(store_dir, codec=codec)
+                store_seconds = _timed(store.store_worker_state, 1, 1, state)
+                load_seconds = _timed(store.load_worker_state, 1, 1)
+                size = os.path.getsize(os.path.join(store_dir, '1', '1'))
+
+            yield {
+                'benchmark': 'store_scaling',
+                'params': {'inputs': number_of_inputs, 'codec': codec},
+                'store_seconds': store_seconds,
+                'load_seconds': load_seconds,
+                'bytes': size,
+            }
+
+
+def bench_exception_heavy(quick):
+    number_of_inputs = 1000 if quick else 10000
+
+    def failing_task(n):
+        # 9 in 10 tasks fail, with one of a few distinct exceptions
+        if n % 10:
+            raise ValueError(f'Failed for inputs ending with {n % 10}')
+
+    for deduplicate_exceptions in [False, True]:
+        metrics = PyloMetrics()
+        with tempfile.TemporaryDirectory() as store_dir:
+            # failed inputs are retried until workers give up, after as many failures in total as there are inputs
+            pylo = Pylo.local_multithread(store_dir, number_of_workers=4, max_worker_failures=number_of_inputs // 4,
+                                          deduplicate_exceptions=deduplicate_exceptions, hooks=[metrics])
+            seconds = _timed(pylo.start_from_scratch, list(range(number_of_inputs)), failing_task)
+
+        stats = metrics.stats()
+        tasks = stats['tasks_completed'] + stats['tasks_failed']
+        yield {
+            'benchmark': 'exception_heavy',
+            'params': {'inputs': number_of_inputs, 'deduplicate_exceptions': deduplicate_exceptions},
+            'seconds': seconds,
+            'tasks': tasks,
+            'tasks_per_second': tasks / seconds,
+            'store_task_exception_seconds': stats['store_calls']['store_task_exception']['total_seconds'],
+        }
+
+
+def bench_resume_cost(quick):
+    sizes = [10 ** 3, 10 ** 4] if quick else [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]
+    for number_of_inputs in sizes:
+        for sqlite_store in [False, True]:
+            with tempfile.TemporaryDirectory() as store_dir:
+                pylo = Pylo.local_multithread(store_dir, number_of_workers=4, sqlite_store=sqlite_store,
+                                              task_executions_before_flush=10000)
+                unfinished_inputs = set(range(0, number_of_inputs, 100))
+
+                def task(n):
+                    if n in unfinished_inputs:
+                        raise ValueError(f'Failed for {n}')
+
+                execution_id = pylo.start_from_scratch(list(range(number_of_inputs)), task)
+                # only the resume itself is measured, the task does nothing
+                seconds = _timed(pylo.start_from_past_execution, execution_id, lambda n: None)
+
+            yield {
+                'benchmark': 'resume_cost',
+                'params': {'inputs': number_of_inputs, 'unfinished_inputs': len(unfinished_inputs),
+                           'store': 'sqlite' if sqlite_store else 'file_system'},
+                'seconds': seconds,
+            }
+
+
+def bench_cost_ordering(quick):
+    number_of_inputs = 200 if quick else 1000
+    rng = random.Random(SEED)
+    latencies = [_skewed_latency(rng) for _ in range(number_of_inputs)]
+    # the slowest inputs come last, as when inputs are sorted by something which grows with their cost
+    latencies.sort()
+
+    def task(n):
+        time.sleep(latencies[n])
+
+    for number_of_workers in [2, 8] if quick else [2, 4, 8, 16]:
+        with tempfile.TemporaryDirectory() as store_dir:
+            pylo = Pylo.local_multithread(store_dir, number_of_workers=number_of_workers, record_task_durations=True)
+            execution_id = pylo.start_from_scratch(list(range(number_of_inputs)), task)
+            ordered_seconds = _timed(pylo.start_from_scratch, list(range(number_of_inputs)), task)
+            scheduled_seconds = _timed(
+                lambda: pylo.start_from_scratch(list(range(number_of_inputs)), task, durations_from=execution_id))
+
+        yield {
+            'benchmark': 'cost_ordering',
+            'params': {'inputs': number_of_inputs, 'workers': number_of_workers, 'latency': 'pareto'},
+            'ordered_seconds': ordered_seconds,
+            'scheduled_seconds': scheduled_seconds,
+            'speedup': ordered_seconds / scheduled_seconds,
+        }
+
+
+def bench_tiered_store(quick):
+    number_of_inputs = 2000 if quick else 20000
+    for sqlite_store in [False, True]:
+        for spill_interval_seconds in [None, 1.0]:
+            with tempfile.TemporaryDirectory() as store_dir:
+                pylo = Pylo.local_multithread(store_dir, number_of_workers=4, sqlite_store=sqlite_store,
+                                              task_executions_before_flush=1, journaled_store=True,
+                                              spill_interval_seconds=spill_interval_seconds)
+                seconds = _timed(pylo.start_from_scratch, list(range(number_of_inputs)), lambda n: None)
+
+            yield {
+                'benchmark': 'tiered_store',
+                'params': {'inputs': number_of_inputs, 'store': 'sqlite' if sqlite_store else 'file_system',
+                           'spill_interval_seconds': spill_interval_seconds},
+                'seconds': seconds,
+                'tasks_per_second': number_of_inputs / seconds,
+            }
+
+
+BENCHMARKS = {
+    'executor_throughput': bench_executor_throughput,
+    'store_scaling': bench_store_scaling,
+    'exception_heavy': bench_exception_heavy,
+    'resume_cost': bench_resume_cost,
+    'cost_ordering': bench_cost_ordering,
+    'tiered_store': bench_tiered_store,
+}
+
+
+def _timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+
+def _environment(quick):
+    return {
+        'benchmark': 'environment',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'quick': quick,
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmarks executors and execution stores of Pylo.')
+    parser.add_argument('--quick', action='store_true', help='run smaller cases, e.g. to check that nothing broke')
+    parser.add_argument('--only', choices=sorted(BENCHMARKS), action='append',
+                        help='run only the given benchmark, can be repeated')
+    parser.add_argument('--output', help='append results to this file, instead of printing them')
+    args = parser.parse_args(argv)
+
+    # failing tasks are logged as errors, which would drown the results
+    logging.disable(logging.CRITICAL)
+    output = open(args.output, 'a') if args.output else sys.stdout
+    try:
+        output.write(json.dumps(_environment(args.quick), sort_keys=True) + '\n')
+        for name in args.only or BENCHMARKS:
+            for result in BENCHMARKS[name](args.quick):
+                output.write(json.dumps(result, sort_keys=True) + '\n')
+                output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,37 @@
+"""
+Compares wall-clock time of static input splitting and work stealing on a skewed workload, where all slow inputs end up
+in the chunk of the first worker.
+
+Run from the repository root with: python -m benchmarks.bench_work_stealing
+"""
+import tempfile
+import time
+
+from pylo.execution import Pylo
+
+NUMBER_OF_INPUTS = 2000
+NUMBER_OF_WORKERS = 8
+SLOW_INPUTS = NUMBER_OF_INPUTS // NUMBER_OF_WORKERS
+
+
+def skewed_task(n):
+    time.sleep(0.004 if n < SLOW_INPUTS else 0.0005)
+
+
+def run(work_stealing):
+    with tempfile.TemporaryDirectory() as store_dir:
+        pylo = Pylo.local_multithread(
+            store_dir, number_of_workers=NUMBER_OF_WORKERS, task_executions_before_flush=100,
+            work_stealing=work_stealing)
+
+        start = time.perf_counter()
+        pylo.start_from_scratch(range(NUMBER_OF_INPUTS), skewed_task)
+        return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    static_seconds = run(work_stealing=False)
+    stealing_seconds = run(work_stealing=True)
+    print(f'static split:  {static_seconds:.3f}s')
+    print(f'work stealing: {stealing_seconds:.3f}s')
+    print(f'speedup:       {static_seconds / stealing_seconds:.2f}x')
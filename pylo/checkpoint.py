@@ -0,0 +1,214 @@
+# coding=utf-8
+import logging
+import threading
+import time
+
+from pylo.state import _apply_worker_journal
+
+_logger = logging.getLogger(__name__)
+
+
+class PyloCheckpointer:
+    """
+    Stores snapshots of worker states from a background thread, so that workers never wait for the store.
+
+    Workers hand over snapshots of their states (see PyloExecutionState.snapshot), or, once they are added with
+    add_worker, only the journals of their states (see submit_changes). The checkpointer keeps its own copy of the
+    states of added workers, and applies their journals to it in the background, so such workers never copy their
+    whole states. If a worker hands over a new snapshot (or journal) before the previous one was stored, both are
+    stored at once. Every interval_seconds, the checkpointer also asks each registered source to hand over its
+    changes, so that progress is stored even if workers finish too few tasks to trigger snapshots themselves.
+    """
+
+    def __init__(self, task_store, interval_seconds):
+        """
+        :param task_store:  the store which snapshots are written to
+        :param interval_seconds:  how often sources are asked to hand over a snapshot
+        """
+        self._task_store = task_store
+        self._interval_seconds = interval_seconds
+        self._sources = []
+        # (execution id, worker id) -> a pair of the latest snapshot (or _WorkerChanges) which has not been stored yet,
+        # and its number
+        self._pending_snapshots = {}
+        # (execution id, worker id) -> the copy of the state of an added worker, only used by the background thread
+        self._worker_states = {}
+        # (execution id, worker id) -> the number of the latest snapshot which was stored
+        self._stored_snapshots = {}
+        # (execution id, worker id) -> a pair of the number of the latest snapshot which failed to store, and why
+        self._failed_snapshots = {}
+
+        self._condition = threading.Condition()
+        self._submitted_snapshots = 0
+        self._closed = False
+        # the failure of the last attempt to store snapshots which were still pending when the checkpointer closed
+        self._close_failure = None
+        self._writer = threading.Thread(target=self._checkpoint_in_background, name='pylo-checkpointer', daemon=True)
+        self._writer.start()
+
+    def add_source(self, checkpoint):
+        """
+        :param checkpoint:  a function called from the background thread every interval_seconds, which submits a
+                            snapshot if anything changed since the previous one. It must not block, since a worker can
+                            wait for the background thread while holding its own locks.
+        """
+        with self._condition:
+            self._sources.append(checkpoint)
+
+    def add_worker(self, execution_id, worker_id, task_execution_state):
+        """
+        Keeps a copy of the state of a worker, which has to be stored already, for submit_changes to apply journals to.
+        """
+        with self._condition:
+            self._worker_states[(execution_id, worker_id)] = task_execution_state.snapshot()
+
+    def submit(self, execution_id, worker_id, snapshot, wait=False):
+        """
+        Queues a snapshot of a worker state to be stored.
+        :param wait:  if set to true, blocks until the snapshot is stored, and raises the exception the store failed
+                      with if it failed to store it (the snapshot stays queued, and is retried with the next one)
+        """
+        self._submit(execution_id, worker_id, snapshot, wait)
+
+    def submit_changes(self, execution_id, worker_id, journal, stream_offset, failed_attempts=None, wait=False):
+        """
+        Queues changes of the state of a worker added with add_worker to be stored.
+        :param journal:  the journal of the worker state, as returned by take_journal
+        :param stream_offset:  the stream offset of the worker state
+        :param failed_attempts:  failed attempts of inputs assigned in the journal, as returned by
+                                 failed_attempts_of_inputs
+        :param wait:  see submit
+        """
+        self._submit(execution_id, worker_id, _WorkerChanges(journal, stream_offset, failed_attempts), wait)
+
+    def _submit(self, execution_id, worker_id, snapshot, wait):
+        with self._condition:
+            key = (execution_id, worker_id)
+            older_snapshot, _ = self._pending_snapshots.pop(key, (None, None))
+            if older_snapshot is not None:
+                snapshot = _merge_pending(older_snapshot, snapshot)
+            self._submitted_snapshots += 1
+            submitted_snapshot = self._submitted_snapshots
+            self._pending_snapshots[key] = (snapshot, submitted_snapshot)
+            self._condition.notify_all()
+            if not wait:
+                return
+
+            self._condition.wait_for(
+                lambda: self._stored_snapshots.get(key, 0) >= submitted_snapshot or
+                self._failed_snapshots.get(key, (0, None))[0] >= submitted_snapshot or not self._writer.is_alive())
+            if self._stored_snapshots.get(key, 0) >= submitted_snapshot:
+                return
+            failed_snapshot, failure = self._failed_snapshots.get(key, (0, None))
+            if failed_snapshot >= submitted_snapshot:
+                raise failure
+            raise RuntimeError(f'The checkpointer closed before it stored the state of worker {worker_id}')
+
+    def close(self):
+        """
+        Stores all pending snapshots, and stops the background thread. Snapshots which fail to store are retried once,
+        and if they fail again, the exception the store failed with is raised.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._writer.join()
+        if self._close_failure is not None:
+            raise self._close_failure
+
+    def _checkpoint_in_background(self):
+        next_checkpoint = time.monotonic() + self._interval_seconds
+        taken_snapshots = 0
+        retried_on_close = False
+        while True:
+            with self._condition:
+                # snapshots which failed to store stay pending, but they are only retried with new ones
+                self._condition.wait_for(
+                    lambda: self._closed or self._submitted_snapshots > taken_snapshots or
+                    time.monotonic() >= next_checkpoint,
+                    timeout=max(0.0, next_checkpoint - time.monotonic()))
+                sources = list(self._sources) if time.monotonic() >= next_checkpoint else []
+
+            if sources:
+                for checkpoint in sources:
+                    checkpoint()
+                next_checkpoint = time.monotonic() + self._interval_seconds
+
+            with self._condition:
+                closed = self._closed
+                taken_snapshots = self._submitted_snapshots
+                snapshots, self._pending_snapshots = self._pending_snapshots, {}
+
+            stored_snapshots, failed_snapshots = {}, {}
+            for (execution_id, worker_id), (snapshot, number) in snapshots.items():
+                task_state = snapshot
+                if isinstance(snapshot, _WorkerChanges):
+                    task_state = self._worker_states[(execution_id, worker_id)]
+                    snapshot.apply_to(task_state)
+                    # the changes are in the copy of the state now, a retry only has to store it again
+                    snapshot = _WorkerChanges([], task_state.stream_offset)
+                # the store takes the journal of the state, so we keep it aside in case the store fails
+                journal = task_state.take_journal()
+                task_state.prepend_journal(list(journal))
+                try:
+                    self._task_store.store_worker_state(execution_id, worker_id, task_state)
+                    stored_snapshots[(execution_id, worker_id)] = number
+                except Exception as e:
+                    _logger.error(f'Failed to store state of worker {worker_id}. Failure message: {str(e)}')
+                    task_state.take_journal()
+                    task_state.prepend_journal(journal)
+                    failed_snapshots[(execution_id, worker_id)] = (snapshot, number, e)
+
+            with self._condition:
+                self._stored_snapshots.update(stored_snapshots)
+                # failed snapshots are retried together with the next ones, so that their journals are not lost
+                for key, (failed_snapshot, number, failure) in failed_snapshots.items():
+                    self._failed_snapshots[key] = (number, failure)
+                    newer_snapshot, newer_number = self._pending_snapshots.pop(key, (None, None))
+                    if newer_snapshot is None:
+                        self._pending_snapshots[key] = (failed_snapshot, number)
+                    else:
+                        self._pending_snapshots[key] = (_merge_pending(failed_snapshot, newer_snapshot), newer_number)
+                self._condition.notify_all()
+
+                if closed and self._pending_snapshots:
+                    if not retried_on_close or not failed_snapshots:
+                        # snapshots submitted while closing are stored too, and failed ones are retried once
+                        retried_on_close = retried_on_close or bool(failed_snapshots)
+                        continue
+                    self._close_failure = next(iter(failed_snapshots.values()))[2]
+                    _logger.error(f'Failed to store states of {len(self._pending_snapshots)} workers before closing')
+                    return
+            if closed:
+                return
+
+
+class _WorkerChanges:
+    """
+    Changes of the state of a worker which the checkpointer keeps a copy of, see submit_changes.
+    """
+    def __init__(self, journal, stream_offset, failed_attempts=None):
+        self.journal = journal
+        self.stream_offset = stream_offset
+        self.failed_attempts = dict(failed_attempts or {})
+
+    def extend(self, newer_changes):
+        self.journal.extend(newer_changes.journal)
+        self.stream_offset = newer_changes.stream_offset
+        self.failed_attempts.update(newer_changes.failed_attempts)
+
+    def apply_to(self, task_execution_state):
+        _apply_worker_journal(task_execution_state, self.journal, self.failed_attempts)
+        task_execution_state.stream_offset = self.stream_offset
+
+
+def _merge_pending(older_snapshot, newer_snapshot):
+    """
+    :return:  a snapshot (or changes) which carries the journals of both, when the older one was not stored yet
+    """
+    if isinstance(older_snapshot, _WorkerChanges):
+        # the newer changes are appended, so that changes which pile up behind a slow store are not copied again
+        older_snapshot.extend(newer_snapshot)
+        return older_snapshot
+    newer_snapshot.prepend_journal(older_snapshot.take_journal())
+    return newer_snapshot
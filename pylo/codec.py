@@ -0,0 +1,209 @@
+# coding=utf-8
+import gzip
+import pickle
+import sys
+import threading
+from abc import ABC, abstractmethod
+from array import array
+
+
+class PyloCodec(ABC):
+    """
+    Turns lists of task inputs into bytes and back, so that stores can persist them compactly.
+
+    Each codec has a unique name, which stores persist next to the encoded inputs, so that they are decoded with
+    the same codec they were encoded with. Codecs which only support some inputs (e.g. integers) raise ValueError or
+    TypeError when encoding other inputs.
+    """
+    name = None
+
+    @abstractmethod
+    def encode_inputs(self, task_inputs):
+        pass
+
+    @abstractmethod
+    def decode_inputs(self, data):
+        pass
+
+    def encode_object(self, obj):
+        """
+        Encodes any other object (e.g. an exception), by default with pickle.
+        """
+        return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def decode_object(self, data):
+        return pickle.loads(data)
+
+
+class PickleCodec(PyloCodec):
+    """
+    Encodes inputs of any picklable type.
+    """
+    name = 'pickle'
+
+    def encode_inputs(self, task_inputs):
+        return pickle.dumps(list(task_inputs), protocol=pickle.HIGHEST_PROTOCOL)
+
+    def decode_inputs(self, data):
+        return pickle.loads(data)
+
+
+class Int64Codec(PyloCodec):
+    """
+    Encodes integer inputs as an array of 64-bit integers, which is the fastest to load.
+    """
+    name = 'int64'
+
+    def encode_inputs(self, task_inputs):
+        _check_inputs_type(task_inputs, int)
+        encoded = array('q', task_inputs)
+        if sys.byteorder == 'big':
+            encoded.byteswap()
+        return encoded.tobytes()
+
+    def decode_inputs(self, data):
+        decoded = array('q')
+        decoded.frombytes(data)
+        if sys.byteorder == 'big':
+            decoded.byteswap()
+        return decoded.tolist()
+
+
+class VarintCodec(PyloCodec):
+    """
+    Encodes integer inputs as variable length differences between consecutive inputs, which is the most compact for
+    ranges of ids (mostly one byte per input), but slower to load than Int64Codec.
+    """
+    name = 'varint'
+
+    def encode_inputs(self, task_inputs):
+        _check_inputs_type(task_inputs, int)
+        encoded = bytearray()
+        previous_input = 0
+        for task_input in task_inputs:
+            delta = task_input - previous_input
+            previous_input = task_input
+            # zigzag encoding, so that small negative deltas are small numbers too
+            value = delta * 2 if delta >= 0 else -delta * 2 - 1
+            while value >= 0x80:
+                encoded.append((value & 0x7f) | 0x80)
+                value >>= 7
+            encoded.append(value)
+        return bytes(encoded)
+
+    def decode_inputs(self, data):
+        decoded = []
+        previous_input = 0
+        value = shift = 0
+        for byte in data:
+            value |= (byte & 0x7f) << shift
+            if byte & 0x80:
+                shift += 7
+                continue
+
+            previous_input += value >> 1 if value % 2 == 0 else -((value + 1) >> 1)
+            decoded.append(previous_input)
+            value = shift = 0
+        return decoded
+
+
+class LinesCodec(PyloCodec):
+    """
+    Encodes string inputs as UTF-8 lines. Strings which contain a newline can not be encoded.
+    """
+    name = 'lines'
+
+    def encode_inputs(self, task_inputs):
+        _check_inputs_type(task_inputs, str)
+        if any('\n' in task_input for task_input in task_inputs):
+            raise ValueError('Inputs which contain a newline can not be encoded as lines')
+        return ''.join(task_input + '\n' for task_input in task_inputs).encode('utf-8')
+
+    def decode_inputs(self, data):
+        return data.decode('utf-8').split('\n')[:-1]
+
+
+class CompressedCodec(PyloCodec):
+    """
+    Compresses the output of another codec with gzip, or with zstd (which requires the zstandard package).
+    """
+    def __init__(self, codec, compression='gzip', level=None):
+        """
+        :param codec:  the codec which encodes inputs before they are compressed
+        :param compression:  either 'gzip' or 'zstd'
+        :param level:  the compression level, if not set, the default level of the compression is used
+        """
+        if compression == 'gzip':
+            level = 6 if level is None else level
+            self._compress = lambda data: gzip.compress(data, compresslevel=level)
+            self._decompress = gzip.decompress
+        elif compression == 'zstd':
+            try:
+                import zstandard
+            except ImportError:
+                raise ImportError('zstd compression requires the zstandard package, install it with: '
+                                  'pip install zstandard')
+            compressor = zstandard.ZstdCompressor(level=3 if level is None else level)
+            decompressor = zstandard.ZstdDecompressor()
+            # zstandard compressors must not be used by multiple threads at once
+            lock = threading.Lock()
+
+            def compress(data):
+                with lock:
+                    return compressor.compress(data)
+
+            def decompress(data):
+                with lock:
+                    return decompressor.decompress(data)
+
+            self._compress, self._decompress = compress, decompress
+        else:
+            raise ValueError(f'Unknown compression {compression}, expected gzip or zstd')
+
+        self.codec = codec
+        self.name = f'{codec.name}+{compression}'
+
+    def encode_inputs(self, task_inputs):
+        return self._compress(self.codec.encode_inputs(task_inputs))
+
+    def decode_inputs(self, data):
+        return self.codec.decode_inputs(self._decompress(data))
+
+    def encode_object(self, obj):
+        return self._compress(self.codec.encode_object(obj))
+
+    def decode_object(self, data):
+        return self.codec.decode_object(self._decompress(data))
+
+
+def get_codec(name):
+    """
+    Returns the codec with the given name, e.g. 'varint' or 'varint+gzip' (a codec, followed by a compression).
+    Besides built-in codecs, it returns codecs registered with register_codec.
+    """
+    codec_name, _, compression = name.partition('+')
+    if codec_name not in _CODECS:
+        raise ValueError(f'Unknown codec {codec_name}, expected one of {", ".join(sorted(_CODECS))}')
+    return CompressedCodec(_CODECS[codec_name], compression) if compression else _CODECS[codec_name]
+
+
+def register_codec(codec):
+    """
+    Makes a custom codec available to get_codec, so that inputs it encoded can be decoded later.
+    """
+    if isinstance(codec, CompressedCodec):
+        codec = codec.codec
+    if '+' in codec.name:
+        raise ValueError(f'Codec names can not contain "+", got {codec.name}')
+    _CODECS[codec.name] = codec
+
+
+def _check_inputs_type(task_inputs, input_type):
+    for task_input in task_inputs:
+        # bool is a subclass of int, but it would not be decoded as bool
+        if type(task_input) is not input_type:
+            raise TypeError(
+                f'{type(task_input).__name__} input {task_input!r} can not be encoded as {input_type.__name__}')
+
+
+_CODECS = {codec.name: codec for codec in (PickleCodec(), Int64Codec(), VarintCodec(), LinesCodec())}
@@ -0,0 +1,104 @@
+# coding=utf-8
+import logging
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+
+class PyloConcurrencyController:
+    """
+    Limits how many workers run tasks at once, and adapts the limit to observed task latency and failures (AIMD).
+
+    Workers acquire a slot before running each task, and release it with the latency of the task and whether it failed.
+    Once as many tasks as the current limit completed, the limit is adjusted: it is halved if too many tasks failed,
+    or if tasks took much longer than the fastest round so far (e.g. because a remote API started to throttle), and
+    otherwise it grows by one, up to max_concurrency.
+    """
+
+    def __init__(self, min_concurrency, max_concurrency, max_failure_rate=0.1, latency_tolerance=2.0,
+                 decrease_factor=0.5, on_change=None):
+        """
+        :param min_concurrency:  the lowest limit, which is also where the limit starts
+        :param max_concurrency:  the highest limit
+        :param max_failure_rate:  the share of failed tasks in a round above which the limit decreases
+        :param latency_tolerance:  how many times longer than in the fastest round tasks can take before the limit
+                                   decreases
+        :param decrease_factor:  what the limit is multiplied by when it decreases
+        :param on_change:  if set, called with the new limit whenever the limit changes. It is called while workers
+                           wait to acquire slots, so it has to be fast
+        """
+        if not 1 <= min_concurrency <= max_concurrency:
+            raise ValueError(f'Expected 1 <= min_concurrency <= max_concurrency, got {min_concurrency} and '
+                             f'{max_concurrency}')
+
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.concurrency = min_concurrency
+        # pairs of seconds since the controller was created and the limit set at that time
+        self.history = [(0.0, min_concurrency)]
+        self._max_failure_rate = max_failure_rate
+        self._latency_tolerance = latency_tolerance
+        self._decrease_factor = decrease_factor
+        self._on_change = on_change
+        self._fastest_latency = None
+
+        self._condition = threading.Condition()
+        self._running = 0
+        self._started_at = time.monotonic()
+        self._round_started_at = self._started_at
+        self._round_tasks = 0
+        self._round_failures = 0
+        self._round_latency = 0.0
+
+    def acquire(self):
+        """
+        Blocks until fewer tasks than the current limit are running.
+        """
+        with self._condition:
+            while self._running >= self.concurrency:
+                self._condition.wait()
+            self._running += 1
+
+    def release(self, latency_seconds, failed):
+        """
+        :param latency_seconds:  how long the task took
+        :param failed:  whether the task failed
+        """
+        with self._condition:
+            self._running -= 1
+            self._round_tasks += 1
+            self._round_failures += failed
+            self._round_latency += latency_seconds
+            if self._round_tasks >= self.concurrency:
+                self._adjust()
+            self._condition.notify_all()
+
+    def _adjust(self):
+        now = time.monotonic()
+        mean_latency = self._round_latency / self._round_tasks
+        failure_rate = self._round_failures / self._round_tasks
+        throughput = self._round_tasks / max(now - self._round_started_at, 1e-9)
+
+        if failure_rate > self._max_failure_rate or \
+                (self._fastest_latency is not None and mean_latency > self._latency_tolerance * self._fastest_latency):
+            concurrency = max(self.min_concurrency, int(self.concurrency * self._decrease_factor))
+        else:
+            concurrency = min(self.max_concurrency, self.concurrency + 1)
+        # failed tasks often fail fast, so their latency says nothing about the load
+        if failure_rate <= self._max_failure_rate:
+            self._fastest_latency = mean_latency if self._fastest_latency is None else \
+                min(self._fastest_latency, mean_latency)
+
+        if concurrency != self.concurrency:
+            _logger.info(f'Changing concurrency from {self.concurrency} to {concurrency} workers. '
+                         f'Throughput {throughput:.1f} tasks/s, failure rate {failure_rate:.0%}, '
+                         f'mean latency {mean_latency:.3f}s')
+            self.concurrency = concurrency
+            self.history.append((now - self._started_at, concurrency))
+            if self._on_change is not None:
+                self._on_change(concurrency)
+
+        self._round_started_at = now
+        self._round_tasks = self._round_failures = 0
+        self._round_latency = 0.0
@@ -1,17 +1,30 @@
+import itertools
+import logging
 import os
 import uuid
 
-from pylo.executor import PyloTaskExecutor, PyloLocalMultiThreadExecutor
-from pylo.state import PyloExecutionStore, PyloExecutionState, PyloFileSystemExecutionStore
+from pylo.executor import PyloTaskExecutor, PyloLocalMultiThreadExecutor, PyloLocalMultiProcessExecutor, \
+    PyloAsyncioExecutor, PyloDistributedExecutor
+from pylo.index import PyloCompletionIndex, _CompletionRecordingStore
+from pylo.retry import PyloRetryPolicy
+from pylo.scheduling import PyloTaskCosts
+from pylo.tiered import PyloTieredExecutionStore
+from pylo.state import PyloExecutionStore, PyloExecutionState, PyloFileSystemExecutionStore, PyloInputStream, \
+    PyloSqliteExecutionStore, PyloBitmapExecutionState, iter_streamed_finished_inputs
+
+_logger = logging.getLogger(__name__)
 
 
 class Pylo:
     """
     Class which encapsulates all Pylo's functionality, it should be all you need when using Pylo.
     """
-    def __init__(self, task_executor: PyloTaskExecutor, task_store: PyloExecutionStore):
+    def __init__(self, task_executor: PyloTaskExecutor, task_store: PyloExecutionStore,
+                 completion_index: PyloCompletionIndex = None):
         self._task_executor = task_executor
         self._task_store = task_store
+        # remembers inputs which tasks finished across executions, for executions started with a task name
+        self._completion_index = completion_index
 
     @classmethod
     def local_multithread(
@@ -20,7 +33,27 @@ class Pylo:
             number_of_workers,
             max_worker_failures=1000,
             task_executions_before_flush=1000,
-            store_exceptions=True):
+            store_exceptions=True,
+            journaled_store=False,
+            sqlite_store=False,
+            deduplicate_exceptions=False,
+            max_stored_exceptions=None,
+            work_stealing=False,
+            stream_batch_size=100,
+            task_batch_size=1,
+            split_failed_batches=True,
+            checkpoint_interval_seconds=None,
+            fsync_policy=None,
+            codec=None,
+            min_number_of_workers=None,
+            retry_delay_seconds=None,
+            max_retry_delay_seconds=60.0,
+            max_attempts=None,
+            hooks=(),
+            worker_initializer=None,
+            worker_finalizer=None,
+            record_task_durations=False,
+            spill_interval_seconds=None):
         """
         Creates a Pylo instance which uses threads as workers, and persists execution progress to a local directory.
         :param local_store_dir:  the directory where Pylo will persist execution state (successful inputs and failures)
@@ -28,20 +61,325 @@ class Pylo:
         :param max_worker_failures:  the maximum allowed task failures per each worker, if a worker exceeds it, it would terminate
         :param task_executions_before_flush:  the number of task executions between snapshotting execution state to disk
         :param store_exceptions:   if set to false, task exceptions will not be persisted
+        :param journaled_store:  if set to true, each snapshot only appends inputs which finished or failed since the
+                                 previous snapshot, instead of rewriting the whole worker state
+        :param sqlite_store:  if set to true, Pylo persists execution state to an SQLite database in the local directory,
+                              instead of to one file per worker
+        :param deduplicate_exceptions:  if set to true, exceptions with the same type, message and traceback as an
+                                        already stored exception are only counted, see get_exception_counts
+        :param max_stored_exceptions:  if set, Pylo stops storing exceptions of an execution once it stored this many
+        :param work_stealing:  if set to true, workers which run out of inputs take over half of the remaining inputs of
+                               the busiest worker, instead of finishing early
+        :param stream_batch_size:  when inputs are streamed, the number of inputs each worker reads from the stream at once
+        :param task_batch_size:  if bigger than 1, the task function is called with lists of up to this many inputs,
+                                 see start_from_scratch for details
+        :param split_failed_batches:  if set to true, when the task function fails for a list of inputs, the list is
+                                      split in halves which are retried separately, until the failing inputs are found
+        :param checkpoint_interval_seconds:  if set, snapshots are written by a background thread, at least this often
+                                             (and also after task_executions_before_flush executions, unless it is
+                                             None), so that workers never wait for the store
+        :param fsync_policy:  one of 'never', 'snapshots' or 'always', whether written state is forced to disk, see
+                              PyloFileSystemExecutionStore and PyloSqliteExecutionStore for their defaults
+        :param codec:  the name of the codec which encodes inputs in snapshots (e.g. 'varint' or 'lines+gzip'), or
+                       a PyloCodec, see pylo.codec. It is not supported by the SQLite store
+        :param min_number_of_workers:  if set, the number of workers which run tasks at once adapts to task latency and
+                                       failures, between this and number_of_workers, see PyloConcurrencyController
+        :param retry_delay_seconds:  if set, failed inputs are retried only after this delay, which doubles with every
+                                     failed attempt of the input (with random jitter), and workers run other inputs in
+                                     the meantime
+        :param max_retry_delay_seconds:  the longest delay before retrying a failed input
+        :param max_attempts:  if set, inputs which failed this many times (including in resumed executions) are no
+                              longer retried, and stay unfinished
+        :param hooks:  PyloHooks called as the execution runs, e.g. PyloMetrics to collect metrics, see pylo.metrics
+        :param worker_initializer:  if set, a function which each worker calls before it runs tasks, and which returns
+                                    the context of the worker (e.g. a database connection or an HTTP session). The task
+                                    function is then called with the context as the second argument
+        :param worker_finalizer:  if set, a function which is called with the context of each worker once it stops (e.g.
+                                  to close the connection), also if the worker gave up after max_worker_failures
+        :param record_task_durations:  if set to true, how long the task took for each input is stored with the
+                                       execution, so that later executions can schedule inputs by it, see
+                                       start_from_scratch
+        :param spill_interval_seconds:  if set, snapshots and exceptions are kept in memory, and only written to the
+                                        local directory this often (and when executions finish), at the cost of losing
+                                        up to this much progress on a crash, see PyloTieredExecutionStore
         :return: a new instance of this class
         """
+        retry_policy = None
+        if retry_delay_seconds is not None or max_attempts is not None:
+            retry_policy = PyloRetryPolicy(
+                delay_seconds=retry_delay_seconds or 0.0,
+                max_delay_seconds=max_retry_delay_seconds,
+                max_attempts=max_attempts)
 
         executor = PyloLocalMultiThreadExecutor(
             number_of_workers=number_of_workers,
             max_worker_failures=max_worker_failures,
             executions_before_flush=task_executions_before_flush,
-            store_exceptions=store_exceptions)
+            store_exceptions=store_exceptions,
+            work_stealing=work_stealing,
+            stream_batch_size=stream_batch_size,
+            task_batch_size=task_batch_size,
+            split_failed_batches=split_failed_batches,
+            checkpoint_interval_seconds=checkpoint_interval_seconds,
+            min_number_of_workers=min_number_of_workers,
+            retry_policy=retry_policy,
+            hooks=hooks,
+            worker_initializer=worker_initializer,
+            worker_finalizer=worker_finalizer,
+            record_task_durations=record_task_durations)
+
+        return Pylo(executor, _local_store(
+            local_store_dir, journaled_store, sqlite_store, deduplicate_exceptions, max_stored_exceptions,
+            fsync_policy, codec, spill_interval_seconds), _local_completion_index(local_store_dir))
+
+    @classmethod
+    def local_multiprocess(
+            cls,
+            local_store_dir,
+            number_of_workers,
+            max_worker_failures=1000,
+            task_executions_before_flush=1000,
+            store_exceptions=True,
+            journaled_store=False,
+            sqlite_store=False,
+            deduplicate_exceptions=False,
+            max_stored_exceptions=None,
+            task_batch_size=1,
+            split_failed_batches=True,
+            fsync_policy=None,
+            codec=None,
+            worker_initializer=None,
+            worker_finalizer=None,
+            spill_interval_seconds=None):
+        """
+        Creates a Pylo instance which uses processes as workers, and persists execution progress to a local directory.
+
+        Unlike threads, processes speed up CPU-bound tasks. The task function and its inputs have to be picklable if
+        the platform starts processes by spawning them (e.g. Windows or macOS).
+        :param local_store_dir:  the directory where Pylo will persist execution state (successful inputs and failures)
+        :param number_of_workers:  the number of processes to create to execute tasks
+        :param max_worker_failures:  the maximum allowed task failures per each worker, if a worker exceeds it, it would terminate
+        :param task_executions_before_flush:  the number of task executions between snapshotting execution state to disk,
+                                              it is also how many task outcomes each worker sends to Pylo at once
+        :param store_exceptions:   if set to false, task exceptions will not be persisted
+        :param journaled_store:  if set to true, each snapshot only appends inputs which finished or failed since the
+                                 previous snapshot, instead of rewriting the whole worker state
+        :param sqlite_store:  if set to true, Pylo persists execution state to an SQLite database in the local directory,
+                              instead of to one file per worker
+        :param deduplicate_exceptions:  if set to true, exceptions with the same type, message and traceback as an
+                                        already stored exception are only counted, see get_exception_counts
+        :param max_stored_exceptions:  if set, Pylo stops storing exceptions of an execution once it stored this many
+        :param task_batch_size:  if bigger than 1, the task function is called with lists of up to this many inputs,
+                                 see start_from_scratch for details
+        :param split_failed_batches:  if set to true, when the task function fails for a list of inputs, the list is
+                                      split in halves which are retried separately, until the failing inputs are found
+        :param fsync_policy:  one of 'never', 'snapshots' or 'always', whether written state is forced to disk, see
+                              PyloFileSystemExecutionStore and PyloSqliteExecutionStore for their defaults
+        :param codec:  the name of the codec which encodes inputs in snapshots (e.g. 'varint' or 'lines+gzip'), or
+                       a PyloCodec, see pylo.codec. It is not supported by the SQLite store
+        :param worker_initializer:  if set, a function which each worker process calls before it runs tasks, and which
+                                    returns the context of the worker (e.g. a database connection). The task function is
+                                    then called with the context as the second argument
+        :param worker_finalizer:  if set, a function which is called with the context of each worker once it stops (e.g.
+                                  to close the connection), also if the worker gave up after max_worker_failures
+        :param spill_interval_seconds:  if set, snapshots and exceptions are kept in memory, and only written to the
+                                        local directory this often, see local_multithread
+        :return: a new instance of this class
+        """
+
+        executor = PyloLocalMultiProcessExecutor(
+            number_of_workers=number_of_workers,
+            max_worker_failures=max_worker_failures,
+            executions_before_flush=task_executions_before_flush,
+            store_exceptions=store_exceptions,
+            task_batch_size=task_batch_size,
+            split_failed_batches=split_failed_batches,
+            worker_initializer=worker_initializer,
+            worker_finalizer=worker_finalizer)
+
+        return Pylo(executor, _local_store(
+            local_store_dir, journaled_store, sqlite_store, deduplicate_exceptions, max_stored_exceptions,
+            fsync_policy, codec, spill_interval_seconds), _local_completion_index(local_store_dir))
+
+    @classmethod
+    def local_asyncio(
+            cls,
+            local_store_dir,
+            max_concurrency=100,
+            max_worker_failures=1000,
+            task_executions_before_flush=1000,
+            store_exceptions=True,
+            journaled_store=False,
+            sqlite_store=False,
+            deduplicate_exceptions=False,
+            max_stored_exceptions=None,
+            fsync_policy=None,
+            codec=None,
+            worker_initializer=None,
+            worker_finalizer=None,
+            spill_interval_seconds=None):
+        """
+        Creates a Pylo instance which runs coroutine tasks (i.e. defined with "async def") on an asyncio event loop,
+        and persists execution progress to a local directory.
+
+        Executions started by this instance block until they finish, so they can not be started from a running
+        event loop.
+        :param local_store_dir:  the directory where Pylo will persist execution state (successful inputs and failures)
+        :param max_concurrency:  the maximum number of tasks running at the same time
+        :param max_worker_failures:  the maximum allowed task failures, if exceeded, no new tasks would be started
+        :param task_executions_before_flush:  the number of task executions between snapshotting execution state to disk
+        :param store_exceptions:   if set to false, task exceptions will not be persisted
+        :param journaled_store:  if set to true, each snapshot only appends inputs which finished or failed since the
+                                 previous snapshot, instead of rewriting the whole worker state
+        :param sqlite_store:  if set to true, Pylo persists execution state to an SQLite database in the local directory,
+                              instead of to one file per worker
+        :param deduplicate_exceptions:  if set to true, exceptions with the same type, message and traceback as an
+                                        already stored exception are only counted, see get_exception_counts
+        :param max_stored_exceptions:  if set, Pylo stops storing exceptions of an execution once it stored this many
+        :param fsync_policy:  one of 'never', 'snapshots' or 'always', whether written state is forced to disk, see
+                              PyloFileSystemExecutionStore and PyloSqliteExecutionStore for their defaults
+        :param codec:  the name of the codec which encodes inputs in snapshots (e.g. 'varint' or 'lines+gzip'), or
+                       a PyloCodec, see pylo.codec. It is not supported by the SQLite store
+        :param worker_initializer:  if set, a function (or coroutine function) which returns the context shared by all
+                                    tasks (e.g. an HTTP session), which the task function is called with as the second
+                                    argument
+        :param worker_finalizer:  if set, a function (or coroutine function) which is called with the context once all
+                                  tasks stopped
+        :param spill_interval_seconds:  if set, snapshots and exceptions are kept in memory, and only written to the
+                                        local directory this often, see local_multithread
+        :return: a new instance of this class
+        """
+
+        executor = PyloAsyncioExecutor(
+            max_concurrency=max_concurrency,
+            max_worker_failures=max_worker_failures,
+            executions_before_flush=task_executions_before_flush,
+            store_exceptions=store_exceptions,
+            worker_initializer=worker_initializer,
+            worker_finalizer=worker_finalizer)
+
+        return Pylo(executor, _local_store(
+            local_store_dir, journaled_store, sqlite_store, deduplicate_exceptions, max_stored_exceptions,
+            fsync_policy, codec, spill_interval_seconds), _local_completion_index(local_store_dir))
+
+    @classmethod
+    def distributed(
+            cls,
+            shared_store_dir,
+            number_of_workers,
+            number_of_shards=None,
+            lease_seconds=30.0,
+            node_id=None,
+            max_worker_failures=1000,
+            task_executions_before_flush=1000,
+            store_exceptions=True,
+            sqlite_store=False,
+            fsync_policy=None,
+            codec=None,
+            retry_delay_seconds=None,
+            max_retry_delay_seconds=60.0,
+            max_attempts=None,
+            hooks=(),
+            worker_initializer=None,
+            worker_finalizer=None,
+            record_task_durations=False):
+        """
+        Creates a Pylo instance which runs executions together with other nodes (processes, possibly on other hosts)
+        which use the same directory, see create_execution and join_execution.
+
+        Every node has to create its instance with the same shared_store_dir and sqlite_store. The directory has to
+        support file locks (e.g. a local disk, or NFSv4), and clocks of all hosts have to be in sync.
+        :param shared_store_dir:  the directory where Pylo persists execution state, shared by all nodes
+        :param number_of_workers:  the number of threads this node runs shards with
+        :param number_of_shards:  the number of shards new executions are split into, four per worker of this node by
+                                  default. More shards spread the inputs of nodes which crash over more nodes
+        :param lease_seconds:  how long a node which stopped renewing the lease of a shard (e.g. because it crashed)
+                               keeps it, before other nodes take the shard over
+        :param node_id:  the name of this node in logs and leases, the host name and process id by default
+        :param max_worker_failures:  the maximum allowed task failures per each shard, if a worker exceeds it, it would
+                                     give the shard up, and move on to the next one
+        :param task_executions_before_flush:  the number of task executions between snapshotting execution state to disk
+        :param store_exceptions:   if set to false, task exceptions will not be persisted
+        :param sqlite_store:  if set to true, Pylo persists execution state to an SQLite database in the shared
+                              directory, instead of to one file per shard
+        :param fsync_policy:  one of 'never', 'snapshots' or 'always', whether written state is forced to disk, see
+                              PyloFileSystemExecutionStore and PyloSqliteExecutionStore for their defaults
+        :param codec:  the name of the codec which encodes inputs in snapshots (e.g. 'varint' or 'lines+gzip'), or
+                       a PyloCodec, see pylo.codec. It is not supported by the SQLite store
+        :param retry_delay_seconds:  if set, failed inputs are retried only after this delay, see local_multithread
+        :param max_retry_delay_seconds:  the longest delay before retrying a failed input
+        :param max_attempts:  if set, inputs which failed this many times are no longer retried, and stay unfinished
+        :param hooks:  PyloHooks called as this node runs shards, see pylo.metrics
+        :param worker_initializer:  if set, a function which each worker of this node calls before it runs shards, see
+                                    local_multithread
+        :param worker_finalizer:  if set, a function which is called with the context of each worker once it stops
+        :param record_task_durations:  if set to true, how long the task took for each input on this node is stored
+                                       with the execution, see local_multithread
+        :return: a new instance of this class
+        """
+        retry_policy = None
+        if retry_delay_seconds is not None or max_attempts is not None:
+            retry_policy = PyloRetryPolicy(
+                delay_seconds=retry_delay_seconds or 0.0,
+                max_delay_seconds=max_retry_delay_seconds,
+                max_attempts=max_attempts)
+
+        executor = PyloDistributedExecutor(
+            number_of_workers=number_of_workers,
+            max_worker_failures=max_worker_failures,
+            executions_before_flush=task_executions_before_flush,
+            store_exceptions=store_exceptions,
+            number_of_shards=number_of_shards,
+            lease_seconds=lease_seconds,
+            node_id=node_id,
+            retry_policy=retry_policy,
+            hooks=hooks,
+            worker_initializer=worker_initializer,
+            worker_finalizer=worker_finalizer,
+            record_task_durations=record_task_durations)
 
-        pylo_store_dir = os.path.join(local_store_dir, 'pylo')
-        store = PyloFileSystemExecutionStore(pylo_store_dir)
-        return Pylo(executor, store)
+        return Pylo(executor, _local_store(
+            shared_store_dir, False, sqlite_store, False, None, fsync_policy, codec),
+            _local_completion_index(shared_store_dir))
 
-    def start_from_past_execution(self, past_execution_id, task_function):
+    def create_execution(self, task_inputs, task_name=None, cost_hint=None, durations_from=None):
+        """
+        Creates a new execution of a task over the given inputs, without running it. Nodes then run it together by
+        calling join_execution with its id. It needs an instance created with Pylo.distributed.
+
+        :param task_inputs:  the inputs of the task, should be iterable (e.g. list)
+        :param task_name:  if set, inputs which executions with the same task name finished are skipped, see
+                           start_from_scratch
+        :param cost_hint:  if set, inputs are split into shards by cost, see start_from_scratch
+        :param durations_from:  if set, inputs are split into shards by durations recorded by this execution, see
+                                start_from_scratch
+        :return:  the execution id of the new execution
+        """
+        new_execution_id = uuid.uuid4().hex
+        new_execution_state = self._skip_completed(PyloExecutionState(new_execution_id, [], task_inputs), task_name)
+        self._schedule_by_cost(new_execution_state, cost_hint, durations_from)
+        self._distributed_executor().create_shards(new_execution_state, self._task_store)
+        return new_execution_id
+
+    def join_execution(self, execution_id, task_function, task_name=None):
+        """
+        Runs shards of an execution created with create_execution (or started by any node with start_from_scratch or
+        start_from_past_execution), together with other nodes which joined it. It returns once all its shards are done,
+        including shards of nodes which crashed, which are taken over once their leases expire.
+
+        :param execution_id:  the id of the execution to join
+        :param task_function:   the task we would like to accomplish, the same on all nodes
+        :param task_name:  if set, inputs which this node finishes are recorded as finished by the task with this name
+        """
+        self._distributed_executor().join(execution_id, self._task_store_for(task_name), task_function)
+
+    def _distributed_executor(self):
+        if not isinstance(self._task_executor, PyloDistributedExecutor):
+            raise ValueError('Joining executions requires a distributed executor, see Pylo.distributed')
+        return self._task_executor
+
+    def start_from_past_execution(self, past_execution_id, task_function, task_inputs=None, task_name=None,
+                                  cost_hint=None, durations_from=None):
         """
         Starts a new execution which inherits state from the previous execution, i.e. "resumes" the previous execution.
 
@@ -52,37 +390,171 @@ class Pylo:
         The input task function should throw an exception when the task fails. Pylo will ignore its output, and if
         there is no exception, it would assume that the task finished successfully.
 
+        If the previous execution streamed its inputs, the same inputs have to be passed again. The new execution would
+        skip the inputs which the previous execution has already read, and stream the rest.
+
+        The new execution only stores the inputs it retries, and references the previous execution for its finished
+        inputs (unless the store does not support references, in which case the finished inputs are copied). Long
+        chains of executions resumed this way can be flattened with flatten_execution.
+
         :param past_execution_id:  the id of the previous execution which we would like to resume
         :param task_function:   the task we would like to accomplish, can be anything
+        :param task_inputs:   the inputs streamed to the previous execution, only needed if it streamed its inputs
+        :param task_name:  if set, unfinished inputs which other executions with the same task name have finished since
+                           are skipped, see start_from_scratch
+        :param cost_hint:  if set, unfinished inputs are scheduled by cost, see start_from_scratch
+        :param durations_from:  if set, unfinished inputs are scheduled by durations recorded by this execution (e.g.
+                                past_execution_id) or by executions it resumed, see start_from_scratch
         :return:  the execution id of the new, resumed execution of the input task
         """
 
-        state_so_far = self._task_store.load_whole_state(past_execution_id)
+        new_execution_id = uuid.uuid4().hex
+        bitmap_state = self._task_store.load_bitmap_state(past_execution_id)
+        if bitmap_state is not None:
+            # bitmaps are compact enough to be copied
+            new_execution_state = self._skip_completed(bitmap_state.with_execution_id(new_execution_id), task_name)
+            self._schedule_by_cost(new_execution_state, cost_hint, durations_from)
+            self._task_executor.execute(new_execution_state, self._task_store_for(task_name), task_function)
+            return new_execution_id
+
+        stream_offset = self._task_store.load_stream_offset(past_execution_id)
+        if stream_offset is not None and task_inputs is None:
+            raise ValueError(f'Execution {past_execution_id} streamed its inputs, so they are needed to resume it')
 
         # when we start from past execution, instead of overriding it, we create a new execution
-        # with state copied from the past execution
-        new_execution_id = uuid.uuid4().hex
-        new_execution_state = state_so_far.with_execution_id(new_execution_id)
-        self._task_executor.execute(new_execution_state, self._task_store, task_function)
+        # which references the past execution, and holds its unfinished inputs
+        if self._task_store.supports_parent_references:
+            unfinished_inputs = list(self._task_store.iter_inputs(past_execution_id, finished=False))
+            new_execution_state = PyloExecutionState(
+                new_execution_id, [], unfinished_inputs, stream_offset,
+                failed_attempts=self._task_store.load_failed_attempts(past_execution_id))
+            # the reference is only stored once the past state is loaded, so failing to load it leaves nothing behind
+            self._task_store.store_parent_execution(new_execution_id, past_execution_id)
+        else:
+            new_execution_state = self._task_store.load_whole_state(past_execution_id).with_execution_id(
+                new_execution_id)
+
+        if new_execution_state.is_streamed:
+            new_execution_state.input_stream = PyloInputStream(task_inputs, offset=new_execution_state.stream_offset)
+        new_execution_state = self._skip_completed(new_execution_state, task_name)
+        self._schedule_by_cost(new_execution_state, cost_hint, durations_from)
+        self._task_executor.execute(new_execution_state, self._task_store_for(task_name), task_function)
         return new_execution_id
 
-    def start_from_scratch(self, task_inputs, task_function):
+    def flatten_execution(self, execution_id):
+        """
+        Copies finished inputs of all executions which the given execution resumed (directly or not) into it, so that
+        querying its state no longer reads the past executions. The past executions are left intact.
+
+        It should not be called while the execution is running.
+
+        :param execution_id:  the id of the execution to flatten
+        """
+        # executions only reference past executions with stores which support it, otherwise they are flat already
+        if self._task_store.supports_parent_references:
+            self._task_store.flatten_execution(execution_id)
+
+    def start_from_scratch(self, task_inputs, task_function, stream_inputs=False, bitmap_state=False, task_name=None,
+                           cost_hint=None, durations_from=None):
         """
         Starts a new execution of the input task.
 
         The input task function should throw an exception when the task fails. Pylo will ignore its output, and if
         there is no exception, it would assume that the task finished successfully.
 
+        If the executor was created with task_batch_size bigger than 1, the task function is called with lists of
+        inputs instead. If it throws an exception, the task failed for all inputs in the list. It can also return a
+        dict which maps positions (within the list) of inputs for which the task failed to their exceptions.
+
+        When inputs are streamed, workers read them from task_inputs in small batches, so they never have to fit in
+        memory (e.g. task_inputs can be a generator over lines of a huge file). Instead of finished inputs, Pylo persists
+        how many inputs were read so far, so the inputs have to be passed again to resume the execution, or to list
+        its finished inputs.
+
+        With bitmap_state, inputs have to be a range of integers (e.g. range(1, 10 ** 9) of ids), and Pylo tracks
+        finished inputs with a bit per input, see PyloBitmapExecutionState.
+
+        With task_name, Pylo records inputs the execution finishes in a completion index (see PyloCompletionIndex), and
+        executions started with the same task name count inputs which are in the index as finished, without running
+        the task for them. It is not supported with streamed inputs or bitmap states.
+
+        With cost_hint or durations_from, inputs are split between workers by how long the task is expected to take
+        for them, so that all workers finish at about the same time, and each worker runs its longest inputs first (see
+        PyloTaskCosts). Expected durations are durations which the execution durations_from (or executions it resumed)
+        recorded, if it was run by an instance created with record_task_durations, otherwise what cost_hint returns
+        for the input. It is not supported with bitmap states.
+
         :param task_inputs:  the inputs of the task, should be iterable (e.g. list)
         :param task_function:   the task we would like to accomplish, can be anything
+        :param stream_inputs:   if set to true, inputs are read lazily
+        :param bitmap_state:   if set to true, finished inputs are tracked in a bitmap
+        :param task_name:   if set, inputs which executions with the same task name finished are skipped
+        :param cost_hint:   if set, a function which returns how long the task is expected to take for an input, in
+                            seconds
+        :param durations_from:   if set, the id of an earlier execution of the task, which recorded task durations
         :return:
         """
         new_execution_id = uuid.uuid4().hex
-        new_execution_state = PyloExecutionState(new_execution_id, [], task_inputs)
-        self._task_executor.execute(new_execution_state, self._task_store, task_function)
+        if bitmap_state:
+            if stream_inputs:
+                raise ValueError('Bitmap states can not stream inputs, they track the whole range of inputs')
+            new_execution_state = PyloBitmapExecutionState.from_range(new_execution_id, task_inputs)
+        elif stream_inputs:
+            new_execution_state = PyloExecutionState(
+                new_execution_id, [], [], stream_offset=0, input_stream=PyloInputStream(task_inputs))
+        else:
+            new_execution_state = PyloExecutionState(new_execution_id, [], task_inputs)
+        new_execution_state = self._skip_completed(new_execution_state, task_name)
+        self._schedule_by_cost(new_execution_state, cost_hint, durations_from)
+        self._task_executor.execute(new_execution_state, self._task_store_for(task_name), task_function)
         return new_execution_id
 
-    def get_state(self, execution_id):
+    def _skip_completed(self, execution_state, task_name):
+        """
+        :return:  the given state, with unfinished inputs which the task finished in other executions moved to
+                  finished inputs
+        """
+        if task_name is None:
+            return execution_state
+        completion_index = self._completion_index_of(task_name)
+        if execution_state.is_streamed or isinstance(execution_state, PyloBitmapExecutionState):
+            raise ValueError('Skipping completed inputs is not supported with streamed inputs or bitmap states')
+
+        completed_inputs, unfinished_inputs = completion_index.split_completed(
+            task_name, execution_state.unfinished_inputs)
+        if not completed_inputs:
+            return execution_state
+
+        _logger.info(f'Skipping {len(completed_inputs)} inputs which task {task_name} already finished')
+        return PyloExecutionState(
+            execution_state.execution_id, list(execution_state.finished_inputs) + completed_inputs, unfinished_inputs,
+            failed_attempts=execution_state.failed_attempts)
+
+    def _schedule_by_cost(self, execution_state, cost_hint, durations_from):
+        if cost_hint is None and durations_from is None:
+            return
+        if isinstance(execution_state, PyloBitmapExecutionState):
+            raise ValueError('Scheduling inputs by cost is not supported with bitmap states')
+
+        if durations_from is not None and not self._task_store.supports_task_durations:
+            raise ValueError(f'Unable to schedule inputs by recorded durations, '
+                             f'{type(self._task_store).__name__} does not support them')
+
+        recorded_durations = self._task_store.load_task_durations(durations_from) \
+            if durations_from is not None else {}
+        execution_state.task_costs = PyloTaskCosts(recorded_durations, cost_hint)
+
+    def _task_store_for(self, task_name):
+        if task_name is None:
+            return self._task_store
+        return _CompletionRecordingStore(self._task_store, self._completion_index_of(task_name), task_name)
+
+    def _completion_index_of(self, task_name):
+        if self._completion_index is None:
+            raise ValueError(f'Unable to skip inputs of task {task_name}, this instance has no completion index')
+        return self._completion_index
+
+    def get_state(self, execution_id, task_inputs=None):
         """
         Returns the state of a given execution.
 
@@ -90,11 +562,92 @@ class Pylo:
         and a list of unfinished task inputs. The unfinished inputs either failed, or have not run yet (e.g. because
         Pylo program was terminated, or because the max_worker_failures was exceeded for all workers.
 
+        If the execution streamed its inputs, the same inputs have to be passed again to list finished inputs. Inputs
+        which the execution has not read yet are neither finished nor unfinished.
+
         :param execution_id:  the id of the execution which state we would like to query
+        :param task_inputs:   the inputs streamed to the execution, only needed if it streamed its inputs
         :return:   a tuple which consists of finished and unfinished task inputs
         """
         task_state = self._task_store.load_whole_state(execution_id)
-        return task_state.finished_inputs, task_state.unfinished_inputs
+        if task_state.is_streamed:
+            if task_inputs is None:
+                raise ValueError(f'Execution {execution_id} streamed its inputs, so they are needed to list its state')
+            task_state = task_state.with_streamed_inputs(task_inputs)
+
+        return list(task_state.finished_inputs), list(task_state.unfinished_inputs)
+
+    def count_inputs(self, execution_id):
+        """
+        Counts finished and unfinished inputs of a given execution, without loading the inputs themselves (as far as
+        the store allows it). It is meant for polling large executions.
+
+        :param execution_id:  the id of the execution which state we would like to query
+        :return:  a tuple which consists of the number of finished and unfinished task inputs
+        """
+        return self._task_store.count_inputs(execution_id)
+
+    def iter_finished_inputs(self, execution_id, task_inputs=None):
+        """
+        Lazily iterates over task inputs over which the task run successfully in a given execution.
+
+        :param execution_id:  the id of the execution which state we would like to query
+        :param task_inputs:   the inputs streamed to the execution, only needed if it streamed its inputs
+        :return:  an iterator over finished task inputs
+        """
+        stream_offset = self._task_store.load_stream_offset(execution_id)
+        if stream_offset is None:
+            return self._task_store.iter_inputs(execution_id, finished=True)
+        if task_inputs is None:
+            raise ValueError(f'Execution {execution_id} streamed its inputs, so they are needed to list its state')
+
+        unfinished_inputs = self._task_store.iter_inputs(execution_id, finished=False)
+        return iter_streamed_finished_inputs(task_inputs, stream_offset, unfinished_inputs)
+
+    def iter_unfinished_inputs(self, execution_id):
+        """
+        Lazily iterates over unfinished task inputs of a given execution.
+
+        :param execution_id:  the id of the execution which state we would like to query
+        :return:  an iterator over unfinished task inputs
+        """
+        return self._task_store.iter_inputs(execution_id, finished=False)
+
+    def get_finished_inputs_page(self, execution_id, offset, limit, task_inputs=None):
+        """
+        Returns a page of task inputs over which the task run successfully in a given execution.
+
+        :param execution_id:  the id of the execution which state we would like to query
+        :param offset:  the number of finished inputs to skip
+        :param limit:  the maximum number of finished inputs to return
+        :param task_inputs:   the inputs streamed to the execution, only needed if it streamed its inputs
+        :return:  a list of finished task inputs
+        """
+        if self._task_store.load_stream_offset(execution_id) is None:
+            return self._task_store.load_inputs_page(execution_id, True, offset, limit)
+        return list(itertools.islice(self.iter_finished_inputs(execution_id, task_inputs), offset, offset + limit))
+
+    def get_unfinished_inputs_page(self, execution_id, offset, limit):
+        """
+        Returns a page of unfinished task inputs of a given execution.
+
+        :param execution_id:  the id of the execution which state we would like to query
+        :param offset:  the number of unfinished inputs to skip
+        :param limit:  the maximum number of unfinished inputs to return
+        :return:  a list of unfinished task inputs
+        """
+        return self._task_store.load_inputs_page(execution_id, False, offset, limit)
+
+    def get_failed_attempts(self, execution_id):
+        """
+        Returns how many times the task failed for each unfinished input of a given execution. Resumed executions carry
+        on counting from the execution they resume.
+
+        :param execution_id:  the id of the execution which state we would like to query
+        :return:  a dict which maps unfinished inputs which failed to the number of times they failed (inputs which are
+                  not hashable, e.g. lists, are pickled)
+        """
+        return self._task_store.load_failed_attempts(execution_id)
 
     def get_exceptions(self, execution_id):
         """
@@ -103,3 +656,51 @@ class Pylo:
         :return:  a list which consists of Exception
         """
         return self._task_store.load_task_exceptions(execution_id)
+
+    def get_exception_counts(self, execution_id):
+        """
+        Returns exceptions thrown when running the execution with the given id, together with the number of times
+        each of them was thrown. Exceptions are only counted more than once if Pylo deduplicates them.
+        :param execution_id:  the id of the execution which state we would like to query
+        :return:  a list which consists of pairs of Exception and its count
+        """
+        return self._task_store.load_task_exception_counts(execution_id)
+
+
+def _local_completion_index(local_store_dir):
+    # the database is only created once an execution is started with a task name
+    return PyloCompletionIndex(os.path.join(local_store_dir, 'pylo', 'completed.sqlite3'))
+
+
+def _local_store(local_store_dir, journaled_store, sqlite_store, deduplicate_exceptions, max_stored_exceptions,
+                 fsync_policy, codec, spill_interval_seconds=None):
+    store = _durable_local_store(
+        local_store_dir, journaled_store, sqlite_store, deduplicate_exceptions, max_stored_exceptions, fsync_policy,
+        codec)
+    if spill_interval_seconds is not None:
+        return PyloTieredExecutionStore(store, spill_interval_seconds=spill_interval_seconds)
+    return store
+
+
+def _durable_local_store(local_store_dir, journaled_store, sqlite_store, deduplicate_exceptions, max_stored_exceptions,
+                         fsync_policy, codec):
+    pylo_store_dir = os.path.join(local_store_dir, 'pylo')
+    # each store has its own default fsync policy
+    fsync_kwargs = {} if fsync_policy is None else {'fsync_policy': fsync_policy}
+    if sqlite_store:
+        if codec is not None:
+            raise ValueError('The SQLite store does not support codecs')
+        os.makedirs(pylo_store_dir, exist_ok=True)
+        return PyloSqliteExecutionStore(
+            os.path.join(pylo_store_dir, 'pylo.sqlite3'),
+            deduplicate_exceptions=deduplicate_exceptions,
+            max_stored_exceptions=max_stored_exceptions,
+            **fsync_kwargs)
+
+    return PyloFileSystemExecutionStore(
+        pylo_store_dir,
+        journaled=journaled_store,
+        deduplicate_exceptions=deduplicate_exceptions,
+        max_stored_exceptions=max_stored_exceptions,
+        codec=codec,
+        **fsync_kwargs)
@@ -1,8 +1,26 @@
+import asyncio
+import heapq
+import inspect
+import itertools
 import logging
+import multiprocessing
+import os
+import queue
+import random
+import socket
 import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 from abc import ABC, abstractmethod
-from pylo.state import PyloExecutionState, PyloExecutionStore
+from pylo.checkpoint import PyloCheckpointer
+from pylo.concurrency import PyloConcurrencyController
+from pylo.metrics import _TimedStore
+from pylo.scheduling import _DurationRecorder
+from pylo.sink import picklable_exception
+from pylo.state import PyloExecutionState, PyloExecutionStore, PyloBitmapExecutionState, _ASSIGNED, \
+    _apply_worker_journal
 
 _logger = logging.getLogger(__name__)
 
@@ -14,11 +32,49 @@ class PyloTaskExecutor(ABC):
 
 
 class PyloLocalMultiThreadExecutor(PyloTaskExecutor):
-    def __init__(self, number_of_workers, max_worker_failures, executions_before_flush, store_exceptions):
+    """
+    Runs tasks in number_of_workers threads.
+
+    If min_number_of_workers is set, only as many workers run tasks at once as a PyloConcurrencyController allows,
+    between min_number_of_workers and number_of_workers, depending on task latency and failures. The controller of the
+    latest execution is kept in concurrency_controller.
+
+    If retry_policy (a PyloRetryPolicy) is set, workers retry failed inputs only after a delay, and run other inputs
+    in the meantime. Otherwise, failed inputs are retried once the worker gets to them again.
+
+    hooks (PyloHooks, e.g. PyloMetrics) are called as tasks start and end, as workers flush their state, and for every
+    store call which writes state or exceptions.
+
+    If worker_initializer is set, each worker calls it once before it runs tasks, and calls the task function with what
+    it returned (e.g. a database connection) as the second argument. worker_finalizer is then called with it once the
+    worker stops, also if it gave up.
+
+    If record_task_durations is set, how long the task took for each input is stored with every flush (see
+    store_task_durations of stores), so that later executions can schedule inputs by it, see PyloTaskCosts.
+    """
+    def __init__(self, number_of_workers, max_worker_failures, executions_before_flush, store_exceptions,
+                 work_stealing=False, stream_batch_size=100, task_batch_size=1, split_failed_batches=True,
+                 checkpoint_interval_seconds=None, min_number_of_workers=None, retry_policy=None, hooks=(),
+                 worker_initializer=None, worker_finalizer=None, record_task_durations=False):
+        if executions_before_flush is None and checkpoint_interval_seconds is None:
+            raise ValueError('Either executions_before_flush or checkpoint_interval_seconds has to be set')
+
         self._number_of_workers = number_of_workers
         self._max_worker_failures = max_worker_failures
         self._executions_before_flush = executions_before_flush
         self._store_exceptions = store_exceptions
+        self._work_stealing = work_stealing
+        self._stream_batch_size = stream_batch_size
+        self._task_batch_size = task_batch_size
+        self._split_failed_batches = split_failed_batches
+        self._checkpoint_interval_seconds = checkpoint_interval_seconds
+        self._min_number_of_workers = min_number_of_workers
+        self._retry_policy = retry_policy
+        self._hooks = list(hooks)
+        self._worker_initializer = worker_initializer
+        self._worker_finalizer = worker_finalizer
+        self._record_task_durations = record_task_durations
+        self.concurrency_controller = None
 
     def execute(self, execution_state: PyloExecutionState, task_store: PyloExecutionStore, task_function):
         _logger.info(
@@ -26,8 +82,22 @@ class PyloLocalMultiThreadExecutor(PyloTaskExecutor):
             f'Tasks completed so far {len(execution_state.finished_inputs)}. '
             f'Tasks to complete: {len(execution_state.unfinished_inputs)}.')
 
+        hooks = _execution_hooks(self._hooks, self._record_task_durations, task_store, execution_state.execution_id)
+        if hooks:
+            task_store = _TimedStore(task_store, hooks)
+            for hook in hooks:
+                hook.on_execution_start(execution_state.execution_id)
+
         finished_state, unfinished_states = execution_state.split_unfinished(
             into_number=self._number_of_workers)
+        checkpointer = PyloCheckpointer(task_store, self._checkpoint_interval_seconds) \
+            if self._checkpoint_interval_seconds is not None else None
+        if self._min_number_of_workers is not None:
+            self.concurrency_controller = PyloConcurrencyController(
+                self._min_number_of_workers, self._number_of_workers,
+                on_change=_concurrency_reporter(hooks, execution_state.execution_id))
+            for hook in hooks:
+                hook.on_concurrency_change(execution_state.execution_id, self.concurrency_controller.concurrency)
 
         # we always write the finished state with the 'worker id' different to all actual workers
         finished_worker_id = 0
@@ -39,6 +109,8 @@ class PyloLocalMultiThreadExecutor(PyloTaskExecutor):
         worker_threads = []
         for worker_id, unfinished_state in enumerate(unfinished_states, start=finished_worker_id + 1):
             task_store.store_worker_state(execution_state.execution_id, worker_id, unfinished_state)
+            if checkpointer is not None and not isinstance(unfinished_state, PyloBitmapExecutionState):
+                checkpointer.add_worker(execution_state.execution_id, worker_id, unfinished_state)
             worker_thread = WorkerThread(
                 execution_id=execution_state.execution_id,
                 worker_id=worker_id,
@@ -47,9 +119,24 @@ class PyloLocalMultiThreadExecutor(PyloTaskExecutor):
                 task_store=task_store,
                 max_worker_failures=self._max_worker_failures,
                 store_exceptions=self._store_exceptions,
-                executions_before_flush=self._executions_before_flush)
+                executions_before_flush=self._executions_before_flush,
+                stream_batch_size=self._stream_batch_size,
+                task_batch_size=self._task_batch_size,
+                split_failed_batches=self._split_failed_batches,
+                checkpointer=checkpointer,
+                concurrency_controller=self.concurrency_controller,
+                retry_policy=self._retry_policy,
+                hooks=hooks,
+                worker_initializer=self._worker_initializer,
+                worker_finalizer=self._worker_finalizer)
 
             worker_threads.append(worker_thread)
+            if checkpointer is not None:
+                checkpointer.add_source(worker_thread.checkpoint)
+
+        if self._work_stealing:
+            for worker_thread in worker_threads:
+                worker_thread.peers = worker_threads
 
         for worker_thread in worker_threads:
             worker_thread.start()
@@ -57,13 +144,561 @@ class PyloLocalMultiThreadExecutor(PyloTaskExecutor):
         for worker_thread in worker_threads:
             worker_thread.join()
 
-        _logger.info('All worker threads finished')
+        try:
+            if checkpointer is not None:
+                checkpointer.close()
+        finally:
+            task_store.finish_execution(execution_state.execution_id)
+        for hook in hooks:
+            hook.on_execution_end(execution_state.execution_id)
+        if self.concurrency_controller is not None:
+            _logger.info(f'All worker threads finished, with concurrency {self.concurrency_controller.concurrency}')
+        else:
+            _logger.info('All worker threads finished')
+
+
+class PyloLocalMultiProcessExecutor(PyloTaskExecutor):
+    """
+    Runs each worker in a separate process, so that CPU-bound tasks are not limited by the GIL.
+
+    Worker processes run the same loop as WorkerThread, but instead of writing to the store themselves, they send the
+    inputs which finished or failed (and exceptions) to the parent process in batches, once per flush. The parent
+    process marks them in its copy of the worker state and persists it, so the store is only ever used by one process.
+
+    worker_initializer and worker_finalizer are called in each worker process, see PyloLocalMultiThreadExecutor.
+    """
+    def __init__(self, number_of_workers, max_worker_failures, executions_before_flush, store_exceptions,
+                 task_batch_size=1, split_failed_batches=True, worker_initializer=None, worker_finalizer=None):
+        self._number_of_workers = number_of_workers
+        self._max_worker_failures = max_worker_failures
+        self._executions_before_flush = executions_before_flush
+        self._store_exceptions = store_exceptions
+        self._task_batch_size = task_batch_size
+        self._split_failed_batches = split_failed_batches
+        self._worker_initializer = worker_initializer
+        self._worker_finalizer = worker_finalizer
+
+    def execute(self, execution_state: PyloExecutionState, task_store: PyloExecutionStore, task_function):
+        if execution_state.input_stream is not None:
+            raise ValueError('Streamed inputs are not supported by worker processes')
+
+        _logger.info(
+            f'Starting execution of tasks. Execution id {execution_state.execution_id}. '
+            f'Tasks completed so far {len(execution_state.finished_inputs)}. '
+            f'Tasks to complete: {len(execution_state.unfinished_inputs)}.')
+
+        finished_state, unfinished_states = execution_state.split_unfinished(
+            into_number=self._number_of_workers)
+
+        finished_worker_id = 0
+        task_store.store_worker_state(
+            execution_state.execution_id,
+            finished_worker_id,
+            finished_state)
+
+        progress_queue = multiprocessing.Queue()
+        worker_states = {}
+        worker_processes = {}
+        for worker_id, unfinished_state in enumerate(unfinished_states, start=finished_worker_id + 1):
+            task_store.store_worker_state(execution_state.execution_id, worker_id, unfinished_state)
+            worker_states[worker_id] = unfinished_state
+            worker_processes[worker_id] = multiprocessing.Process(
+                target=_run_worker_process,
+                args=(execution_state.execution_id, worker_id, task_function,
+                      list(unfinished_state.unfinished_inputs), self._max_worker_failures,
+                      self._store_exceptions, self._executions_before_flush, self._task_batch_size,
+                      self._split_failed_batches, self._worker_initializer, self._worker_finalizer, progress_queue))
+
+        for worker_process in worker_processes.values():
+            worker_process.start()
+
+        try:
+            self._collect_progress(
+                execution_state.execution_id, task_store, worker_states, worker_processes, progress_queue)
+        except BaseException:
+            # workers whose progress can no longer be stored are stopped, rather than left running
+            for worker_process in worker_processes.values():
+                worker_process.terminate()
+            raise
+        finally:
+            for worker_process in worker_processes.values():
+                worker_process.join()
+
+        task_store.finish_execution(execution_state.execution_id)
+        _logger.info('All worker processes finished')
+
+    @staticmethod
+    def _collect_progress(execution_id, task_store, worker_states, worker_processes, progress_queue):
+        running_worker_ids = set(worker_processes)
+        while running_worker_ids:
+            try:
+                worker_id, journal, exceptions = progress_queue.get(timeout=1)
+            except queue.Empty:
+                for worker_id in list(running_worker_ids):
+                    if worker_processes[worker_id].exitcode is not None and progress_queue.empty():
+                        _logger.error(f'Worker process {worker_id} exited with code '
+                                      f'{worker_processes[worker_id].exitcode} without reporting that it finished')
+                        running_worker_ids.discard(worker_id)
+                continue
+
+            if journal is None:
+                running_worker_ids.discard(worker_id)
+                continue
+
+            for exception in exceptions:
+                task_store.store_task_exception(execution_id, exception)
+
+            if not journal:
+                continue
+
+            _apply_worker_journal(worker_states[worker_id], journal)
+            task_store.store_worker_state(execution_id, worker_id, worker_states[worker_id])
+
+
+class PyloAsyncioExecutor(PyloTaskExecutor):
+    """
+    Runs coroutine task functions concurrently on a single event loop, which scales to thousands of concurrent IO-bound
+    tasks (e.g. HTTP requests) much better than a thread per worker.
+
+    All inputs belong to a single worker, with max_worker_failures applying to all its tasks. Snapshots and exceptions
+    are written to the store by a separate thread, so the event loop never waits on the store.
+
+    The context created by worker_initializer (see PyloLocalMultiThreadExecutor) is shared by all tasks, which is what
+    e.g. HTTP sessions of async clients are made for. worker_initializer and worker_finalizer can be coroutine functions
+    too, and are called on the event loop.
+    """
+    def __init__(self, max_concurrency, max_worker_failures, executions_before_flush, store_exceptions,
+                 worker_initializer=None, worker_finalizer=None):
+        self._max_concurrency = max_concurrency
+        self._max_worker_failures = max_worker_failures
+        self._executions_before_flush = executions_before_flush
+        self._store_exceptions = store_exceptions
+        self._worker_initializer = worker_initializer
+        self._worker_finalizer = worker_finalizer
+
+    def execute(self, execution_state: PyloExecutionState, task_store: PyloExecutionStore, task_function):
+        if not _is_coroutine_function(task_function):
+            raise TypeError(f'The asyncio executor runs coroutine functions (async def), got {task_function!r}')
+
+        _logger.info(
+            f'Starting execution of tasks. Execution id {execution_state.execution_id}. '
+            f'Tasks completed so far {len(execution_state.finished_inputs)}. '
+            f'Tasks to complete: {len(execution_state.unfinished_inputs)}.')
+
+        finished_state, unfinished_states = execution_state.split_unfinished(into_number=1)
+
+        finished_worker_id = 0
+        task_store.store_worker_state(
+            execution_state.execution_id,
+            finished_worker_id,
+            finished_state)
+
+        worker_id = finished_worker_id + 1
+        worker_state = unfinished_states[0] if unfinished_states else \
+            PyloExecutionState(execution_state.execution_id, [], [])
+        task_store.store_worker_state(execution_state.execution_id, worker_id, worker_state)
+
+        with ThreadPoolExecutor(max_workers=1, thread_name_prefix='pylo-store') as store_executor:
+            asyncio.run(self._run_tasks(worker_id, worker_state, task_store, task_function, store_executor))
+
+        task_store.finish_execution(execution_state.execution_id)
+        _logger.info('All tasks finished')
+
+    async def _run_tasks(self, worker_id, worker_state, task_store, task_function, store_executor):
+        loop = asyncio.get_running_loop()
+        execution_id = worker_state.execution_id
+        in_flight_inputs = {}
+        task_ids = itertools.count()
+        store_futures = []
+        failures_so_far = 0
+        finished_since_flush = 0
+        flush_in_progress = None
+        # the store thread keeps its own copy of the worker state, and brings it up to date with journals, so that
+        # flushes only hand over what changed instead of copying the whole state on the event loop. In-flight inputs
+        # are not journaled yet, so they are still unfinished in the copy. Snapshots of bitmap states are cheap, since
+        # they share the bitmap, so they are stored as they are
+        stored_state = None if isinstance(worker_state, PyloBitmapExecutionState) else worker_state.snapshot()
+
+        def store_changes(journal, stream_offset):
+            _apply_worker_journal(stored_state, journal)
+            stored_state.stream_offset = stream_offset
+            task_store.store_worker_state(execution_id, worker_id, stored_state)
+
+        def flush():
+            nonlocal finished_since_flush, flush_in_progress
+            finished_since_flush = 0
+            if stored_state is None:
+                flush_in_progress = loop.run_in_executor(
+                    store_executor, task_store.store_worker_state, execution_id, worker_id,
+                    worker_state.snapshot(in_flight_inputs.values()))
+            else:
+                flush_in_progress = loop.run_in_executor(
+                    store_executor, store_changes, worker_state.take_journal(), worker_state.stream_offset)
+            store_futures.append(flush_in_progress)
+
+        task_context = ()
+        if self._worker_initializer is not None:
+            try:
+                task_context = (await _maybe_await(self._worker_initializer()),)
+            except Exception as e:
+                _logger.error(f'Failed to initialize the worker, so no tasks will run. Failure message: {str(e)}')
+                if self._store_exceptions:
+                    await loop.run_in_executor(store_executor, task_store.store_task_exception, execution_id, e)
+                return
+
+        async def run_tasks_one_by_one():
+            nonlocal failures_so_far, finished_since_flush
+            # there is only one worker, so inputs claimed from the stream are persisted by the next flush, together with
+            # the stream offset
+            while (worker_state.unfinished_inputs or worker_state.claim_from_stream(self._max_concurrency)) and \
+                    failures_so_far < self._max_worker_failures:
+                task_input = worker_state.next_unfinished()
+                task_id = next(task_ids)
+                in_flight_inputs[task_id] = task_input
+                try:
+                    await task_function(task_input, *task_context)
+                except Exception as e:
+                    _logger.error(f'Failed to execute task for input {task_input}. '
+                                  f'Failures so far: {failures_so_far}. Failure message: {str(e)}')
+
+                    del in_flight_inputs[task_id]
+                    worker_state.mark_failed(task_input)
+                    failures_so_far += 1
+
+                    if self._store_exceptions:
+                        store_futures.append(loop.run_in_executor(
+                            store_executor, task_store.store_task_exception, execution_id, e))
+                    continue
+
+                del in_flight_inputs[task_id]
+                worker_state.mark_finished(task_input)
+                finished_since_flush += 1
+
+                # if the previous flush has not finished yet, we do not queue another one, the next task will retry
+                if finished_since_flush >= self._executions_before_flush and \
+                        (flush_in_progress is None or flush_in_progress.done()):
+                    flush()
+
+        try:
+            await asyncio.gather(*(run_tasks_one_by_one() for _ in range(self._max_concurrency)))
+        finally:
+            if self._worker_finalizer is not None and task_context:
+                try:
+                    await _maybe_await(self._worker_finalizer(*task_context))
+                except Exception as e:
+                    _logger.error(f'Failed to finalize the worker. Failure message: {str(e)}')
+        if failures_so_far >= self._max_worker_failures:
+            _logger.error(f'Failed more than {self._max_worker_failures} times so gave up')
+
+        flush()
+        await asyncio.gather(*store_futures)
+
+
+def _execution_hooks(hooks, record_task_durations, task_store, execution_id):
+    """
+    :return:  hooks of an execution, which include a recorder of task durations if they are recorded
+    """
+    if not record_task_durations:
+        return hooks
+    if not task_store.supports_task_durations:
+        raise ValueError(f'Unable to record task durations, {type(task_store).__name__} does not support them')
+    return hooks + [_DurationRecorder(task_store, execution_id)]
+
+
+def _concurrency_reporter(hooks, execution_id):
+    def report(concurrency):
+        for hook in hooks:
+            hook.on_concurrency_change(execution_id, concurrency)
+    return report
+
+
+async def _maybe_await(result):
+    return await result if inspect.isawaitable(result) else result
+
+
+def _is_coroutine_function(function):
+    # callable objects count if their __call__ is a coroutine function
+    return inspect.iscoroutinefunction(function) or inspect.iscoroutinefunction(getattr(function, '__call__', None))
+
+
+class PyloDistributedExecutor(PyloTaskExecutor):
+    """
+    Runs an execution on several nodes, i.e. processes (possibly on different hosts) which share a store, e.g. a
+    PyloFileSystemExecutionStore in a shared directory, or a PyloSqliteExecutionStore.
+
+    Unfinished inputs are split into number_of_shards shards up front (see create_shards), which are stored as worker
+    states. Any node can then join the execution by its id (see join), and run number_of_workers workers, each of which
+    takes the lease of a shard, runs its inputs like a WorkerThread, and moves on to the next shard. Leases expire after
+    lease_seconds unless they are renewed, which workers do every heartbeat_interval_seconds and before every snapshot,
+    so once the leases of a node which crashed expire, other nodes take over its shards from their latest snapshots.
+    A worker which finds its lease taken over stops without storing anything further.
+
+    A shard is done once all its inputs finished, or its worker gave up after max_worker_failures. Nodes keep polling
+    for expired leases every poll_interval_seconds until all shards are done.
+
+    Each worker of a node creates its context with worker_initializer (see PyloLocalMultiThreadExecutor) once, and
+    uses it for all shards it runs. The same goes for record_task_durations, every node stores durations of the tasks
+    it ran.
+    """
+    def __init__(self, number_of_workers, max_worker_failures, executions_before_flush, store_exceptions,
+                 number_of_shards=None, lease_seconds=30.0, heartbeat_interval_seconds=None, poll_interval_seconds=None,
+                 node_id=None, task_batch_size=1, split_failed_batches=True, retry_policy=None, hooks=(),
+                 worker_initializer=None, worker_finalizer=None, record_task_durations=False):
+        heartbeat_interval_seconds = heartbeat_interval_seconds or lease_seconds / 3
+        if heartbeat_interval_seconds >= lease_seconds:
+            raise ValueError(f'Expected heartbeat_interval_seconds shorter than lease_seconds, got '
+                             f'{heartbeat_interval_seconds} and {lease_seconds}')
+
+        self._number_of_workers = number_of_workers
+        self._max_worker_failures = max_worker_failures
+        self._executions_before_flush = executions_before_flush
+        self._store_exceptions = store_exceptions
+        # more shards than workers, so that the shards of a node which crashed are spread over the other nodes
+        self._number_of_shards = number_of_shards or 4 * number_of_workers
+        self._lease_seconds = lease_seconds
+        self._heartbeat_interval_seconds = heartbeat_interval_seconds
+        # polling only reads leases, so nodes which wait for shards of other nodes can leave soon after they are done
+        self._poll_interval_seconds = poll_interval_seconds or min(heartbeat_interval_seconds, 1.0)
+        self._task_batch_size = task_batch_size
+        self._split_failed_batches = split_failed_batches
+        self._retry_policy = retry_policy
+        self._hooks = list(hooks)
+        self._worker_initializer = worker_initializer
+        self._worker_finalizer = worker_finalizer
+        self._record_task_durations = record_task_durations
+        self.node_id = node_id or f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+    def execute(self, execution_state: PyloExecutionState, task_store: PyloExecutionStore, task_function):
+        self.create_shards(execution_state, task_store)
+        self.join(execution_state.execution_id, task_store, task_function)
+
+    def create_shards(self, execution_state: PyloExecutionState, task_store: PyloExecutionStore):
+        """
+        Splits unfinished inputs of the execution into shards, and stores them, so that nodes can join the execution.
+        """
+        _check_supports_leases(task_store)
+        if execution_state.input_stream is not None:
+            raise ValueError('Streamed inputs are not supported by the distributed executor')
+        if isinstance(execution_state, PyloBitmapExecutionState):
+            raise ValueError('Bitmap states are not supported by the distributed executor')
+
+        _logger.info(
+            f'Creating shards of execution {execution_state.execution_id}. '
+            f'Tasks completed so far {len(execution_state.finished_inputs)}. '
+            f'Tasks to complete: {len(execution_state.unfinished_inputs)}.')
+
+        finished_state, unfinished_states = execution_state.split_unfinished(into_number=self._number_of_shards)
+        # nodes which join an execution without unfinished inputs still need a shard to find it done
+        unfinished_states = unfinished_states or [PyloExecutionState(execution_state.execution_id, [], [])]
+
+        finished_worker_id = 0
+        task_store.store_worker_state(execution_state.execution_id, finished_worker_id, finished_state)
+        shard_ids = []
+        for shard_id, unfinished_state in enumerate(unfinished_states, start=finished_worker_id + 1):
+            task_store.store_worker_state(execution_state.execution_id, shard_id, unfinished_state)
+            shard_ids.append(shard_id)
+        # leases go last, so nodes never find shards which are not stored yet
+        task_store.create_leases(execution_state.execution_id, shard_ids)
+
+    def join(self, execution_id, task_store: PyloExecutionStore, task_function):
+        """
+        Runs shards of the given execution on this node, until all shards are done.
+        """
+        _check_supports_leases(task_store)
+        if not task_store.load_leases(execution_id):
+            raise ValueError(f'Execution {execution_id} has no shards, it has to be started by a distributed executor')
+
+        _logger.info(f'Node {self.node_id} joining execution {execution_id}')
+        hooks = _execution_hooks(self._hooks, self._record_task_durations, task_store, execution_id)
+        if hooks:
+            task_store = _TimedStore(task_store, hooks)
+            for hook in hooks:
+                hook.on_execution_start(execution_id)
+
+        heartbeat = _LeaseHeartbeat(self._heartbeat_interval_seconds)
+        worker_threads = [
+            threading.Thread(target=self._run_shards, args=(f'{self.node_id}/{index}', execution_id, task_store,
+                                                            task_function, heartbeat, hooks),
+                             name=f'pylo-node-worker-{index}')
+            for index in range(self._number_of_workers)]
+        for worker_thread in worker_threads:
+            worker_thread.start()
+        for worker_thread in worker_threads:
+            worker_thread.join()
+
+        heartbeat.close()
+        task_store.finish_execution(execution_id)
+        for hook in hooks:
+            hook.on_execution_end(execution_id)
+        _logger.info(f'All shards of execution {execution_id} are done, node {self.node_id} leaves')
+
+    def _run_shards(self, owner, execution_id, task_store, task_function, heartbeat, hooks):
+        task_context = ()
+        if self._worker_initializer is not None:
+            try:
+                task_context = (self._worker_initializer(),)
+            except Exception as e:
+                # shards are left to other workers
+                _logger.error(f'Worker {owner} failed to initialize, so it will not run shards. '
+                              f'Failure message: {str(e)}')
+                if self._store_exceptions:
+                    task_store.store_task_exception(execution_id, e)
+                return
+
+        try:
+            self._run_shards_with_context(
+                owner, execution_id, task_store, task_function, heartbeat, hooks, task_context)
+        finally:
+            if task_context:
+                _finalize_worker(self._worker_finalizer, task_context, owner)
+
+    def _run_shards_with_context(self, owner, execution_id, task_store, task_function, heartbeat, hooks,
+                                 task_context):
+        while True:
+            shard_id = self._acquire_shard(owner, execution_id, task_store)
+            if shard_id is None:
+                return
+
+            worker = _ShardWorker(
+                owner=owner,
+                lease_seconds=self._lease_seconds,
+                execution_id=execution_id,
+                worker_id=shard_id,
+                task_function=task_function,
+                task_state=task_store.load_worker_state(execution_id, shard_id),
+                task_store=task_store,
+                max_worker_failures=self._max_worker_failures,
+                store_exceptions=self._store_exceptions,
+                executions_before_flush=self._executions_before_flush,
+                task_batch_size=self._task_batch_size,
+                split_failed_batches=self._split_failed_batches,
+                retry_policy=self._retry_policy,
+                hooks=hooks)
+            worker.task_context = task_context
+            heartbeat.add(worker)
+            try:
+                worker.run()
+            finally:
+                heartbeat.remove(worker)
+
+            if not worker.lease_lost:
+                task_store.release_lease(execution_id, shard_id, owner, done=True)
+
+    def _acquire_shard(self, owner, execution_id, task_store):
+        """
+        :return:  the id of a shard which owner took the lease of, or None once all shards are done
+        """
+        while True:
+            leases = task_store.load_leases(execution_id)
+            if all(done for _, _, done in leases.values()):
+                return None
+
+            now = time.time()
+            available_shard_ids = [shard_id for shard_id, (lease_owner, expires_at, done) in leases.items()
+                                   if not done and (lease_owner is None or expires_at <= now)]
+            # in random order, so that nodes rarely compete for the same shard
+            random.shuffle(available_shard_ids)
+            for shard_id in available_shard_ids:
+                if task_store.acquire_lease(execution_id, shard_id, owner, self._lease_seconds):
+                    if leases[shard_id][0] is not None:
+                        _logger.warning(f'Worker {owner} took over shard {shard_id} of execution {execution_id}, '
+                                        f'since the lease of {leases[shard_id][0]} expired')
+                    return shard_id
+
+            # shards leased by other nodes are taken over if those nodes crash
+            time.sleep(self._poll_interval_seconds)
+
+
+def _check_supports_leases(task_store):
+    if not task_store.supports_leases:
+        raise ValueError(f'{type(task_store).__name__} does not support leases, which the distributed executor needs')
+
+
+class _LeaseHeartbeat:
+    """
+    Renews leases of shard workers of a node from a background thread, every interval_seconds.
+    """
+    def __init__(self, interval_seconds):
+        self._interval_seconds = interval_seconds
+        self._workers = set()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._renew_periodically, name='pylo-heartbeat', daemon=True)
+        self._thread.start()
+
+    def add(self, worker):
+        with self._lock:
+            self._workers.add(worker)
+
+    def remove(self, worker):
+        # once removed, the lease of the worker is never renewed, so it can be released
+        with self._lock:
+            self._workers.discard(worker)
+
+    def close(self):
+        self._closed.set()
+        self._thread.join()
+
+    def _renew_periodically(self):
+        while not self._closed.wait(self._interval_seconds):
+            with self._lock:
+                for worker in self._workers:
+                    try:
+                        worker.renew_lease()
+                    except Exception as e:
+                        # the lease expires unless a later renewal succeeds
+                        _logger.error(f'Unable to renew the lease of worker {worker.owner}. Failure message: {str(e)}')
+
+
+class _ProgressReporter:
+    """
+    Stands in for the execution store in worker processes, which only store worker states and exceptions. Instead of
+    persisting anything, it sends inputs which finished or failed since the previous flush (the journal of the worker
+    state), together with exceptions, to the parent process.
+    """
+    def __init__(self, progress_queue):
+        self._progress_queue = progress_queue
+        self._exceptions = []
+
+    def store_worker_state(self, execution_id, worker_id, task_execution_state):
+        self._progress_queue.put((worker_id, task_execution_state.take_journal(), self._exceptions))
+        self._exceptions = []
+
+    def store_task_exception(self, execution_id, exception):
+        self._exceptions.append(picklable_exception(exception))
+
+
+def _run_worker_process(execution_id, worker_id, task_function, task_inputs, max_worker_failures,
+                        store_exceptions, executions_before_flush, task_batch_size, split_failed_batches,
+                        worker_initializer, worker_finalizer, progress_queue):
+    try:
+        progress_reporter = _ProgressReporter(progress_queue)
+        worker = WorkerThread(
+            execution_id=execution_id,
+            worker_id=worker_id,
+            task_function=task_function,
+            task_state=PyloExecutionState(execution_id, [], task_inputs),
+            task_store=progress_reporter,
+            max_worker_failures=max_worker_failures,
+            store_exceptions=store_exceptions,
+            executions_before_flush=executions_before_flush,
+            task_batch_size=task_batch_size,
+            split_failed_batches=split_failed_batches,
+            worker_initializer=worker_initializer,
+            worker_finalizer=worker_finalizer)
+        # runs the worker loop in this process, rather than in a new thread
+        worker.run()
+        worker._store_state()
+    finally:
+        progress_queue.put((worker_id, None, None))
 
 
 class WorkerThread(threading.Thread):
     def __init__(self, execution_id, worker_id,
                  task_function, task_state, task_store,
-                 max_worker_failures, store_exceptions, executions_before_flush):
+                 max_worker_failures, store_exceptions, executions_before_flush, stream_batch_size=100,
+                 task_batch_size=1, split_failed_batches=True, checkpointer=None, concurrency_controller=None,
+                 retry_policy=None, hooks=(), worker_initializer=None, worker_finalizer=None):
         threading.Thread.__init__(self)
         self.execution_id = execution_id
         self.worker_id = worker_id
@@ -73,44 +708,359 @@ class WorkerThread(threading.Thread):
         self.max_worker_failures = max_worker_failures
         self.executions_before_flush = executions_before_flush
         self.store_exceptions = store_exceptions
+        self.stream_batch_size = stream_batch_size
+        # if bigger than 1, the task function is called with lists of inputs instead of single inputs
+        self.task_batch_size = task_batch_size
+        self.split_failed_batches = split_failed_batches
+        # if set, snapshots are stored by the checkpointer in the background, instead of by this worker
+        self.checkpointer = checkpointer
+        # if set, limits how many workers run tasks at once
+        self.concurrency_controller = concurrency_controller
+        # if set, failed inputs wait in delayed_inputs before they are retried
+        self.retry_policy = retry_policy
+        # a heap of (time when the input is retried, sequence number, input)
+        self.delayed_inputs = []
+        self._delayed_ids = itertools.count()
+        # inputs which failed max attempts times, they are not retried by this execution
+        self.abandoned_inputs = []
+        self.hooks = hooks
+        self.worker_initializer = worker_initializer
+        self.worker_finalizer = worker_finalizer
+        # extra arguments of the task function, the context created by worker_initializer if there is one
+        self.task_context = ()
         self.failures_so_far = 0
+        self.finished_since_flush = 0
+        # inputs taken from unfinished inputs, which have not finished or failed yet
+        self.in_flight_inputs = []
+        self.gave_up = False
+        # workers which this worker can steal unfinished inputs from, once it runs out of its own
+        self.peers = []
+        # guards task_state, which is shared with peers stealing from this worker
+        self.state_lock = threading.Lock()
 
     def run(self):
+        if self.worker_initializer is not None:
+            # the context is created in the thread which uses it, since e.g. sqlite connections can not change threads
+            try:
+                self.task_context = (self.worker_initializer(),)
+            except Exception as e:
+                _logger.error(f'Worker {self.worker_id} failed to initialize, so it will give up. '
+                              f'Failure message: {str(e)}')
+                with self.state_lock:
+                    self.gave_up = True
+                if self.store_exceptions:
+                    self.task_store.store_task_exception(self.execution_id, e)
+                return
+
+        try:
+            self._run_tasks()
+        finally:
+            if self.task_context:
+                _finalize_worker(self.worker_finalizer, self.task_context, f'worker {self.worker_id}')
+
+    def _run_tasks(self):
         _logger.info(f'Starting worker {self.worker_id} for execution {self.execution_id}. '
                      f'Executions to perform: {len(self.task_state.unfinished_inputs)}, '
                      f'finished executions: {len(self.task_state.finished_inputs)}')
 
-        while self.task_state.unfinished_inputs:
+        while self._has_unfinished_inputs() or self._claim_from_stream() or self._steal_unfinished() or \
+                self._wait_for_delayed_inputs():
             if self.failures_so_far >= self.max_worker_failures:
                 _logger.error(f'Worker {self.worker_id} failed more than '
                               f'{self.max_worker_failures} times so it will give up')
-                self.task_store.store_worker_state(
-                    execution_id=self.execution_id,
-                    worker_id=self.worker_id,
-                    task_execution_state=self.task_state)
+                with self.state_lock:
+                    self.gave_up = True
+                    self._store_state()
 
                 return
 
-            cur_task_input = self.task_state.unfinished_inputs.pop(0)
+            with self.state_lock:
+                cur_task_inputs = []
+                while len(cur_task_inputs) < self.task_batch_size and self.task_state.unfinished_inputs:
+                    task_input = self.task_state.next_unfinished()
+                    # inputs of resumed executions may have failed max attempts times already
+                    if not self._abandon_if_out_of_attempts(task_input):
+                        cur_task_inputs.append(task_input)
+                self.in_flight_inputs.extend(cur_task_inputs)
+            if not cur_task_inputs:
+                continue
+
+            for cur_task_input, e in self._run_task_and_measure(cur_task_inputs):
+                if e is not None:
+                    _logger.error(f'Worker {self.worker_id} failed to execute task for input {cur_task_input}. '
+                                  f'Failures so far: {self.failures_so_far}. Failure message: {str(e)}')
+
+                    with self.state_lock:
+                        self.in_flight_inputs.remove(cur_task_input)
+                        self._mark_failed(cur_task_input)
+                    self.failures_so_far += 1
+
+                    if self.store_exceptions:
+                        self.task_store.store_task_exception(self.execution_id, e)
+                    continue
+
+                with self.state_lock:
+                    self.in_flight_inputs.remove(cur_task_input)
+                    self.task_state.mark_finished(cur_task_input)
+                    self.finished_since_flush += 1
+
+            with self.state_lock:
+                # executions_before_flush is None if snapshots are only triggered by the checkpointer
+                if (self.executions_before_flush is not None and
+                        self.finished_since_flush >= self.executions_before_flush) or \
+                        len(self.task_state.unfinished_inputs) == 0:
+                    self._store_state()
+
+    def _mark_failed(self, task_input):
+        """
+        Marks the input as failed, and schedules its retry, the caller has to hold state_lock.
+        """
+        if self.retry_policy is None:
+            self.task_state.mark_failed(task_input)
+            return
+
+        # the input stays unfinished in the store, but the worker holds it until it is due, like an in-flight input
+        self.task_state.mark_failed(task_input, requeue=False)
+        if self._abandon_if_out_of_attempts(task_input):
+            return
+
+        failed_attempts = self.task_state.failed_attempts_of(task_input)
+        retry_at = time.monotonic() + self.retry_policy.retry_delay_seconds(failed_attempts)
+        heapq.heappush(self.delayed_inputs, (retry_at, next(self._delayed_ids), task_input))
+
+    def _abandon_if_out_of_attempts(self, task_input):
+        """
+        Moves the input to abandoned inputs if it failed max attempts times, the caller has to hold state_lock.
+        """
+        if self.retry_policy is None or not self.task_state.failed_attempts:
+            return False
+
+        failed_attempts = self.task_state.failed_attempts_of(task_input)
+        if self.retry_policy.should_retry(failed_attempts):
+            return False
+
+        _logger.error(f'Worker {self.worker_id} failed to execute task for input {task_input} {failed_attempts} '
+                      f'times, so it will not retry it')
+        self.abandoned_inputs.append(task_input)
+        return True
+
+    def _has_unfinished_inputs(self):
+        if self.delayed_inputs:
+            with self.state_lock:
+                now = time.monotonic()
+                while self.delayed_inputs and self.delayed_inputs[0][0] <= now:
+                    self.task_state.requeue_failed(heapq.heappop(self.delayed_inputs)[2])
+        return bool(self.task_state.unfinished_inputs)
+
+    def _wait_for_delayed_inputs(self):
+        """
+        Called once the worker runs out of other inputs, waits until the next delayed input is due.
+        :return:  false if there are no delayed inputs
+        """
+        if not self.delayed_inputs:
+            return False
+
+        waiting_since = time.monotonic()
+        time.sleep(max(0.0, self.delayed_inputs[0][0] - waiting_since))
+        self._report_idle(time.monotonic() - waiting_since)
+        return True
+
+    def _report_idle(self, seconds):
+        for hook in self.hooks:
+            hook.on_idle(self.execution_id, self.worker_id, seconds)
+
+    def _run_task_and_measure(self, task_inputs):
+        """
+        Runs the task within the limit of the concurrency controller, and reports its latency to the controller and
+        to hooks.
+        """
+        if self.concurrency_controller is None and not self.hooks:
+            return self._run_task(task_inputs)
+
+        if self.concurrency_controller is not None:
+            # inputs are taken before waiting, so that thieves can still steal all other unfinished inputs of this worker
+            waiting_since = time.monotonic()
+            self.concurrency_controller.acquire()
+            self._report_idle(time.monotonic() - waiting_since)
+        for hook in self.hooks:
+            hook.on_task_start(self.execution_id, self.worker_id, task_inputs, len(self.task_state.unfinished_inputs))
+
+        started_at = time.monotonic()
+        results = None
+        try:
+            results = self._run_task(task_inputs)
+            return results
+        finally:
+            seconds = time.monotonic() - started_at
+            if self.concurrency_controller is not None:
+                failed = results is None or any(e is not None for _, e in results)
+                self.concurrency_controller.release(seconds, failed)
+            if results is not None:
+                for hook in self.hooks:
+                    hook.on_task_end(self.execution_id, self.worker_id, task_inputs, [e for _, e in results], seconds)
+
+    def _run_task(self, task_inputs):
+        """
+        Runs the task over the given inputs, and returns a list of pairs of each input and the exception it failed with
+        (or None if the task finished successfully).
+        """
+        if self.task_batch_size == 1:
             try:
-                self.task_function(cur_task_input)
+                self.task_function(task_inputs[0], *self.task_context)
             except Exception as e:
-                _logger.error(f'Worker {self.worker_id} failed to execute task for input {cur_task_input}. '
-                              f'Failures so far: {self.failures_so_far}. Failure message: {str(e)}')
+                return [(task_inputs[0], e)]
+            return [(task_inputs[0], None)]
 
-                self.task_state.unfinished_inputs.append(cur_task_input)
-                self.failures_so_far += 1
+        try:
+            results = self.task_function(task_inputs, *self.task_context)
+        except Exception as e:
+            if self.split_failed_batches and len(task_inputs) > 1:
+                # we do not know which inputs made the batch fail, so we retry both halves separately, until
+                # the failing inputs are isolated
+                middle = len(task_inputs) // 2
+                return self._run_task(task_inputs[:middle]) + self._run_task(task_inputs[middle:])
+            return [(task_input, e) for task_input in task_inputs]
 
-                if self.store_exceptions:
-                    self.task_store.store_task_exception(self.execution_id, e)
-                continue
+        # only a dict reports failures, anything else the task returns (e.g. ids of inserted rows) is ignored, as it is
+        # for single inputs
+        failures = results if isinstance(results, dict) else {}
+        return [(task_input, failures.get(position)) for position, task_input in enumerate(task_inputs)]
+
+    def _claim_from_stream(self):
+        input_stream = self.task_state.input_stream
+        if input_stream is None:
+            return False
+
+        # the claimed inputs are persisted before any other worker can claim more, so the highest persisted stream
+        # offset never skips inputs which are not persisted as unfinished by some worker
+        with input_stream.lock, self.state_lock:
+            if not self.task_state.claim_from_stream(self.stream_batch_size):
+                return False
+            self._store_state(wait=True)
+
+        return True
+
+    def _steal_unfinished(self):
+        while True:
+            victim = max(
+                (peer for peer in self.peers if peer is not self and not peer.gave_up),
+                key=lambda peer: len(peer.task_state.unfinished_inputs),
+                default=None)
+            if victim is None or len(victim.task_state.unfinished_inputs) < 2:
+                return False
+
+            # locks are always taken in the order of worker ids, so that two workers stealing from each other
+            # can not deadlock
+            first, second = sorted((self, victim), key=lambda worker: worker.worker_id)
+            with first.state_lock, second.state_lock:
+                if victim.gave_up:
+                    continue
+
+                # the victim always keeps at least half of its inputs, so it never runs out of the input it checked for
+                stolen_inputs = victim.task_state.give_away_unfinished(len(victim.task_state.unfinished_inputs) // 2)
+                if not stolen_inputs:
+                    continue
+
+                self.task_state.assign_unfinished(
+                    stolen_inputs, victim.task_state.failed_attempts_of_inputs(stolen_inputs))
+
+                # the thief is stored first, so if we crash in between, stolen inputs are duplicated rather than lost
+                self._store_state(wait=True)
+                victim._store_state(wait=True)
+
+            _logger.info(f'Worker {self.worker_id} stole {len(stolen_inputs)} inputs from worker {victim.worker_id}')
+            return True
+
+    def checkpoint(self):
+        """
+        Called by the checkpointer from its background thread, submits a snapshot if the state changed since the
+        previous one. It never blocks, if the state is in use the next checkpoint will catch up.
+        """
+        if not self.state_lock.acquire(blocking=False):
+            return
+        try:
+            if self.task_state.has_changes():
+                self._store_state()
+        finally:
+            self.state_lock.release()
+
+    def _store_state(self, wait=False):
+        """
+        Stores the state of this worker, the caller has to hold state_lock (unless no other thread can use the state).
+        :param wait:  if set to true, returns only once the state is stored, even if it is stored by the checkpointer
+        """
+        started_at = time.monotonic()
+        self.finished_since_flush = 0
+        if self.checkpointer is not None and not isinstance(self.task_state, PyloBitmapExecutionState):
+            # the checkpointer keeps its own copy of the state, so we only hand over what changed. Held inputs are not
+            # journaled until they finish or fail, so they are still unfinished in the copy
+            journal = self.task_state.take_journal()
+            assigned_inputs = (task_input for status, task_input in journal if status == _ASSIGNED)
+            self.checkpointer.submit_changes(
+                self.execution_id, self.worker_id, journal, self.task_state.stream_offset,
+                self.task_state.failed_attempts_of_inputs(assigned_inputs), wait=wait)
+            self._report_flush(started_at)
+            return
+
+        # in-flight, delayed and abandoned inputs are not in unfinished inputs of the state, but they have to be stored
+        # as unfinished
+        held_inputs = self.in_flight_inputs + [task_input for _, _, task_input in self.delayed_inputs] + \
+            self.abandoned_inputs
+        task_state = self.task_state.snapshot(held_inputs) \
+            if held_inputs or self.checkpointer is not None else self.task_state
+        if self.checkpointer is not None:
+            self.checkpointer.submit(self.execution_id, self.worker_id, task_state, wait=wait)
+        else:
+            self.task_store.store_worker_state(
+                execution_id=self.execution_id,
+                worker_id=self.worker_id,
+                task_execution_state=task_state)
+        self._report_flush(started_at)
+
+    def _report_flush(self, started_at):
+        for hook in self.hooks:
+            hook.on_flush(self.execution_id, self.worker_id, time.monotonic() - started_at)
+
+
+def _finalize_worker(worker_finalizer, task_context, worker_name):
+    if worker_finalizer is None:
+        return
+    try:
+        worker_finalizer(*task_context)
+    except Exception as e:
+        _logger.error(f'Failed to finalize {worker_name}. Failure message: {str(e)}')
+
+
+class _ShardWorker(WorkerThread):
+    """
+    Runs inputs of a shard which owner holds the lease of, in the calling thread, until they run out or the lease is
+    lost. Unlike a WorkerThread, it never steals inputs, and once the lease is lost, it leaves the shard to the new
+    owner without storing it.
+    """
+    def __init__(self, owner, lease_seconds, **kwargs):
+        super().__init__(**kwargs)
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.lease_lost = False
+
+    def renew_lease(self):
+        """
+        :return:  false if the lease expired and was taken over by another worker
+        """
+        if not self.lease_lost and \
+                not self.task_store.acquire_lease(self.execution_id, self.worker_id, self.owner, self.lease_seconds):
+            _logger.warning(f'Worker {self.owner} lost the lease of shard {self.worker_id} of execution '
+                            f'{self.execution_id}, so it stops')
+            self.lease_lost = True
+        return not self.lease_lost
 
-            self.task_state.finished_inputs.append(cur_task_input)
+    def _has_unfinished_inputs(self):
+        return not self.lease_lost and super()._has_unfinished_inputs()
 
-            if len(self.task_state.finished_inputs) % self.executions_before_flush == 0 or \
-                    len(self.task_state.unfinished_inputs) == 0:
+    def _wait_for_delayed_inputs(self):
+        return not self.lease_lost and super()._wait_for_delayed_inputs()
 
-                self.task_store.store_worker_state(
-                    execution_id=self.execution_id,
-                    worker_id=self.worker_id,
-                    task_execution_state=self.task_state)
+    def _store_state(self, wait=False):
+        # the lease is renewed first, so a worker which was stalled past its lease never overwrites the new owner
+        if self.renew_lease():
+            super()._store_state(wait)
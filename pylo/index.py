@@ -0,0 +1,190 @@
+# coding=utf-8
+import hashlib
+import math
+import os
+import pickle
+import sqlite3
+import threading
+
+from pylo.state import FINISHED
+
+
+class PyloCompletionIndex:
+    """
+    Remembers which inputs a task finished, across executions, so that new executions of the task can skip them. Tasks
+    are told apart by name, so each task name has its own set of finished inputs.
+
+    Inputs are identified by a fingerprint, a hash of the pickled input (or of what the fingerprint function returns
+    for it), so inputs have to pickle the same way every time, e.g. numbers, strings or tuples of them, but not sets of
+    strings, whose order changes between processes.
+
+    Fingerprints are kept in an SQLite table, indexed by task name and fingerprint. In front of it, a Bloom filter per
+    task name, built in memory on first use, answers most lookups of inputs which never finished without reading the
+    table. Inputs which other processes record after the filter was built are not skipped by this process, they just
+    run again.
+    """
+    # lookups of candidates which passed the Bloom filter are batched in queries of this many fingerprints
+    LOOKUP_BATCH_SIZE = 500
+
+    def __init__(self, database_path, fingerprint=None, false_positive_rate=0.01):
+        """
+        :param database_path:  the SQLite database which keeps fingerprints, it is created on first use
+        :param fingerprint:  if set, a function which maps an input to a stable value it is identified by (e.g. its id),
+                             instead of the whole input
+        :param false_positive_rate:  the share of lookups of inputs which never finished which the Bloom filter lets
+                                     through to the table
+        """
+        self.database_path = database_path
+        self._fingerprint = fingerprint
+        self._false_positive_rate = false_positive_rate
+        # task name -> Bloom filter of its fingerprints
+        self._bloom_filters = {}
+        self._lock = threading.Lock()
+        # sqlite connections can not be shared between threads, so each thread opens its own
+        self._connections = threading.local()
+
+    def fingerprint(self, task_input):
+        value = self._fingerprint(task_input) if self._fingerprint is not None else task_input
+        # a fixed protocol, so that equal inputs always have the same fingerprint
+        return hashlib.blake2b(pickle.dumps(value, protocol=4), digest_size=16).digest()
+
+    def split_completed(self, task_name, task_inputs):
+        """
+        :return:  a tuple which consists of a list of inputs which the task already finished, and a list of the other
+                  inputs, both in the order of task_inputs
+        """
+        bloom_filter = self._bloom_filter(task_name)
+        inputs_with_fingerprints = [(task_input, self.fingerprint(task_input)) for task_input in task_inputs]
+        candidates = [fingerprint for _, fingerprint in inputs_with_fingerprints if fingerprint in bloom_filter]
+
+        completed_fingerprints = set()
+        for start in range(0, len(candidates), self.LOOKUP_BATCH_SIZE):
+            batch = candidates[start:start + self.LOOKUP_BATCH_SIZE]
+            completed_fingerprints.update(fingerprint for fingerprint, in self._connection().execute(
+                f'SELECT fingerprint FROM completed WHERE task_name = ? AND fingerprint IN '
+                f'({", ".join("?" * len(batch))})', [task_name] + batch))
+
+        completed_inputs, uncompleted_inputs = [], []
+        for task_input, fingerprint in inputs_with_fingerprints:
+            (completed_inputs if fingerprint in completed_fingerprints else uncompleted_inputs).append(task_input)
+        return completed_inputs, uncompleted_inputs
+
+    def is_completed(self, task_name, task_input):
+        return bool(self.split_completed(task_name, [task_input])[0])
+
+    def record_completed(self, task_name, task_inputs):
+        """
+        Records that the task finished the given inputs.
+        """
+        fingerprints = [self.fingerprint(task_input) for task_input in task_inputs]
+        if not fingerprints:
+            return
+
+        with self._connection() as connection:
+            connection.executemany(
+                'INSERT OR IGNORE INTO completed (task_name, fingerprint) VALUES (?, ?)',
+                ((task_name, fingerprint) for fingerprint in fingerprints))
+
+        bloom_filter = self._bloom_filters.get(task_name)
+        if bloom_filter is not None:
+            with self._lock:
+                for fingerprint in fingerprints:
+                    bloom_filter.add(fingerprint)
+                if bloom_filter.is_full():
+                    # the filter lets more and more lookups through as it fills up, so it is rebuilt twice as large
+                    del self._bloom_filters[task_name]
+
+    def count_completed(self, task_name):
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM completed WHERE task_name = ?', (task_name,)).fetchone()[0]
+
+    def clear(self, task_name):
+        """
+        Forgets all inputs the task finished, so that new executions run them again.
+        """
+        with self._connection() as connection:
+            connection.execute('DELETE FROM completed WHERE task_name = ?', (task_name,))
+        with self._lock:
+            self._bloom_filters.pop(task_name, None)
+
+    def _bloom_filter(self, task_name):
+        with self._lock:
+            bloom_filter = self._bloom_filters.get(task_name)
+            if bloom_filter is None:
+                bloom_filter = _BloomFilter(max(2 * self.count_completed(task_name), 10000), self._false_positive_rate)
+                for fingerprint, in self._connection().execute(
+                        'SELECT fingerprint FROM completed WHERE task_name = ?', (task_name,)):
+                    bloom_filter.add(fingerprint)
+                self._bloom_filters[task_name] = bloom_filter
+            return bloom_filter
+
+    def _connection(self):
+        connection = getattr(self._connections, 'connection', None)
+        if connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.database_path)), exist_ok=True)
+            connection = sqlite3.connect(self.database_path, timeout=60)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(_SQLITE_SCHEMA)
+            self._connections.connection = connection
+        return connection
+
+
+class _BloomFilter:
+    """
+    A set of fingerprints which may report fingerprints it does not hold as held (at about false_positive_rate while it
+    holds at most capacity fingerprints), but never the other way around.
+    """
+    def __init__(self, capacity, false_positive_rate):
+        self.capacity = capacity
+        self.size = 0
+        self._number_of_bits = math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2)
+        self._number_of_hashes = max(1, round(self._number_of_bits / capacity * math.log(2)))
+        self._bits = bytearray((self._number_of_bits + 7) // 8)
+
+    def add(self, fingerprint):
+        for position in self._positions(fingerprint):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.size += 1
+
+    def is_full(self):
+        return self.size > self.capacity
+
+    def __contains__(self, fingerprint):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(fingerprint))
+
+    def _positions(self, fingerprint):
+        # fingerprints are already hashes, so two halves of one are enough to derive all positions (double hashing)
+        first_hash = int.from_bytes(fingerprint[:8], 'little')
+        second_hash = int.from_bytes(fingerprint[8:16], 'little') | 1
+        return [(first_hash + i * second_hash) % self._number_of_bits for i in range(self._number_of_hashes)]
+
+
+class _CompletionRecordingStore:
+    """
+    Wraps a store, and records inputs which finished in the completion index whenever a worker state is stored. Other
+    calls are passed through to the store as they are.
+    """
+    def __init__(self, task_store, completion_index, task_name):
+        self._task_store = task_store
+        self._completion_index = completion_index
+        self._task_name = task_name
+
+    def store_worker_state(self, execution_id, worker_id, task_execution_state):
+        # the journal is put back, since stores which write changes only need it too
+        journal = task_execution_state.take_journal()
+        task_execution_state.prepend_journal(journal)
+        self._task_store.store_worker_state(execution_id, worker_id, task_execution_state)
+        self._completion_index.record_completed(
+            self._task_name, [task_input for status, task_input in journal if status == FINISHED])
+
+    def __getattr__(self, name):
+        return getattr(self._task_store, name)
+
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS completed (
+    task_name TEXT NOT NULL,
+    fingerprint BLOB NOT NULL,
+    PRIMARY KEY (task_name, fingerprint)
+) WITHOUT ROWID;
+"""
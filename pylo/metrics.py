@@ -0,0 +1,238 @@
+# coding=utf-8
+import bisect
+import json
+import logging
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+
+class PyloHooks:
+    """
+    Callbacks which executors call as an execution runs, e.g. to collect metrics or to profile tasks. All of them do
+    nothing by default, so hooks only override the ones they need.
+
+    Hooks are called from worker threads (and on_flush and on_store also from the checkpointer thread), so they have to
+    be thread-safe, and fast, since workers wait for them.
+    """
+
+    def on_execution_start(self, execution_id):
+        pass
+
+    def on_execution_end(self, execution_id):
+        pass
+
+    def on_task_start(self, execution_id, worker_id, task_inputs, queue_depth):
+        """
+        :param task_inputs:  the list of inputs the task function is called with (one input, unless tasks are batched)
+        :param queue_depth:  the number of unfinished inputs the worker has left, besides these
+        """
+        pass
+
+    def on_task_end(self, execution_id, worker_id, task_inputs, exceptions, seconds):
+        """
+        :param exceptions:  the exception each input failed with, or None for inputs which finished
+        :param seconds:  how long the task function took
+        """
+        pass
+
+    def on_flush(self, execution_id, worker_id, seconds):
+        """
+        :param seconds:  how long the worker waited for its state to be snapshotted (and stored, unless it is stored
+                         in the background)
+        """
+        pass
+
+    def on_store(self, execution_id, operation, seconds):
+        """
+        :param operation:  the name of the store method, store_worker_state or store_task_exception
+        """
+        pass
+
+    def on_idle(self, execution_id, worker_id, seconds):
+        """
+        Called when a worker waited without running tasks, e.g. for a retry to be due or for a free slot of the
+        concurrency controller.
+        """
+        pass
+
+    def on_concurrency_change(self, execution_id, concurrency):
+        """
+        Called with the limit of the concurrency controller when the execution starts, and whenever the limit changes,
+        if the executor adapts concurrency (see PyloConcurrencyController).
+        """
+        pass
+
+
+class PyloMetrics(PyloHooks):
+    """
+    Hooks which count tasks which finished and failed, per worker and overall, and measure throughput, task latency
+    (as a histogram), queue depth, idle time, time spent in store calls, and how concurrency was adapted. Comparing
+    time spent in tasks to time spent in the store tells whether an execution is bound by tasks or by the store.
+
+    stats() returns the metrics as a dict. If dump_path is set, they are also appended to that file as a JSON line
+    every dump_interval_seconds, and once more when the execution ends.
+    """
+    # upper bounds of latency histogram buckets, in seconds
+    LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 30, 60, float('inf'))
+
+    def __init__(self, dump_path=None, dump_interval_seconds=60.0):
+        self._dump_path = dump_path
+        self._dump_interval_seconds = dump_interval_seconds
+        self._lock = threading.Lock()
+        self._execution_id = None
+        self._started_at = None
+        self._workers = {}
+        self._store_calls = {}
+        # pairs of seconds since the execution started and the limit of concurrency set at that time
+        self._concurrency_history = []
+        self._stop_dumping = threading.Event()
+        self._dumper = None
+
+    def on_execution_start(self, execution_id):
+        with self._lock:
+            self._execution_id = execution_id
+            self._started_at = time.monotonic()
+            self._workers = {}
+            self._store_calls = {}
+            self._concurrency_history = []
+
+        if self._dump_path is not None:
+            self._stop_dumping.clear()
+            self._dumper = threading.Thread(target=self._dump_periodically, name='pylo-metrics', daemon=True)
+            self._dumper.start()
+
+    def on_execution_end(self, execution_id):
+        if self._dumper is not None:
+            self._stop_dumping.set()
+            self._dumper.join()
+            self._dumper = None
+            self._dump()
+
+    def on_task_start(self, execution_id, worker_id, task_inputs, queue_depth):
+        with self._lock:
+            self._worker(worker_id)['queue_depth'] = queue_depth
+
+    def on_task_end(self, execution_id, worker_id, task_inputs, exceptions, seconds):
+        failed = sum(e is not None for e in exceptions)
+        with self._lock:
+            worker = self._worker(worker_id)
+            worker['tasks_completed'] += len(exceptions) - failed
+            worker['tasks_failed'] += failed
+            worker['task_seconds'] += seconds
+            worker['latency_histogram'][bisect.bisect_left(self.LATENCY_BUCKETS, seconds)] += 1
+
+    def on_flush(self, execution_id, worker_id, seconds):
+        with self._lock:
+            worker = self._worker(worker_id)
+            worker['flushes'] += 1
+            worker['flush_seconds'] += seconds
+
+    def on_store(self, execution_id, operation, seconds):
+        with self._lock:
+            calls = self._store_calls.setdefault(operation, {'calls': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+            calls['calls'] += 1
+            calls['total_seconds'] += seconds
+            calls['max_seconds'] = max(calls['max_seconds'], seconds)
+
+    def on_idle(self, execution_id, worker_id, seconds):
+        with self._lock:
+            self._worker(worker_id)['idle_seconds'] += seconds
+
+    def on_concurrency_change(self, execution_id, concurrency):
+        with self._lock:
+            self._concurrency_history.append((time.monotonic() - self._started_at, concurrency))
+
+    def stats(self):
+        """
+        :return:  a dict with metrics of the latest execution, overall and per worker (under 'workers')
+        """
+        with self._lock:
+            elapsed_seconds = time.monotonic() - self._started_at if self._started_at is not None else 0.0
+            workers = {str(worker_id): _worker_stats(worker, elapsed_seconds)
+                       for worker_id, worker in sorted(self._workers.items())}
+            totals = _new_worker()
+            for worker in self._workers.values():
+                for name, value in worker.items():
+                    if name == 'latency_histogram':
+                        totals[name] = [total + count for total, count in zip(totals[name], value)]
+                    else:
+                        totals[name] += value
+
+            stats = _worker_stats(totals, elapsed_seconds)
+            stats.update({
+                'execution_id': self._execution_id,
+                'elapsed_seconds': elapsed_seconds,
+                'store_calls': {operation: dict(calls) for operation, calls in self._store_calls.items()},
+                'concurrency': self._concurrency_history[-1][1] if self._concurrency_history else None,
+                'concurrency_history': [list(change) for change in self._concurrency_history],
+                'workers': workers,
+            })
+            return stats
+
+    def _worker(self, worker_id):
+        worker = self._workers.get(worker_id)
+        if worker is None:
+            worker = self._workers[worker_id] = _new_worker()
+        return worker
+
+    def _dump_periodically(self):
+        while not self._stop_dumping.wait(self._dump_interval_seconds):
+            self._dump()
+
+    def _dump(self):
+        try:
+            with open(self._dump_path, 'a') as df:
+                df.write(json.dumps(self.stats()) + '\n')
+        except OSError as e:
+            _logger.error(f'Unable to dump metrics to {self._dump_path}. Failure message: {str(e)}')
+
+
+class _TimedStore:
+    """
+    Wraps a store, and reports how long each store_worker_state and store_task_exception call took to hooks. Other
+    calls are passed through to the store as they are.
+    """
+    def __init__(self, task_store, hooks):
+        self._task_store = task_store
+        self._hooks = hooks
+
+    def store_worker_state(self, execution_id, worker_id, task_execution_state):
+        started_at = time.monotonic()
+        self._task_store.store_worker_state(execution_id, worker_id, task_execution_state)
+        self._report(execution_id, 'store_worker_state', time.monotonic() - started_at)
+
+    def store_task_exception(self, execution_id, exception):
+        started_at = time.monotonic()
+        self._task_store.store_task_exception(execution_id, exception)
+        self._report(execution_id, 'store_task_exception', time.monotonic() - started_at)
+
+    def _report(self, execution_id, operation, seconds):
+        for hook in self._hooks:
+            hook.on_store(execution_id, operation, seconds)
+
+    def __getattr__(self, name):
+        return getattr(self._task_store, name)
+
+
+def _new_worker():
+    return {
+        'tasks_completed': 0,
+        'tasks_failed': 0,
+        'task_seconds': 0.0,
+        'idle_seconds': 0.0,
+        'flushes': 0,
+        'flush_seconds': 0.0,
+        'queue_depth': 0,
+        'latency_histogram': [0] * len(PyloMetrics.LATENCY_BUCKETS),
+    }
+
+
+def _worker_stats(worker, elapsed_seconds):
+    stats = {name: value for name, value in worker.items() if name != 'latency_histogram'}
+    stats['throughput_per_second'] = worker['tasks_completed'] / elapsed_seconds if elapsed_seconds else 0.0
+    stats['latency_histogram'] = {
+        f'<={bound}' if bound != float('inf') else f'>{PyloMetrics.LATENCY_BUCKETS[-2]}': count
+        for bound, count in zip(PyloMetrics.LATENCY_BUCKETS, worker['latency_histogram'])}
+    return stats
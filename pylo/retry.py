@@ -0,0 +1,38 @@
+# coding=utf-8
+import random
+
+
+class PyloRetryPolicy:
+    """
+    Decides when inputs which failed are retried: after a delay which doubles with every failed attempt of the input
+    (exponential backoff), shortened by a random share (jitter) so that inputs which failed together are not all
+    retried at once. Inputs which failed max_attempts times are not retried, and stay unfinished.
+    """
+
+    def __init__(self, delay_seconds=1.0, max_delay_seconds=60.0, backoff_multiplier=2.0, jitter=0.5,
+                 max_attempts=None):
+        """
+        :param delay_seconds:  the delay after the first failed attempt
+        :param max_delay_seconds:  the longest delay, however many attempts failed
+        :param backoff_multiplier:  what the delay is multiplied by after each failed attempt
+        :param jitter:  the largest share of the delay which is randomly cut from it, between 0 and 1
+        :param max_attempts:  if set, the number of attempts after which an input is no longer retried
+        """
+        if not 0 <= jitter <= 1:
+            raise ValueError(f'Expected jitter between 0 and 1, got {jitter}')
+
+        self.delay_seconds = delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.backoff_multiplier = backoff_multiplier
+        self.jitter = jitter
+        self.max_attempts = max_attempts
+
+    def should_retry(self, failed_attempts):
+        return self.max_attempts is None or failed_attempts < self.max_attempts
+
+    def retry_delay_seconds(self, failed_attempts):
+        """
+        :return:  how long to wait before retrying an input which failed the given number of times
+        """
+        delay = min(self.max_delay_seconds, self.delay_seconds * self.backoff_multiplier ** (failed_attempts - 1))
+        return delay * (1 - self.jitter * random.random())
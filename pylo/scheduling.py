@@ -0,0 +1,91 @@
+# coding=utf-8
+import heapq
+import threading
+
+from pylo.metrics import PyloHooks
+from pylo.state import _input_key
+
+
+class PyloTaskCosts:
+    """
+    Estimates of how long the task takes for each input, which executions use to schedule their inputs: unfinished
+    inputs are split between workers longest first, each to the worker with the least work so far (longest processing
+    time first), so that all workers finish at about the same time, and every worker starts with its longest inputs.
+
+    The cost of an input is how long the task took for it in an earlier execution (see record_task_durations of
+    Pylo.local_multithread), or else what cost_hint returns for it, in seconds. Inputs with neither cost as much as
+    the average recorded duration.
+    """
+    def __init__(self, recorded_durations=None, cost_hint=None):
+        """
+        :param recorded_durations:  a dict which maps keys of inputs to how long the task took for them, as returned by
+                                    load_task_durations of stores
+        :param cost_hint:  if set, a function which returns an estimate of how long the task takes for an input
+        """
+        self._recorded_durations = recorded_durations or {}
+        self._cost_hint = cost_hint
+        self._default_cost = sum(self._recorded_durations.values()) / len(self._recorded_durations) \
+            if self._recorded_durations else 1.0
+
+    def cost_of(self, task_input):
+        duration = self._recorded_durations.get(_input_key(task_input))
+        if duration is not None:
+            return duration
+        if self._cost_hint is not None:
+            return self._cost_hint(task_input)
+        return self._default_cost
+
+    def pack(self, task_inputs, into_number):
+        """
+        Splits the given inputs into up to into_number lists with about the same total cost.
+        :return:  a list of non-empty lists of inputs, each sorted the most costly first
+        """
+        sorted_inputs = self._sorted_with_costs(task_inputs)
+        chunks = [[] for _ in range(min(into_number, len(sorted_inputs)))]
+        # (total cost so far, chunk index), so that ties go to the first chunk
+        loads = [(0.0, index) for index in range(len(chunks))]
+        for task_input, cost in sorted_inputs:
+            load, index = heapq.heappop(loads)
+            chunks[index].append(task_input)
+            heapq.heappush(loads, (load + cost, index))
+        return chunks
+
+    def _sorted_with_costs(self, task_inputs):
+        # sorted is stable, so inputs which cost the same keep their order
+        return sorted(((task_input, self.cost_of(task_input)) for task_input in task_inputs),
+                      key=lambda input_and_cost: -input_and_cost[1])
+
+
+class _DurationRecorder(PyloHooks):
+    """
+    Hooks which collect how long the task took for each input, and store them with the store of the execution whenever
+    a worker flushes its state, and once the execution ends.
+    """
+    def __init__(self, task_store, execution_id):
+        self._task_store = task_store
+        self._execution_id = execution_id
+        self._lock = threading.Lock()
+        self._store_lock = threading.Lock()
+        # input key -> seconds
+        self._durations = {}
+
+    def on_task_end(self, execution_id, worker_id, task_inputs, exceptions, seconds):
+        # batches are timed as a whole, so each of their inputs counts for an equal part. Failed attempts count too,
+        # since inputs which are left unfinished are the ones resumed executions schedule
+        seconds_per_input = seconds / len(task_inputs)
+        with self._lock:
+            for task_input in task_inputs:
+                self._durations[_input_key(task_input)] = seconds_per_input
+
+    def on_flush(self, execution_id, worker_id, seconds):
+        self._store()
+
+    def on_execution_end(self, execution_id):
+        self._store()
+
+    def _store(self):
+        with self._store_lock:
+            with self._lock:
+                durations, self._durations = self._durations, {}
+            if durations:
+                self._task_store.store_task_durations(self._execution_id, durations)
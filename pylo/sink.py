@@ -0,0 +1,173 @@
+# coding=utf-8
+import logging
+import pickle
+import threading
+import traceback
+from collections import Counter
+
+_logger = logging.getLogger(__name__)
+
+
+class PyloExceptionSink:
+    """
+    Buffers task exceptions of an execution in memory, and persists them in batches from a background thread, so that
+    workers never wait for exceptions to be written.
+
+    The buffer is written once it holds max_buffered_exceptions, or every flush_interval_seconds, whichever comes
+    first. Exceptions which failed to be written are put back in the buffer, and retried every flush_interval_seconds.
+    Exceptions which were buffered but not written yet are lost if the process is killed, or if they fail to be written
+    twice while the sink closes.
+    """
+
+    def __init__(self, write_exceptions, max_buffered_exceptions=1000, flush_interval_seconds=1.0,
+                 deduplicate=False, max_stored_exceptions=None, stored_exceptions=0):
+        """
+        :param write_exceptions:  a function which persists a batch of exceptions, it is called with a list of pairs of
+                                  an index and an exception to store, and a dict which maps indexes of already stored
+                                  exceptions to the number of times they were repeated since
+        :param max_buffered_exceptions:  the number of buffered exceptions which triggers a write
+        :param flush_interval_seconds:  the maximum time an exception stays buffered
+        :param deduplicate:  if set to true, exceptions with the same type, message and traceback as an already stored
+                             exception are only counted, instead of being stored again
+        :param max_stored_exceptions:  if set, exceptions are dropped once this many were stored
+        :param stored_exceptions:  the number of exceptions which were already stored
+        """
+        self._write_exceptions = write_exceptions
+        self._max_buffered_exceptions = max_buffered_exceptions
+        self._flush_interval_seconds = flush_interval_seconds
+        self._deduplicate = deduplicate
+        self._max_stored_exceptions = max_stored_exceptions
+        self._stored_exceptions = stored_exceptions
+        self._dropped_exceptions = 0
+
+        self._buffered_exceptions = []
+        self._repeated_exceptions = Counter()
+        # deduplication key -> index of the stored exception
+        self._exception_indexes = {}
+
+        self._condition = threading.Condition()
+        self._requested_flushes = 0
+        self._completed_flushes = 0
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_in_background, name='pylo-exception-sink', daemon=True)
+        self._writer.start()
+
+    def add(self, exception):
+        key = _deduplication_key(exception) if self._deduplicate else None
+        with self._condition:
+            if key is not None and key in self._exception_indexes:
+                self._repeated_exceptions[self._exception_indexes[key]] += 1
+                return
+
+            if self._max_stored_exceptions is not None and self._stored_exceptions >= self._max_stored_exceptions:
+                if self._dropped_exceptions == 0:
+                    _logger.warning(f'Stored {self._max_stored_exceptions} exceptions already, further exceptions '
+                                    f'will be dropped')
+                self._dropped_exceptions += 1
+                return
+
+            if key is not None:
+                self._exception_indexes[key] = self._stored_exceptions
+            self._buffered_exceptions.append((self._stored_exceptions, exception))
+            self._stored_exceptions += 1
+
+            if len(self._buffered_exceptions) >= self._max_buffered_exceptions:
+                self._condition.notify_all()
+
+    @property
+    def dropped_exceptions(self):
+        return self._dropped_exceptions
+
+    def flush(self):
+        """
+        Blocks until all exceptions added so far are written.
+        """
+        with self._condition:
+            self._requested_flushes += 1
+            requested_flush = self._requested_flushes
+            self._condition.notify_all()
+            self._condition.wait_for(lambda: self._completed_flushes >= requested_flush or not self._writer.is_alive())
+
+    def close(self):
+        """
+        Writes all buffered exceptions, and stops the background thread. If they fail to be written, they are retried
+        once.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._writer.join()
+
+    def _write_in_background(self):
+        write_failed = False
+        retried_on_close = False
+        while True:
+            with self._condition:
+                # after a failed write, a full buffer waits for the interval, so that writes are not retried in a loop
+                self._condition.wait_for(
+                    lambda: self._closed or self._requested_flushes > self._completed_flushes or
+                    (not write_failed and len(self._buffered_exceptions) >= self._max_buffered_exceptions),
+                    timeout=self._flush_interval_seconds)
+
+                requested_flushes = self._requested_flushes
+                closed = self._closed
+                exceptions, self._buffered_exceptions = self._buffered_exceptions, []
+                repeated_exceptions, self._repeated_exceptions = self._repeated_exceptions, Counter()
+
+            write_failed = False
+            if exceptions or repeated_exceptions:
+                try:
+                    self._write_exceptions(exceptions, dict(repeated_exceptions))
+                except Exception as e:
+                    _logger.error(f'Failed to store {len(exceptions)} exceptions, they will be retried. '
+                                  f'Failure message: {str(e)}')
+                    write_failed = True
+
+            with self._condition:
+                if write_failed:
+                    # indexes of exceptions are their positions in the store, so they have to be written in order
+                    self._buffered_exceptions[:0] = exceptions
+                    self._repeated_exceptions.update(repeated_exceptions)
+                self._completed_flushes = requested_flushes
+                self._condition.notify_all()
+
+            if closed:
+                if not write_failed or retried_on_close:
+                    if write_failed:
+                        _logger.error(f'Failed to store {len(self._buffered_exceptions)} exceptions before closing')
+                    return
+                retried_on_close = True
+
+
+class RepeatedException:
+    """
+    Persisted in place of an exception which repeats an already stored exception.
+    """
+    def __init__(self, index, count):
+        self.index = index
+        self.count = count
+
+
+def count_repeated_exceptions(records):
+    """
+    Turns stored exceptions and RepeatedException records into a list of pairs of an exception and its count.
+    """
+    exception_counts = []
+    for record in records:
+        if isinstance(record, RepeatedException):
+            exception_counts[record.index][1] += record.count
+        else:
+            exception_counts.append([record, 1])
+    return [(exception, count) for exception, count in exception_counts]
+
+
+def picklable_exception(exception):
+    try:
+        pickle.dumps(exception)
+        return exception
+    except Exception:
+        return Exception(f'{type(exception).__name__}: {exception}')
+
+
+def _deduplication_key(exception):
+    return ''.join(traceback.format_exception(type(exception), exception, exception.__traceback__))
@@ -1,35 +1,279 @@
 # coding=utf-8
+import contextlib
+import copy
+import itertools
+import logging
 import math
+import mmap
 import os
 import pickle
+import sqlite3
+import threading
+import time
 from abc import ABC, abstractmethod
-from functools import reduce
+from collections import Counter, defaultdict, deque
+
+from pylo.codec import PickleCodec, get_codec, register_codec
+from pylo.sink import PyloExceptionSink, RepeatedException, count_repeated_exceptions, picklable_exception
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+_logger = logging.getLogger(__name__)
+
+FINISHED = 'finished'
+FAILED = 'failed'
+# when stores force written state to disk: never (left to the OS), for every snapshot of the whole state, or always
+# (also for every journal append)
+FSYNC_NEVER = 'never'
+FSYNC_SNAPSHOTS = 'snapshots'
+FSYNC_ALWAYS = 'always'
+_GIVEN_AWAY = 'given_away'
+_ASSIGNED = 'assigned'
 
 
 class PyloExecutionState:
-    def __init__(self, execution_id, finished_inputs, unfinished_inputs):
+    """
+    Finished and unfinished inputs of an execution, or of one of its workers.
+
+    When inputs are streamed, finished inputs are not kept. Instead, the state keeps the offset of the streamed inputs
+    read so far, and every input before the offset which is not unfinished counts as finished.
+
+    The state also counts how many times the task failed for each unfinished input (see failed_attempts_of), so that
+    executors can back off, or stop retrying an input, across restarts.
+
+    If task_costs (a PyloTaskCosts) is set, split_unfinished splits unfinished inputs by their estimated cost, instead
+    of in the order they are in. Like the input stream, it is not stored.
+    """
+    def __init__(self, execution_id, finished_inputs, unfinished_inputs, stream_offset=None, input_stream=None,
+                 failed_attempts=None):
         self.execution_id = execution_id
         self.finished_inputs = finished_inputs
-        self.unfinished_inputs = unfinished_inputs
+        self.unfinished_inputs = deque(unfinished_inputs)
+        self.stream_offset = stream_offset
+        self.input_stream = input_stream
+        # input key (see _input_key) -> the number of times the task failed for the input
+        self.failed_attempts = dict(failed_attempts or {})
+        self.task_costs = None
+        self._journal = []
+
+    @property
+    def is_streamed(self):
+        return self.stream_offset is not None
+
+    def next_unfinished(self):
+        return self.unfinished_inputs.popleft()
+
+    def mark_finished(self, task_input):
+        if not self.is_streamed:
+            self.finished_inputs.append(task_input)
+        if self.failed_attempts:
+            self.failed_attempts.pop(_input_key(task_input), None)
+        self._journal.append((FINISHED, task_input))
+
+    def mark_failed(self, task_input, requeue=True):
+        """
+        :param requeue:  if set to false, the input is not appended to unfinished inputs, so that it is not retried
+                         until it is passed to requeue_failed. Stores still record it as unfinished, but until then it
+                         has to be passed to snapshot as in-flight
+        """
+        key = _input_key(task_input)
+        self.failed_attempts[key] = self.failed_attempts.get(key, 0) + 1
+        if requeue:
+            self.requeue_failed(task_input)
+        self._journal.append((FAILED, task_input))
+
+    def requeue_failed(self, task_input):
+        """
+        Appends an input which failed without being requeued to unfinished inputs. Stores already record it as
+        unfinished, so it is not journaled.
+        """
+        self.unfinished_inputs.append(task_input)
+
+    def failed_attempts_of(self, task_input):
+        """
+        :return:  the number of times the task failed for the given input
+        """
+        return self.failed_attempts.get(_input_key(task_input), 0)
+
+    def failed_attempts_of_inputs(self, task_inputs):
+        """
+        :return:  a dict of failed attempts of the given inputs, which can be passed to assign_unfinished of another
+                  state. They are left in this state too, since stores may only learn that the inputs moved from the
+                  journal
+        """
+        if not self.failed_attempts:
+            return {}
+        keys = (_input_key(task_input) for task_input in task_inputs)
+        return {key: self.failed_attempts[key] for key in keys if key in self.failed_attempts}
+
+    def give_away_unfinished(self, number_of_inputs):
+        """
+        Removes up to the given number of inputs from the end of unfinished inputs, so that another worker can take
+        them over.
+        """
+        given_away = [self.unfinished_inputs.pop() for _ in range(min(number_of_inputs, len(self.unfinished_inputs)))]
+        given_away.reverse()
+        self._journal.extend((_GIVEN_AWAY, task_input) for task_input in given_away)
+        return given_away
+
+    def assign_unfinished(self, task_inputs, failed_attempts=None):
+        """
+        :param failed_attempts:  failed attempts of the inputs (e.g. in the state of the worker they were taken from),
+                                 as returned by failed_attempts_of_inputs
+        """
+        self.unfinished_inputs.extend(task_inputs)
+        self.failed_attempts.update(failed_attempts or {})
+        self._journal.extend((_ASSIGNED, task_input) for task_input in task_inputs)
+
+    def claim_from_stream(self, number_of_inputs):
+        """
+        Reads up to the given number of inputs from the input stream, and adds them to unfinished inputs.
+        :return:  true if any inputs were read, false if the stream is exhausted (or if there is no stream)
+        """
+        if self.input_stream is None:
+            return False
+
+        offset, task_inputs = self.input_stream.take(number_of_inputs)
+        if not task_inputs:
+            return False
+
+        self.assign_unfinished(task_inputs)
+        self.stream_offset = offset + len(task_inputs)
+        return True
+
+    def snapshot(self, in_flight_inputs=()):
+        """
+        Returns a copy of this state which can be stored while this state keeps changing. The journal moves to the copy.
+        :param in_flight_inputs:  inputs which were taken from unfinished inputs, but have not finished or failed yet,
+                                  they are kept as unfinished in the copy
+        """
+        snapshot = PyloExecutionState(
+            self.execution_id,
+            list(self.finished_inputs),
+            list(in_flight_inputs) + list(self.unfinished_inputs),
+            stream_offset=self.stream_offset,
+            failed_attempts=self.failed_attempts)
+        snapshot._journal = self.take_journal()
+        return snapshot
+
+    def prepend_journal(self, journal):
+        """
+        Puts journal entries (as returned by take_journal) in front of the journal of this state, e.g. the journal of an
+        older snapshot of the same state which is not going to be stored.
+        """
+        self._journal[:0] = journal
+
+    def has_changes(self):
+        """
+        :return:  true if any inputs changed since the journal was last taken
+        """
+        return bool(self._journal)
+
+    def take_journal(self):
+        """
+        Returns the changes of inputs (finished, failed, given away or assigned) since the last call, and starts a new
+        journal.
+        """
+        journal, self._journal = self._journal, []
+        return journal
+
+    def replay_journal(self, journal):
+        """
+        Applies journal entries (as returned by take_journal) on top of this state. Failed and assigned inputs are
+        appended to unfinished inputs, the same way workers do it, so that the replayed state matches the journaled one.
+        """
+        timeline = list(self.unfinished_inputs)
+        alive = [True] * len(timeline)
+        positions = defaultdict(deque)
+        for position, task_input in enumerate(timeline):
+            positions[_input_key(task_input)].append(position)
+
+        for status, task_input in journal:
+            key = _input_key(task_input)
+            key_positions = positions[key]
+            if status != _ASSIGNED and key_positions:
+                alive[key_positions.popleft()] = False
+
+            if status == FINISHED:
+                if not self.is_streamed:
+                    self.finished_inputs.append(task_input)
+                self.failed_attempts.pop(key, None)
+            elif status != _GIVEN_AWAY:
+                if status == FAILED:
+                    self.failed_attempts[key] = self.failed_attempts.get(key, 0) + 1
+                key_positions.append(len(timeline))
+                timeline.append(task_input)
+                alive.append(True)
+
+        self.unfinished_inputs = deque(task_input for task_input, is_alive in zip(timeline, alive) if is_alive)
 
     def join(self, other_state):
-        if other_state.execution_id != self.execution_id:
-            raise Exception(f'Unable to join two execution states with different '
-                            f'ids: {other_state.execution_id} and {self.execution_id}')
+        return PyloExecutionState.merge(self.execution_id, [self, other_state])
+
+    @staticmethod
+    def merge(execution_id, states):
+        """
+        Joins any number of states of the same execution, in time linear in their total size.
+        """
+        states = list(states)
+        if any(isinstance(state, PyloBitmapExecutionState) for state in states):
+            return PyloBitmapExecutionState.merge(execution_id, states)
 
+        finished_inputs, unfinished_inputs, stream_offsets = [], [], []
+        failed_attempts = _merge_failed_attempts(states)
+        for state in states:
+            if state.execution_id != execution_id:
+                raise Exception(f'Unable to join two execution states with different '
+                                f'ids: {state.execution_id} and {execution_id}')
+
+            finished_inputs.extend(state.finished_inputs)
+            unfinished_inputs.extend(state.unfinished_inputs)
+            if state.is_streamed:
+                stream_offsets.append(state.stream_offset)
+
+        if failed_attempts:
+            # restricted to unfinished inputs, since workers keep failed attempts of inputs they gave away
+            unfinished_keys = {_input_key(task_input) for task_input in unfinished_inputs}
+            failed_attempts = {key: attempts for key, attempts in failed_attempts.items() if key in unfinished_keys}
         return PyloExecutionState(
-            execution_id=self.execution_id,
-            finished_inputs=self.finished_inputs + other_state.finished_inputs,
-            unfinished_inputs=self.unfinished_inputs + other_state.unfinished_inputs)
+            execution_id, finished_inputs, unfinished_inputs, max(stream_offsets, default=None), None, failed_attempts)
 
     def with_execution_id(self, new_execution_id):
-        return PyloExecutionState(new_execution_id, self.finished_inputs, self.unfinished_inputs)
+        return PyloExecutionState(
+            new_execution_id, self.finished_inputs, self.unfinished_inputs, self.stream_offset, self.input_stream,
+            self.failed_attempts)
+
+    def with_streamed_inputs(self, task_inputs):
+        """
+        Returns this state with finished inputs listed, given the same inputs which were streamed to the execution.
+        Inputs after the stream offset have not been read by the execution, so they are neither finished nor unfinished.
+        """
+        if not self.is_streamed:
+            return self
+
+        finished_inputs = list(self.finished_inputs)
+        finished_inputs.extend(iter_streamed_finished_inputs(task_inputs, self.stream_offset, self.unfinished_inputs))
+        return PyloExecutionState(self.execution_id, finished_inputs, self.unfinished_inputs)
 
     def split_unfinished(self, into_number):
-        finished_state = PyloExecutionState(self.execution_id, self.finished_inputs, [])
+        finished_state = PyloExecutionState(self.execution_id, self.finished_inputs, [], self.stream_offset)
+        if self.task_costs is not None:
+            unfinished_chunks = self.task_costs.pack(self.unfinished_inputs, into_number)
+        else:
+            unfinished_chunks = _split_list_into_chunks(self.unfinished_inputs, into_number)
+        if self.input_stream is not None:
+            # every worker reads from the stream once it runs out of inputs, so we need all of them
+            unfinished_chunks += [[] for _ in range(into_number - len(unfinished_chunks))]
+
         unfinished_states = \
-            [PyloExecutionState(self.execution_id, [], unfinished_chunk)
-             for unfinished_chunk in _split_list_into_chunks(self.unfinished_inputs, into_number)]
+            [PyloExecutionState(self.execution_id, [], unfinished_chunk, self.stream_offset, self.input_stream,
+                                self.failed_attempts_of_inputs(unfinished_chunk))
+             for unfinished_chunk in unfinished_chunks]
 
         return finished_state, unfinished_states
 
@@ -37,12 +281,462 @@ class PyloExecutionState:
         if isinstance(other, PyloExecutionState):
             return self.execution_id == other.execution_id \
                    and self.finished_inputs == other.finished_inputs \
-                   and self.unfinished_inputs == other.unfinished_inputs
+                   and list(self.unfinished_inputs) == list(other.unfinished_inputs) \
+                   and self.stream_offset == other.stream_offset
 
         return NotImplemented
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_journal']
+        del state['input_stream']
+        state.pop('task_costs', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.unfinished_inputs = deque(self.unfinished_inputs)
+        self.__dict__.setdefault('stream_offset', None)
+        self.__dict__.setdefault('failed_attempts', {})
+        self.input_stream = None
+        self.task_costs = None
+        self._journal = []
+
+
+class PyloBitmapExecutionState(PyloExecutionState):
+    """
+    State of an execution over a dense range of integer inputs (e.g. range(1, 10000)), which tracks finished inputs as
+    bits of a bitmap rather than in lists, so it takes a bit per input. Every input of the range which is not finished
+    is unfinished.
+
+    States of all workers of an execution share the bitmap, and each of them goes over its own part of the range (parts
+    start at byte boundaries). Inputs which failed, now or before the execution was resumed, or which were stolen from
+    another worker, are queued after the part.
+    Finished inputs of a state are the finished inputs of its part.
+    finished_inputs and unfinished_inputs are read-only views, which compute their length without listing inputs.
+
+    The file system store memory-maps the bitmap, so a snapshot only flushes it. Other stores store inputs as lists.
+    """
+    def __init__(self, execution_id, bitmap, first_input=None, stop_input=None):
+        """
+        :param bitmap:  the bitmap shared by all states of the execution
+        :param first_input:  the first input of the part of the range of this state, the start of the range by default
+        :param stop_input:  the input after the last one in the part of this state, the stop of the range by default
+        """
+        self.execution_id = execution_id
+        self.bitmap = bitmap
+        self.stream_offset = None
+        self.input_stream = None
+        # the part of the range of this state, its finished inputs are the finished inputs of the part
+        self._part = (bitmap.start if first_input is None else first_input,
+                      bitmap.stop if stop_input is None else stop_input)
+        self._next_input, self._stop_input = self._part
+        # the number of unfinished inputs in the part, from the next input on
+        self._pending_inputs = (self._stop_input - self._next_input) - bitmap.count(self._next_input, self._stop_input)
+        self._queued_inputs = deque()
+        self.failed_attempts = {}
+        self._journal = []
+
+    @classmethod
+    def from_range(cls, execution_id, task_inputs):
+        if not isinstance(task_inputs, range) or task_inputs.step != 1:
+            raise ValueError(f'Bitmap states need a range of inputs with step 1, got {task_inputs!r}')
+        return cls(execution_id, _Bitmap(task_inputs.start, task_inputs.stop))
+
+    @property
+    def finished_inputs(self):
+        return _BitmapInputs(self, finished=True)
+
+    @property
+    def unfinished_inputs(self):
+        return _BitmapInputs(self, finished=False)
+
+    def next_unfinished(self):
+        while self._pending_inputs > 0:
+            while self.bitmap.is_set(self._next_input):
+                self._next_input += 1
+            self._next_input += 1
+            self._pending_inputs -= 1
+            task_input = self._next_input - 1
+            # inputs which failed before, e.g. in an execution which is resumed, are queued after the part, the same
+            # way inputs which fail now are, so that they do not use up the failures a worker is allowed first
+            if task_input not in self.failed_attempts:
+                return task_input
+            self._queued_inputs.append(task_input)
+
+        return self._queued_inputs.popleft()
+
+    def mark_finished(self, task_input):
+        self.bitmap.set(task_input)
+        if self.failed_attempts:
+            self.failed_attempts.pop(task_input, None)
+        self._journal.append((FINISHED, task_input))
+
+    def requeue_failed(self, task_input):
+        self._queued_inputs.append(task_input)
+
+    def give_away_unfinished(self, number_of_inputs):
+        given_away = []
+        while len(given_away) < number_of_inputs and self._queued_inputs:
+            given_away.append(self._queued_inputs.pop())
+        while len(given_away) < number_of_inputs and self._pending_inputs > 0:
+            # the part shrinks from its end
+            self._stop_input -= 1
+            if not self.bitmap.is_set(self._stop_input):
+                given_away.append(self._stop_input)
+                self._pending_inputs -= 1
+
+        given_away.reverse()
+        self._journal.extend((_GIVEN_AWAY, task_input) for task_input in given_away)
+        return given_away
+
+    def assign_unfinished(self, task_inputs, failed_attempts=None):
+        for task_input in task_inputs:
+            if not self.bitmap.start <= task_input < self.bitmap.stop:
+                raise ValueError(f'Input {task_input!r} is out of the range of the bitmap state')
+        self._queued_inputs.extend(task_inputs)
+        self.failed_attempts.update(failed_attempts or {})
+        self._journal.extend((_ASSIGNED, task_input) for task_input in task_inputs)
+
+    def claim_from_stream(self, number_of_inputs):
+        return False
+
+    def snapshot(self, in_flight_inputs=()):
+        snapshot = copy.copy(self)
+        snapshot._queued_inputs = deque(itertools.chain(in_flight_inputs, self._queued_inputs))
+        snapshot.failed_attempts = dict(self.failed_attempts)
+        snapshot._journal = self.take_journal()
+        return snapshot
+
+    def replay_journal(self, journal):
+        """
+        Applies journal entries on top of this state. Finished inputs are set in the bitmap, inputs which were given
+        away leave the state, and assigned inputs are queued after the part. Failed inputs stay unfinished, but inputs
+        of the part may end up in a different order than in the journaled state.
+        """
+        for status, task_input in journal:
+            key = _input_key(task_input)
+            if status == _ASSIGNED:
+                self._queued_inputs.append(task_input)
+                continue
+
+            queued = task_input in self._queued_inputs
+            if status == FAILED:
+                self.failed_attempts[key] = self.failed_attempts.get(key, 0) + 1
+            elif status == FINISHED:
+                self.failed_attempts.pop(key, None)
+                if queued:
+                    self._queued_inputs.remove(task_input)
+                elif self._next_input <= task_input < self._stop_input and not self.bitmap.is_set(task_input):
+                    self._pending_inputs -= 1
+                self.bitmap.set(task_input)
+            elif queued:
+                self._queued_inputs.remove(task_input)
+            elif self._next_input <= task_input < self._stop_input:
+                # inputs are given away from the end of the part, so the part ends before the first of them
+                given_away = (self._stop_input - task_input) - self.bitmap.count(task_input, self._stop_input)
+                self._pending_inputs -= given_away
+                self._stop_input = task_input
+
+    @staticmethod
+    def merge(execution_id, states):
+        bitmaps = []
+        for state in states:
+            if state.execution_id != execution_id:
+                raise Exception(f'Unable to join two execution states with different '
+                                f'ids: {state.execution_id} and {execution_id}')
+            if not isinstance(state, PyloBitmapExecutionState):
+                raise ValueError('Bitmap states can only be joined with other bitmap states')
+            if all(bitmap is not state.bitmap for bitmap in bitmaps):
+                bitmaps.append(state.bitmap)
+
+        # states of workers of the same execution share their bitmap, so there is usually nothing to merge
+        merged_bitmap = bitmaps[0]
+        for bitmap in bitmaps[1:]:
+            merged_bitmap = merged_bitmap.union(bitmap)
+        merged = PyloBitmapExecutionState(execution_id, merged_bitmap)
+        merged.failed_attempts = {task_input: attempts
+                                  for task_input, attempts in _merge_failed_attempts(states).items()
+                                  if not merged_bitmap.is_set(task_input)}
+        return merged
+
+    def with_execution_id(self, new_execution_id):
+        state = PyloBitmapExecutionState(new_execution_id, self.bitmap.copy())
+        state.failed_attempts = dict(self.failed_attempts)
+        return state
+
+    def split_unfinished(self, into_number):
+        finished_state = PyloBitmapExecutionState(self.execution_id, self.bitmap, self.bitmap.stop, self.bitmap.stop)
+
+        # parts start at byte boundaries of the bitmap, so that workers rarely set bits of the same byte
+        part_size = math.ceil((self.bitmap.stop - self.bitmap.start) / into_number / 8) * 8
+        unfinished_states = []
+        for first_input in range(self.bitmap.start, self.bitmap.stop, max(part_size, 8)):
+            state = PyloBitmapExecutionState(
+                self.execution_id, self.bitmap, first_input, min(first_input + part_size, self.bitmap.stop))
+            state.failed_attempts = {task_input: attempts for task_input, attempts in self.failed_attempts.items()
+                                     if first_input <= task_input < state._stop_input}
+            if state._pending_inputs > 0:
+                unfinished_states.append(state)
+
+        return finished_state, unfinished_states
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_journal']
+        del state['input_stream']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.input_stream = None
+        self._journal = []
+
+
+def _merge_failed_attempts(states):
+    # an input can be in failed attempts of more than one worker, if it was stolen after it failed. The worker it was
+    # stolen from still has the older count
+    failed_attempts = {}
+    for state in states:
+        for key, attempts in state.failed_attempts.items():
+            failed_attempts[key] = max(attempts, failed_attempts.get(key, 0))
+    return failed_attempts
+
+
+def _apply_worker_journal(worker_state, journal, failed_attempts=None):
+    """
+    Applies the journal of a worker state (inputs which finished, failed, moved between workers, or were claimed from
+    the stream) to another copy of it, which holds in-flight inputs of the worker as unfinished, e.g. in the parent of
+    a worker process. Unlike replay_journal, it takes time proportional to the length of the journal, as long as the
+    worker takes inputs in order. The copy journals the changes too, for stores to persist.
+    :param failed_attempts:  failed attempts of inputs assigned in the journal, as returned by failed_attempts_of_inputs
+    """
+    if isinstance(worker_state, PyloBitmapExecutionState):
+        # bitmap states find inputs by their position in the part, rather than in a list of unfinished inputs
+        worker_state.replay_journal(journal)
+        worker_state.failed_attempts.update(failed_attempts or {})
+        worker_state.prepend_journal(journal)
+        return
+
+    unfinished_inputs = worker_state.unfinished_inputs
+    index = 0
+    while index < len(journal):
+        status, task_input = journal[index]
+        if status == _ASSIGNED:
+            key = _input_key(task_input)
+            worker_state.assign_unfinished(
+                [task_input], {key: failed_attempts[key]} if failed_attempts and key in failed_attempts else None)
+        elif status == _GIVEN_AWAY:
+            # inputs are given away together, from the end of unfinished inputs
+            stop = index
+            while stop < len(journal) and journal[stop][0] == _GIVEN_AWAY:
+                stop += 1
+            given_away = [given_away_input for _, given_away_input in journal[index:stop]]
+            if list(itertools.islice(reversed(unfinished_inputs), len(given_away)))[::-1] != given_away:
+                for given_away_input in given_away:
+                    unfinished_inputs.remove(given_away_input)
+                unfinished_inputs.extend(given_away)
+            worker_state.give_away_unfinished(len(given_away))
+            index = stop
+            continue
+        else:
+            # workers take inputs in order, so reported inputs are almost always among the first unfinished ones
+            if unfinished_inputs and unfinished_inputs[0] == task_input:
+                worker_state.next_unfinished()
+            else:
+                unfinished_inputs.remove(task_input)
+
+            if status == FINISHED:
+                worker_state.mark_finished(task_input)
+            else:
+                worker_state.mark_failed(task_input)
+        index += 1
+
+
+class _BitmapInputs:
+    """
+    A read-only view of finished or unfinished inputs of a bitmap state.
+    """
+    def __init__(self, state, finished):
+        self._state = state
+        self._finished = finished
+
+    def __len__(self):
+        state = self._state
+        if self._finished:
+            return state.bitmap.count(*state._part)
+        return state._pending_inputs + len(state._queued_inputs)
+
+    def __iter__(self):
+        state = self._state
+        if self._finished:
+            return state.bitmap.iter_inputs(*state._part, finished=True)
+        # in the order of next_unfinished
+        return itertools.chain(
+            state.bitmap.iter_inputs(state._next_input, state._stop_input, finished=False), list(state._queued_inputs))
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class _Bitmap:
+    """
+    Bits of a range of integer inputs, set for finished inputs. It is backed by a bytearray, or once it is mapped to
+    a file, by a memory-mapped file.
+    """
+    def __init__(self, start, stop, data=None):
+        self.start = start
+        self.stop = stop
+        self.data = bytearray(math.ceil((stop - start) / 8)) if data is None else data
+        self.file_path = None
+        self._lock = threading.Lock()
+
+    def is_set(self, task_input):
+        position = task_input - self.start
+        return bool(self.data[position >> 3] & (1 << (position & 7)))
+
+    def set(self, task_input):
+        position = task_input - self.start
+        # workers which steal inputs can set bits in bytes of other workers, so setting a bit has to be atomic
+        with self._lock:
+            self.data[position >> 3] |= 1 << (position & 7)
+
+    def count(self, first_input, stop_input):
+        """
+        :return:  the number of set bits of inputs from first_input (inclusive) to stop_input (exclusive)
+        """
+        first, stop = first_input - self.start, stop_input - self.start
+        first_byte, stop_byte = math.ceil(first / 8), stop // 8
+        if first_byte >= stop_byte:
+            return sum(self.is_set(self.start + position) for position in range(first, stop))
+
+        edge_positions = itertools.chain(range(first, first_byte * 8), range(stop_byte * 8, stop))
+        return bin(int.from_bytes(self.data[first_byte:stop_byte], 'little')).count('1') + \
+            sum(self.is_set(self.start + position) for position in edge_positions)
+
+    def iter_inputs(self, first_input, stop_input, finished):
+        """
+        Iterates over inputs with set (if finished) or unset bits, from first_input to stop_input (exclusive).
+        """
+        skipped_byte, full_byte = (0, 0xff) if finished else (0xff, 0)
+        task_input = first_input
+        while task_input < stop_input:
+            position = task_input - self.start
+            if position & 7 == 0 and task_input + 8 <= stop_input:
+                byte = self.data[position >> 3]
+                if byte == skipped_byte:
+                    task_input += 8
+                    continue
+                if byte == full_byte:
+                    yield from range(task_input, task_input + 8)
+                    task_input += 8
+                    continue
+
+            if self.is_set(task_input) == finished:
+                yield task_input
+            task_input += 1
+
+    def union(self, other):
+        if (self.start, self.stop) != (other.start, other.stop):
+            raise ValueError(f'Unable to join bitmaps of different ranges: '
+                             f'{self.start}-{self.stop} and {other.start}-{other.stop}')
+        data = (int.from_bytes(self.data, 'little') | int.from_bytes(other.data, 'little')).to_bytes(
+            len(self.data), 'little')
+        return _Bitmap(self.start, self.stop, bytearray(data))
+
+    def copy(self):
+        with self._lock:
+            return _Bitmap(self.start, self.stop, bytearray(self.data))
+
+    def map_to_file(self, file_path, fsync):
+        """
+        Writes the bitmap to the given file, and from then on keeps it in the memory-mapped file.
+        """
+        with self._lock:
+            if self.file_path == file_path:
+                return
+
+            temp_file = file_path + _TEMP_SUFFIX
+            with open(temp_file, 'wb') as tf:
+                tf.write(self.data)
+                if fsync:
+                    tf.flush()
+                    os.fsync(tf.fileno())
+            os.replace(temp_file, file_path)
+
+            # empty files can not be memory-mapped, but then there are no bits to set either
+            if self.data:
+                with open(file_path, 'r+b') as bf:
+                    self.data = mmap.mmap(bf.fileno(), 0)
+            self.file_path = file_path
+
+    def flush(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.flush()
+
+    def __getstate__(self):
+        return {'start': self.start, 'stop': self.stop, 'data': bytearray(self.data), 'file_path': None}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+def iter_streamed_finished_inputs(task_inputs, stream_offset, unfinished_inputs):
+    """
+    Lazily lists finished inputs of a streamed execution, that is the inputs read by the execution which are not
+    unfinished, given the same inputs which were streamed to it.
+    """
+    unfinished_counts = Counter(_input_key(task_input) for task_input in unfinished_inputs)
+    for task_input in itertools.islice(task_inputs, stream_offset):
+        key = _input_key(task_input)
+        if unfinished_counts[key] > 0:
+            unfinished_counts[key] -= 1
+        else:
+            yield task_input
+
+
+class PyloInputStream:
+    """
+    Hands out inputs of an execution from an iterable (e.g. a generator over a file, or a database cursor) in batches,
+    without ever reading all of them into memory.
+    """
+    def __init__(self, task_inputs, offset=0):
+        """
+        :param task_inputs:  an iterable of inputs
+        :param offset:  the number of inputs to skip, i.e. the offset of an execution we resume
+        """
+        self._task_inputs_iterator = itertools.islice(iter(task_inputs), offset, None)
+        self.offset = offset
+        # workers hold the lock while they claim inputs and snapshot their state, so that snapshots with higher offsets
+        # are never persisted before snapshots with lower offsets
+        self.lock = threading.Lock()
+
+    def take(self, number_of_inputs):
+        """
+        :return:  a tuple with the offset of the first returned input, and a list of up to the given number of inputs
+        """
+        task_inputs = list(itertools.islice(self._task_inputs_iterator, number_of_inputs))
+        offset = self.offset
+        self.offset += len(task_inputs)
+        return offset, task_inputs
+
 
 class PyloExecutionStore(ABC):
+    # optional capabilities, which callers check before calling the methods they stand for.
+    # Stores which support parent references implement store_parent_execution and flatten_execution, which resume
+    # executions without copying their finished inputs (see PyloFileSystemExecutionStore)
+    supports_parent_references = False
+    # stores which support leases implement create_leases, acquire_lease, release_lease and load_leases, which nodes
+    # running an execution use to share its shards (see PyloDistributedExecutor and PyloFileSystemExecutionStore)
+    supports_leases = False
+    # stores which support task durations implement store_task_durations and load_task_durations, which executions use
+    # to schedule inputs by how long the task took for them before (see PyloTaskCosts and PyloFileSystemExecutionStore)
+    supports_task_durations = False
+
     @abstractmethod
     def load_whole_state(self, execution_id):
         pass
@@ -63,55 +757,1232 @@ class PyloExecutionStore(ABC):
     def store_task_exception(self, execution_id, exception):
         pass
 
+    def iter_inputs(self, execution_id, finished):
+        """
+        Iterates over finished or unfinished inputs of the given execution. Stores which can, override it to avoid
+        loading the whole state into memory at once.
+        """
+        state = self.load_whole_state(execution_id)
+        return iter(state.finished_inputs if finished else state.unfinished_inputs)
+
+    def load_inputs_page(self, execution_id, finished, offset, limit):
+        """
+        :return:  a list of up to limit finished or unfinished inputs, starting at the given offset (in the order in
+                  which iter_inputs returns them)
+        """
+        return list(itertools.islice(self.iter_inputs(execution_id, finished), offset, offset + limit))
+
+    def count_inputs(self, execution_id):
+        """
+        :return:  a tuple with the number of finished and unfinished inputs of the given execution
+        """
+        state = self.load_whole_state(execution_id)
+        if state.is_streamed:
+            return state.stream_offset - len(state.unfinished_inputs), len(state.unfinished_inputs)
+        return len(state.finished_inputs), len(state.unfinished_inputs)
+
+    def load_stream_offset(self, execution_id):
+        """
+        :return:  the number of inputs read so far by the given execution, or None if it does not stream its inputs
+        """
+        return self.load_whole_state(execution_id).stream_offset
+
+    def load_parent_execution(self, execution_id):
+        """
+        :return:  the id of the execution which the given execution resumes by reference, or None if there is none
+                  (always, for stores which do not support parent references)
+        """
+        return None
+
+    def load_failed_attempts(self, execution_id):
+        """
+        :return:  a dict which maps keys of unfinished inputs of the given execution to the number of times the task
+                  failed for them (see PyloExecutionState.failed_attempts)
+        """
+        return self.load_whole_state(execution_id).failed_attempts
+
+    def load_bitmap_state(self, execution_id):
+        """
+        :return:  the state of the given execution if it is a bitmap state which the store keeps as a bitmap (see
+                  PyloBitmapExecutionState), otherwise None
+        """
+        return None
+
+    def load_task_exception_counts(self, execution_id):
+        """
+        :return:  a list of pairs of an exception and the number of times it was thrown (more than one only if
+                  the store deduplicates exceptions)
+        """
+        return [(exception, 1) for exception in self.load_task_exceptions(execution_id)]
+
+    def _ancestor_executions(self, execution_id):
+        """
+        :return:  ids of executions which the given execution references, directly or not, starting from the oldest
+        """
+        ancestors = []
+        parent_execution_id = self.load_parent_execution(execution_id)
+        while parent_execution_id is not None:
+            ancestors.append(parent_execution_id)
+            parent_execution_id = self.load_parent_execution(parent_execution_id)
+        return ancestors[::-1]
+
+    def finish_execution(self, execution_id):
+        """
+        Called by executors once they finish running the given execution. Persists anything the store buffered for
+        the execution, and releases resources the store holds for it.
+        """
+        pass
+
+
+class _ExceptionSinks:
+    """
+    Exception sinks of executions which are running, created when the first exception of an execution is stored.
+    """
+    def __init__(self, create_sink):
+        self._create_sink = create_sink
+        self._sinks = {}
+        self._lock = threading.Lock()
+
+    def add(self, execution_id, exception):
+        with self._lock:
+            sink = self._sinks.get(str(execution_id))
+            if sink is None:
+                sink = self._sinks[str(execution_id)] = self._create_sink(execution_id)
+        sink.add(exception)
+
+    def flush(self, execution_id):
+        sink = self._sinks.get(str(execution_id))
+        if sink is not None:
+            sink.flush()
+
+    def close(self, execution_id):
+        with self._lock:
+            sink = self._sinks.pop(str(execution_id), None)
+        if sink is not None:
+            sink.close()
+
 
 class PyloFileSystemExecutionStore(PyloExecutionStore):
+    """
+    Persists execution state to a local directory, one file per worker.
+
+    When journaled, the first snapshot of a worker is written as a base file, and subsequent snapshots only append
+    inputs which finished or failed since the previous snapshot to the worker journal. Once the journal grows as large
+    as the base, it is folded into a new base, which keeps the total cost of snapshotting linear in the number of inputs.
 
-    def __init__(self, store_directory):
+    Whole states are written to a temporary file which then replaces the previous one, so a crash never leaves a
+    partially written state behind. fsync_policy (one of FSYNC_NEVER, FSYNC_SNAPSHOTS or FSYNC_ALWAYS) controls whether
+    writes are also forced to disk, which makes them survive power loss at the cost of latency.
+
+    Inputs are encoded with a codec (see pylo.codec), pickle by default. For integer or string inputs, compact codecs
+    like 'varint' or 'lines' make snapshots several times smaller and faster to load. Exceptions are always pickled,
+    but compressed if the codec compresses (e.g. 'varint+gzip').
+
+    Bitmap states (see PyloBitmapExecutionState) are kept in a single memory-mapped bitmap file per execution instead,
+    so storing them only flushes the bitmap, and only if fsync_policy asks for it.
+
+    Exceptions are buffered and appended to a single file per execution by a background thread, see PyloExceptionSink.
+    """
+
+    supports_parent_references = True
+    supports_leases = True
+    supports_task_durations = True
+
+    def __init__(self, store_directory, journaled=False, min_journal_entries_before_compaction=1000,
+                 deduplicate_exceptions=False, max_stored_exceptions=None, exceptions_flush_interval_seconds=1.0,
+                 fsync_policy=FSYNC_NEVER, codec=None):
+        _check_fsync_policy(fsync_policy)
         self.store_directory_path = store_directory
+        self._journaled = journaled
+        self._fsync_policy = fsync_policy
+        self._codec = _create_codec(codec)
+        self._min_journal_entries_before_compaction = min_journal_entries_before_compaction
+        # (execution id, worker id) -> [base generation, base size, journal entries]
+        self._journals = {}
+        # (execution id, worker id) -> failed attempts of a bitmap state, as last written
+        self._bitmap_failed_attempts = {}
+        self._deduplicate_exceptions = deduplicate_exceptions
+        self._max_stored_exceptions = max_stored_exceptions
+        self._exceptions_flush_interval_seconds = exceptions_flush_interval_seconds
+        self._exception_sinks = _ExceptionSinks(self._create_exception_sink)
 
     def load_whole_state(self, execution_id):
-        execution_path = os.path.join(self.store_directory_path, str(execution_id))
-        worker_ids = [worker_id for worker_id in os.listdir(execution_path) if worker_id != 'meta']
-        workers_states = [self.load_worker_state(execution_id, worker_id) for worker_id in worker_ids]
+        bitmap_state = self.load_bitmap_state(execution_id)
+        if bitmap_state is not None:
+            return bitmap_state
+
+        workers_states = [self.load_worker_state(execution_id, worker_id)
+                          for worker_id in self._worker_ids(execution_id)]
+        state = PyloExecutionState.merge(execution_id, workers_states)
 
-        empty_state = PyloExecutionState(execution_id, [], [])
-        return reduce(lambda state1, state2: state1.join(state2), workers_states, empty_state)
+        ancestors = self._ancestor_executions(execution_id)
+        if ancestors:
+            state.finished_inputs = [task_input for ancestor in ancestors
+                                     for task_input in self._iter_own_inputs(ancestor, finished=True)] + \
+                state.finished_inputs
+        return state
 
     def load_worker_state(self, execution_id, worker_id):
-        state_file = os.path.join(self.store_directory_path, str(execution_id), str(worker_id))
-        return pickle.load(open(state_file, "rb"))
+        # workers of bitmap states share the bitmap
+        bitmap_state = self.load_bitmap_state(execution_id)
+        if bitmap_state is not None:
+            return bitmap_state
+
+        state_file = self._state_file_path(execution_id, worker_id)
+        header, unfinished_inputs, finished_inputs = _read_state_file(state_file)
+        state = PyloExecutionState(header['execution_id'], finished_inputs, unfinished_inputs, header['stream_offset'],
+                                   failed_attempts=header.get('failed_attempts'))
+
+        journal = _read_journal(state_file, header['generation'])
+        if journal:
+            state.replay_journal(journal)
+        return state
+
+    def iter_inputs(self, execution_id, finished):
+        bitmap_state = self.load_bitmap_state(execution_id)
+        if bitmap_state is not None:
+            yield from bitmap_state.finished_inputs if finished else bitmap_state.unfinished_inputs
+            return
+
+        # unfinished inputs of parent executions are all retried, so only finished inputs are inherited
+        execution_ids = self._ancestor_executions(execution_id) + [execution_id] if finished else [execution_id]
+        for chained_execution_id in execution_ids:
+            yield from self._iter_own_inputs(chained_execution_id, finished)
+
+    def _iter_own_inputs(self, execution_id, finished):
+        for worker_id in self._worker_ids(execution_id):
+            state_file = self._state_file_path(execution_id, worker_id)
+            header, unfinished_inputs, finished_inputs = _read_state_file(state_file, load_finished=finished)
+            if _read_journal(state_file, header['generation']):
+                state = self.load_worker_state(execution_id, worker_id)
+                unfinished_inputs, finished_inputs = state.unfinished_inputs, state.finished_inputs
+
+            yield from finished_inputs if finished else unfinished_inputs
+
+    def count_inputs(self, execution_id):
+        bitmap_state = self.load_bitmap_state(execution_id)
+        if bitmap_state is not None:
+            return len(bitmap_state.finished_inputs), len(bitmap_state.unfinished_inputs)
+
+        finished_count, unfinished_count, stream_offset = self._count_own_inputs(execution_id)
+        if stream_offset is not None:
+            return stream_offset - unfinished_count, unfinished_count
+
+        for ancestor in self._ancestor_executions(execution_id):
+            finished_count += self._count_own_inputs(ancestor)[0]
+        return finished_count, unfinished_count
+
+    def _count_own_inputs(self, execution_id):
+        finished_count, unfinished_count, stream_offset = 0, 0, None
+        for worker_id in self._worker_ids(execution_id):
+            state_file = self._state_file_path(execution_id, worker_id)
+            header, _, _ = _read_state_file(state_file, load_unfinished=False, load_finished=False)
+            finished_count += header['finished_inputs']
+            unfinished_count += header['unfinished_inputs']
+            if header['stream_offset'] is not None:
+                stream_offset = max(header['stream_offset'], stream_offset or 0)
+
+            for status, _ in _read_journal(state_file, header['generation']):
+                finished_count += status == FINISHED
+                unfinished_count += (status == _ASSIGNED) - (status in (FINISHED, _GIVEN_AWAY))
+
+        return finished_count, unfinished_count, stream_offset
+
+    def load_failed_attempts(self, execution_id):
+        bitmap_state = self.load_bitmap_state(execution_id)
+        if bitmap_state is not None:
+            return bitmap_state.failed_attempts
+
+        # workers keep failed attempts of inputs they gave away, so inputs which finished may be left in, but their
+        # attempts are never used
+        workers_failed_attempts = []
+        for worker_id in self._worker_ids(execution_id):
+            state_file = self._state_file_path(execution_id, worker_id)
+            header, _, _ = _read_state_file(state_file, load_unfinished=False, load_finished=False)
+            failed_attempts = dict(header.get('failed_attempts') or {})
+            for status, task_input in _read_journal(state_file, header['generation']):
+                if status == FAILED:
+                    failed_attempts[_input_key(task_input)] = failed_attempts.get(_input_key(task_input), 0) + 1
+                elif status == FINISHED:
+                    failed_attempts.pop(_input_key(task_input), None)
+            workers_failed_attempts.append(PyloExecutionState(execution_id, [], [], failed_attempts=failed_attempts))
+        return _merge_failed_attempts(workers_failed_attempts)
+
+    def load_stream_offset(self, execution_id):
+        stream_offsets = [
+            _read_state_file(self._state_file_path(execution_id, worker_id), False, False)[0]['stream_offset']
+            for worker_id in self._worker_ids(execution_id)]
+        return max((offset for offset in stream_offsets if offset is not None), default=None)
 
     def store_worker_state(self, execution_id, worker_id, task_execution_state):
+        if isinstance(task_execution_state, PyloBitmapExecutionState):
+            self._store_bitmap(execution_id, worker_id, task_execution_state)
+            return
+
         execution_path = os.path.join(self.store_directory_path, str(execution_id))
         os.makedirs(execution_path, exist_ok=True)
 
         state_file = os.path.join(execution_path, str(worker_id))
-        pickle.dump(task_execution_state, open(state_file, "wb"))
+        journal = task_execution_state.take_journal()
+        # streamed states only keep a window of unfinished inputs, so they are always cheap to rewrite
+        if not self._journaled or task_execution_state.is_streamed:
+            _write_state_file_atomically(
+                state_file, task_execution_state, None, self._fsync_policy != FSYNC_NEVER, self._codec)
+            return
+
+        journal_key = (str(execution_id), str(worker_id))
+        journal_info = self._journals.get(journal_key)
+        if journal_info is None or \
+                journal_info[2] + len(journal) >= max(self._min_journal_entries_before_compaction, journal_info[1]):
+            generation = journal_info[0] + 1 if journal_info else 0
+            self._write_base(state_file, task_execution_state, generation)
+            self._journals[journal_key] = [
+                generation,
+                len(task_execution_state.finished_inputs) + len(task_execution_state.unfinished_inputs),
+                0]
+            return
+
+        if journal:
+            with open(state_file + _JOURNAL_SUFFIX, 'ab') as jf:
+                for entry in journal:
+                    pickle.dump(entry, jf)
+                if self._fsync_policy == FSYNC_ALWAYS:
+                    jf.flush()
+                    os.fsync(jf.fileno())
+            journal_info[2] += len(journal)
+
+    def _store_bitmap(self, execution_id, worker_id, task_execution_state):
+        # finished inputs are already in the bitmap, and every other input of the range is unfinished
+        task_execution_state.take_journal()
+        bitmap = task_execution_state.bitmap
+        bitmap_file = self._bitmap_file_path(execution_id)
+        if bitmap.file_path == bitmap_file:
+            if self._fsync_policy != FSYNC_NEVER:
+                bitmap.flush()
+        else:
+            os.makedirs(os.path.dirname(bitmap_file), exist_ok=True)
+            with open(bitmap_file + _RANGE_SUFFIX, 'wb') as rf:
+                pickle.dump((bitmap.start, bitmap.stop), rf)
+            bitmap.map_to_file(bitmap_file, self._fsync_policy != FSYNC_NEVER)
+
+        # failed attempts are not in the bitmap, but there are few of them, so each worker rewrites its own whenever
+        # they change
+        attempts_key = (str(execution_id), str(worker_id))
+        failed_attempts = task_execution_state.failed_attempts
+        if failed_attempts == self._bitmap_failed_attempts.get(attempts_key, {}):
+            return
+
+        attempts_file = os.path.join(self._bitmap_failed_attempts_dir_path(execution_id), str(worker_id))
+        os.makedirs(os.path.dirname(attempts_file), exist_ok=True)
+        with open(attempts_file + _TEMP_SUFFIX, 'wb') as af:
+            pickle.dump(failed_attempts, af)
+            if self._fsync_policy != FSYNC_NEVER:
+                af.flush()
+                os.fsync(af.fileno())
+        os.replace(attempts_file + _TEMP_SUFFIX, attempts_file)
+        self._bitmap_failed_attempts[attempts_key] = dict(failed_attempts)
+
+    def load_bitmap_state(self, execution_id):
+        bitmap_file = self._bitmap_file_path(execution_id)
+        if not os.path.exists(bitmap_file + _RANGE_SUFFIX):
+            return None
+
+        with open(bitmap_file + _RANGE_SUFFIX, 'rb') as rf:
+            start, stop = pickle.load(rf)
+        with open(bitmap_file, 'rb') as bf:
+            data = bytearray(bf.read())
+        bitmap_state = PyloBitmapExecutionState(execution_id, _Bitmap(start, stop, data))
+
+        workers_failed_attempts = []
+        attempts_dir = self._bitmap_failed_attempts_dir_path(execution_id)
+        for file_name in os.listdir(attempts_dir) if os.path.isdir(attempts_dir) else []:
+            if not file_name.endswith(_TEMP_SUFFIX):
+                with open(os.path.join(attempts_dir, file_name), 'rb') as af:
+                    workers_failed_attempts.append(
+                        PyloExecutionState(execution_id, [], [], failed_attempts=pickle.load(af)))
+        # workers keep failed attempts of inputs they gave away, which may have finished since
+        failed_attempts = _merge_failed_attempts(workers_failed_attempts)
+        bitmap_state.failed_attempts = {task_input: attempts for task_input, attempts in failed_attempts.items()
+                                        if not bitmap_state.bitmap.is_set(task_input)}
+        return bitmap_state
+
+    def compact(self, execution_id):
+        """
+        Folds the journals of all workers of the given execution into their base snapshots.
+        """
+        for worker_id in self._worker_ids(execution_id):
+            state_file = self._state_file_path(execution_id, worker_id)
+            if not os.path.exists(state_file + _JOURNAL_SUFFIX):
+                continue
+
+            state = self.load_worker_state(execution_id, worker_id)
+            self._write_base(state_file, state, _next_generation(state_file))
+            self._journals.pop((str(execution_id), worker_id), None)
+
+    def store_parent_execution(self, execution_id, parent_execution_id):
+        """
+        Records that the given execution resumes the parent execution by reference. The given execution only holds
+        the inputs it retries, and finished inputs of the parent (and its own parents) are listed as its finished
+        inputs without being copied.
+        """
+        parent_file = self._parent_file_path(execution_id)
+        os.makedirs(os.path.dirname(parent_file), exist_ok=True)
+        with open(parent_file, 'wb') as pf:
+            pickle.dump(parent_execution_id, pf)
+
+    def load_parent_execution(self, execution_id):
+        parent_file = self._parent_file_path(execution_id)
+        if not os.path.exists(parent_file):
+            return None
+        with open(parent_file, 'rb') as pf:
+            return pickle.load(pf)
+
+    def flatten_execution(self, execution_id):
+        """
+        Copies finished inputs of all executions which the given execution references into the given execution, and
+        drops the reference, so that lookups no longer walk the chain of parent executions.
+        """
+        ancestors = self._ancestor_executions(execution_id)
+        if not ancestors:
+            return
+
+        # finished inputs of parent executions are added to the finished state (worker 0). If we crash before the
+        # reference to the parent is removed, they are listed twice, but never lost
+        state_file = self._state_file_path(execution_id, 0)
+        if os.path.exists(state_file):
+            finished_state = self.load_worker_state(execution_id, 0)
+        else:
+            finished_state = PyloExecutionState(execution_id, [], [])
+        finished_state.finished_inputs = [task_input for ancestor in ancestors
+                                          for task_input in self._iter_own_inputs(ancestor, finished=True)] + \
+            finished_state.finished_inputs
+
+        self._write_base(state_file, finished_state, _next_generation(state_file))
+        self._journals.pop((str(execution_id), '0'), None)
+        os.remove(self._parent_file_path(execution_id))
+
+    def create_leases(self, execution_id, shard_ids):
+        """
+        Records shards of the given execution, which nodes running it take leases of (see PyloDistributedExecutor).
+        Shards are worker states, and none of them is leased yet.
+        """
+        with self._locked_leases(execution_id) as leases:
+            for shard_id in shard_ids:
+                leases.setdefault(shard_id, (None, 0.0, False))
+
+    def acquire_lease(self, execution_id, shard_id, owner, lease_seconds):
+        """
+        Takes the lease of the given shard for owner, for lease_seconds from now. It succeeds if the shard is not done,
+        and is not leased, or its lease expired, or owner already holds it (in which case the lease is renewed). Lease
+        expiry is compared to the wall clock, so clocks of all nodes have to be in sync (to well within lease_seconds).
+
+        :return:  true if owner holds the lease now
+        """
+        with self._locked_leases(execution_id) as leases:
+            now = time.time()
+            current_owner, expires_at, done = leases.get(shard_id, (None, 0.0, True))
+            if done or (current_owner not in (None, owner) and expires_at > now):
+                return False
+            leases[shard_id] = (owner, now + lease_seconds, False)
+
+        if current_owner != owner:
+            # other nodes may have written the shard since this store last did, so its journal starts over
+            self._journals.pop((str(execution_id), str(shard_id)), None)
+        return True
+
+    def release_lease(self, execution_id, shard_id, owner, done):
+        """
+        Releases the lease of the given shard, if owner still holds it.
+        :param done:  if set to true, the shard is never leased again
+        """
+        with self._locked_leases(execution_id) as leases:
+            if leases.get(shard_id, (None,))[0] == owner:
+                leases[shard_id] = (None, 0.0, done)
+
+    def load_leases(self, execution_id):
+        """
+        :return:  a dict which maps ids of shards of the given execution to tuples of their owner (None if not leased),
+                  the wall clock time their lease expires at, and whether they are done. It is empty if the execution
+                  has no shards
+        """
+        # leases are replaced atomically, so they can be read without the lock
+        return _read_leases(self._leases_file_path(execution_id))
+
+    @contextlib.contextmanager
+    def _locked_leases(self, execution_id):
+        """
+        Holds a lock on leases of the given execution, which other processes respect too, and yields them as a dict
+        which is written back if it changed.
+        """
+        leases_file = self._leases_file_path(execution_id)
+        os.makedirs(os.path.dirname(leases_file), exist_ok=True)
+        with _exclusive_file_lock(leases_file + _LOCK_SUFFIX):
+            leases = _read_leases(leases_file)
+            original_leases = dict(leases)
+            yield leases
+            if leases != original_leases:
+                temp_file = leases_file + _TEMP_SUFFIX
+                with open(temp_file, 'wb') as lf:
+                    pickle.dump(leases, lf)
+                    if self._fsync_policy != FSYNC_NEVER:
+                        lf.flush()
+                        os.fsync(lf.fileno())
+                os.replace(temp_file, leases_file)
+
+    def store_task_durations(self, execution_id, durations):
+        """
+        Records how long the task took for inputs of the given execution, replacing durations recorded for the same
+        inputs before.
+        :param durations:  a dict which maps keys of inputs (see PyloExecutionState.failed_attempts) to seconds
+        """
+        durations_file = self._durations_file_path(execution_id)
+        os.makedirs(os.path.dirname(durations_file), exist_ok=True)
+        # appended in a single write, so that nodes sharing the directory do not interleave their records
+        with open(durations_file, 'ab') as df:
+            df.write(pickle.dumps(durations))
+
+    def load_task_durations(self, execution_id):
+        """
+        :return:  a dict which maps keys of inputs to how long the task took for them in the given execution, or in
+                  executions which it references (the latest duration of each input)
+        """
+        durations = {}
+        for recording_execution_id in self._ancestor_executions(execution_id) + [execution_id]:
+            durations.update(self._load_own_task_durations(recording_execution_id))
+        return durations
+
+    def _load_own_task_durations(self, execution_id):
+        durations_file = self._durations_file_path(execution_id)
+        durations = {}
+        if not os.path.exists(durations_file):
+            return durations
+
+        with open(durations_file, 'rb') as df:
+            for record in _load_all(df):
+                durations.update(record)
+        return durations
+
+    def _durations_file_path(self, execution_id):
+        return os.path.join(self.store_directory_path, str(execution_id), 'meta', 'durations')
+
+    def _leases_file_path(self, execution_id):
+        return os.path.join(self.store_directory_path, str(execution_id), 'meta', 'leases')
+
+    def _bitmap_file_path(self, execution_id):
+        return os.path.join(self.store_directory_path, str(execution_id), 'meta', 'bitmap')
+
+    def _bitmap_failed_attempts_dir_path(self, execution_id):
+        return os.path.join(self.store_directory_path, str(execution_id), 'meta', 'bitmap-failed-attempts')
+
+    def _parent_file_path(self, execution_id):
+        return os.path.join(self.store_directory_path, str(execution_id), 'meta', 'parent')
+
+    def _worker_ids(self, execution_id):
+        execution_path = os.path.join(self.store_directory_path, str(execution_id))
+        return sorted(
+            (worker_id for worker_id in os.listdir(execution_path) if _is_worker_file(worker_id)),
+            key=_worker_sort_key)
+
+    def _state_file_path(self, execution_id, worker_id):
+        return os.path.join(self.store_directory_path, str(execution_id), str(worker_id))
+
+    def _write_base(self, state_file, task_execution_state, generation):
+        # the base carries a generation number, and so does the journal. A journal left over from an older generation
+        # (e.g. when we crash after writing the base, but before truncating the journal) is therefore ignored on load.
+        _write_state_file_atomically(
+            state_file, task_execution_state, generation, self._fsync_policy != FSYNC_NEVER, self._codec)
+
+        with open(state_file + _JOURNAL_SUFFIX, 'wb') as jf:
+            pickle.dump(generation, jf)
 
     def load_task_exceptions(self, execution_id):
-        exceptions_file_path = os.path.join(self.store_directory_path, str(execution_id), 'meta', 'exceptions')
+        return [exception for exception, _ in self.load_task_exception_counts(execution_id)]
+
+    def load_task_exception_counts(self, execution_id):
+        self._exception_sinks.flush(execution_id)
+        exceptions_file_path = self._exceptions_file_path(execution_id)
         if not os.path.exists(exceptions_file_path):
             return []
 
-        exceptions = []
         with open(exceptions_file_path, mode='rb') as ef:
-            while True:
-                try:
-                    exceptions.append(pickle.load(ef))
-                except EOFError:
-                    break
-        return exceptions
+            return count_repeated_exceptions(_decode_record(record) for record in _load_all(ef))
 
     def store_task_exception(self, execution_id, exception):
-        meta_files_path = os.path.join(self.store_directory_path, str(execution_id), 'meta')
-        os.makedirs(meta_files_path, exist_ok=True)
+        self._exception_sinks.add(execution_id, exception)
+
+    def finish_execution(self, execution_id):
+        self._exception_sinks.close(execution_id)
+
+    def _exceptions_file_path(self, execution_id):
+        return os.path.join(self.store_directory_path, str(execution_id), 'meta', 'exceptions')
+
+    def _create_exception_sink(self, execution_id):
+        exceptions_file_path = self._exceptions_file_path(execution_id)
+        os.makedirs(os.path.dirname(exceptions_file_path), exist_ok=True)
+
+        stored_exceptions = len(self.load_task_exception_counts(execution_id)) \
+            if os.path.exists(exceptions_file_path) else 0
+        exceptions_file = open(exceptions_file_path, 'ab')
+
+        def write_exceptions(exceptions, repeated_exceptions):
+            # exceptions are serialized up front, so a failure never leaves a partial record in the file
+            records = [self._encode_record(picklable_exception(exception)) for _, exception in exceptions] + \
+                [self._encode_record(RepeatedException(index, count)) for index, count in repeated_exceptions.items()]
+            exceptions_file.write(b''.join(records))
+            exceptions_file.flush()
+
+        return _ClosingExceptionSink(
+            exceptions_file,
+            write_exceptions,
+            flush_interval_seconds=self._exceptions_flush_interval_seconds,
+            deduplicate=self._deduplicate_exceptions,
+            max_stored_exceptions=self._max_stored_exceptions,
+            stored_exceptions=stored_exceptions)
+
+    def _encode_record(self, record):
+        if self._codec.name == PickleCodec.name:
+            return pickle.dumps(record)
+        return pickle.dumps(_EncodedRecord(self._codec.name, self._codec.encode_object(record)))
+
+
+class _EncodedRecord:
+    """
+    A record of the exceptions file, encoded with a codec other than pickle.
+    """
+    def __init__(self, codec_name, data):
+        self.codec_name = codec_name
+        self.data = data
+
+
+class _ClosingExceptionSink(PyloExceptionSink):
+    """
+    Exception sink which closes the file it writes to, once it is closed.
+    """
+    def __init__(self, exceptions_file, write_exceptions, **kwargs):
+        super().__init__(write_exceptions, **kwargs)
+        self._exceptions_file = exceptions_file
+
+    def close(self):
+        super().close()
+        self._exceptions_file.close()
+
+
+class PyloSqliteExecutionStore(PyloExecutionStore):
+    """
+    Persists execution state and exceptions to indexed tables of an SQLite database, so that questions like "is this
+    input finished?" or "how many inputs failed?" can be answered without loading the whole state.
+
+    Once a worker state has been stored, subsequent snapshots only apply inputs which changed since the previous
+    snapshot, in a single transaction. The database uses write-ahead logging, so other processes can read it
+    (e.g. call get_state) while workers write to it.
+
+    With write-ahead logging, every snapshot is a transaction, so fsync_policy maps to sqlite synchronous setting:
+    FSYNC_NEVER to OFF, FSYNC_SNAPSHOTS to NORMAL (the log is synced on checkpoints), and FSYNC_ALWAYS to FULL.
+    """
+
+    supports_parent_references = True
+    supports_leases = True
+    supports_task_durations = True
+
+    def __init__(self, database_path, deduplicate_exceptions=False, max_stored_exceptions=None,
+                 exceptions_flush_interval_seconds=1.0, fsync_policy=FSYNC_SNAPSHOTS):
+        _check_fsync_policy(fsync_policy)
+        self.database_path = database_path
+        self._fsync_policy = fsync_policy
+        self._deduplicate_exceptions = deduplicate_exceptions
+        self._max_stored_exceptions = max_stored_exceptions
+        self._exceptions_flush_interval_seconds = exceptions_flush_interval_seconds
+        self._exception_sinks = _ExceptionSinks(self._create_exception_sink)
+        # sqlite connections can not be shared between threads, so each thread opens its own
+        self._connections = threading.local()
+        # (execution id, worker id) -> [next finished position, next unfinished position]
+        self._positions = {}
+        with self._connection() as connection:
+            connection.executescript(_SQLITE_SCHEMA)
+
+    def load_whole_state(self, execution_id):
+        workers_states = [self.load_worker_state(execution_id, worker_id)
+                          for worker_id in self._worker_ids(execution_id)]
+        state = PyloExecutionState.merge(execution_id, workers_states)
+
+        ancestors = self._ancestor_executions(execution_id)
+        if ancestors:
+            state.finished_inputs = [task_input for ancestor in ancestors
+                                     for task_input in self._iter_own_inputs(ancestor, finished=True)] + \
+                state.finished_inputs
+        return state
+
+    def load_worker_state(self, execution_id, worker_id):
+        connection = self._connection()
+        worker = connection.execute(
+            'SELECT stream_offset FROM workers WHERE execution_id = ? AND worker_id = ?',
+            (str(execution_id), str(worker_id))).fetchone()
+        if worker is None:
+            raise KeyError(f'No state of worker {worker_id} for execution {execution_id}')
+
+        inputs = {0: [], 1: []}
+        for finished, task_input in connection.execute(
+                'SELECT finished, task_input FROM inputs WHERE execution_id = ? AND worker_id = ? '
+                'ORDER BY finished, position', (str(execution_id), str(worker_id))):
+            inputs[finished].append(pickle.loads(task_input))
+
+        # failed attempts are stored per execution, so that they do not have to move with stolen inputs
+        failed_attempts = self.load_failed_attempts(execution_id)
+        if failed_attempts:
+            unfinished_keys = (_input_key(task_input) for task_input in inputs[0])
+            failed_attempts = {key: failed_attempts[key] for key in unfinished_keys if key in failed_attempts}
+        return PyloExecutionState(execution_id, inputs[1], inputs[0], stream_offset=worker[0],
+                                  failed_attempts=failed_attempts)
+
+    def store_worker_state(self, execution_id, worker_id, task_execution_state):
+        journal = task_execution_state.take_journal()
+        positions_key = (str(execution_id), str(worker_id))
+        with self._connection() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO workers (execution_id, worker_id, stream_offset) VALUES (?, ?, ?)',
+                (str(execution_id), str(worker_id), task_execution_state.stream_offset))
+
+            if positions_key not in self._positions:
+                self._store_whole_worker_state(connection, positions_key, task_execution_state)
+            else:
+                self._store_worker_state_changes(connection, positions_key, journal, task_execution_state.is_streamed)
+            self._store_failed_attempts_changes(
+                connection, str(execution_id), journal, task_execution_state.failed_attempts)
+
+    def _store_whole_worker_state(self, connection, positions_key, task_execution_state):
+        connection.execute('DELETE FROM inputs WHERE execution_id = ? AND worker_id = ?', positions_key)
+        connection.executemany(
+            'INSERT INTO inputs (execution_id, worker_id, finished, position, task_input) VALUES (?, ?, ?, ?, ?)',
+            itertools.chain(
+                (positions_key + (1, position, _serialize_input(task_input))
+                 for position, task_input in enumerate(task_execution_state.finished_inputs)),
+                (positions_key + (0, position, _serialize_input(task_input))
+                 for position, task_input in enumerate(task_execution_state.unfinished_inputs))))
+        self._positions[positions_key] = [
+            len(task_execution_state.finished_inputs), len(task_execution_state.unfinished_inputs)]
+        connection.executemany(
+            'INSERT OR REPLACE INTO failed_attempts (execution_id, input_key, attempts) VALUES (?, ?, ?)',
+            ((positions_key[0], _serialize_input(key), attempts)
+             for key, attempts in task_execution_state.failed_attempts.items()))
+
+    def _store_failed_attempts_changes(self, connection, execution_id, journal, failed_attempts):
+        # the journal only tells which inputs failed or finished, the state has their current number of attempts
+        for status, task_input in journal:
+            key = _input_key(task_input)
+            if status == FAILED:
+                connection.execute(
+                    'INSERT OR REPLACE INTO failed_attempts (execution_id, input_key, attempts) VALUES (?, ?, ?)',
+                    (execution_id, _serialize_input(key), failed_attempts.get(key, 1)))
+            elif status == FINISHED:
+                connection.execute('DELETE FROM failed_attempts WHERE execution_id = ? AND input_key = ?',
+                                   (execution_id, _serialize_input(key)))
+            elif status == _ASSIGNED and key in failed_attempts:
+                connection.execute(
+                    'INSERT OR REPLACE INTO failed_attempts (execution_id, input_key, attempts) VALUES (?, ?, ?)',
+                    (execution_id, _serialize_input(key), failed_attempts[key]))
+
+    def load_failed_attempts(self, execution_id):
+        return {pickle.loads(input_key): attempts for input_key, attempts in self._connection().execute(
+            'SELECT input_key, attempts FROM failed_attempts WHERE execution_id = ?', (str(execution_id),))}
+
+    def _store_worker_state_changes(self, connection, positions_key, journal, is_streamed):
+        positions = self._positions[positions_key]
+        for status, task_input in journal:
+            serialized_input = _serialize_input(task_input)
+            if status == _ASSIGNED:
+                connection.execute(
+                    'INSERT INTO inputs (execution_id, worker_id, finished, position, task_input) '
+                    'VALUES (?, ?, 0, ?, ?)', positions_key + (positions[1], serialized_input))
+                positions[1] += 1
+                continue
+
+            # inputs are taken from the front of unfinished inputs, and given away from the back
+            order = 'DESC' if status == _GIVEN_AWAY else 'ASC'
+            row = connection.execute(
+                f'SELECT rowid FROM inputs WHERE execution_id = ? AND task_input = ? AND worker_id = ? '
+                f'AND finished = 0 ORDER BY position {order} LIMIT 1',
+                (positions_key[0], serialized_input, positions_key[1])).fetchone()
+            if row is None:
+                continue
+
+            # streamed states do not keep finished inputs
+            if status == _GIVEN_AWAY or (status == FINISHED and is_streamed):
+                connection.execute('DELETE FROM inputs WHERE rowid = ?', row)
+            elif status == FINISHED:
+                connection.execute(
+                    'UPDATE inputs SET finished = 1, position = ? WHERE rowid = ?', (positions[0], row[0]))
+                positions[0] += 1
+            else:
+                connection.execute('UPDATE inputs SET position = ? WHERE rowid = ?', (positions[1], row[0]))
+                positions[1] += 1
+
+    def load_task_exceptions(self, execution_id):
+        return [exception for exception, _ in self.load_task_exception_counts(execution_id)]
+
+    def load_task_exception_counts(self, execution_id):
+        self._exception_sinks.flush(execution_id)
+        return [(pickle.loads(exception), count) for exception, count in self._connection().execute(
+            'SELECT exception, count FROM exceptions WHERE execution_id = ? ORDER BY exception_index',
+            (str(execution_id),))]
+
+    def store_task_exception(self, execution_id, exception):
+        self._exception_sinks.add(execution_id, exception)
+
+    def store_task_durations(self, execution_id, durations):
+        with self._connection() as connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO task_durations (execution_id, input_key, seconds) VALUES (?, ?, ?)',
+                ((str(execution_id), _serialize_input(key), seconds) for key, seconds in durations.items()))
+
+    def load_task_durations(self, execution_id):
+        durations = {}
+        for recording_execution_id in self._ancestor_executions(execution_id) + [execution_id]:
+            durations.update(self._load_own_task_durations(recording_execution_id))
+        return durations
+
+    def _load_own_task_durations(self, execution_id):
+        return {pickle.loads(input_key): seconds for input_key, seconds in self._connection().execute(
+            'SELECT input_key, seconds FROM task_durations WHERE execution_id = ?', (str(execution_id),))}
+
+    def finish_execution(self, execution_id):
+        self._exception_sinks.close(execution_id)
+
+    def _create_exception_sink(self, execution_id):
+        # other processes may store exceptions of the same execution (see PyloDistributedExecutor), so exceptions take
+        # the next free indexes in the table, and indexes of the sink are mapped to them
+        table_indexes = {}
+
+        def write_exceptions(exceptions, repeated_exceptions):
+            with self._connection() as connection:
+                connection.executemany(
+                    'INSERT INTO exceptions (execution_id, exception_index, exception) '
+                    'SELECT ?, COALESCE(MAX(exception_index) + 1, 0), ? FROM exceptions WHERE execution_id = ?',
+                    ((str(execution_id), pickle.dumps(picklable_exception(exception)), str(execution_id))
+                     for _, exception in exceptions))
+                if exceptions and self._deduplicate_exceptions:
+                    last_index = connection.execute(
+                        'SELECT MAX(exception_index) FROM exceptions WHERE execution_id = ?',
+                        (str(execution_id),)).fetchone()[0]
+                    for table_index, (index, _) in enumerate(exceptions, start=last_index - len(exceptions) + 1):
+                        table_indexes[index] = table_index
+                connection.executemany(
+                    'UPDATE exceptions SET count = count + ? WHERE execution_id = ? AND exception_index = ?',
+                    ((count, str(execution_id), table_indexes.get(index, index))
+                     for index, count in repeated_exceptions.items()))
+
+        stored_exceptions = self._connection().execute(
+            'SELECT COUNT(*) FROM exceptions WHERE execution_id = ?', (str(execution_id),)).fetchone()[0]
+        return PyloExceptionSink(
+            write_exceptions,
+            flush_interval_seconds=self._exceptions_flush_interval_seconds,
+            deduplicate=self._deduplicate_exceptions,
+            max_stored_exceptions=self._max_stored_exceptions,
+            stored_exceptions=stored_exceptions)
+
+    def iter_inputs(self, execution_id, finished):
+        # unfinished inputs of parent executions are all retried, so only finished inputs are inherited
+        execution_ids = self._ancestor_executions(execution_id) + [execution_id] if finished else [execution_id]
+        for chained_execution_id in execution_ids:
+            yield from self._iter_own_inputs(chained_execution_id, finished)
+
+    def _iter_own_inputs(self, execution_id, finished):
+        for worker_id in self._worker_ids(execution_id):
+            for task_input, in self._connection().execute(
+                    'SELECT task_input FROM inputs WHERE execution_id = ? AND worker_id = ? AND finished = ? '
+                    'ORDER BY position', (str(execution_id), str(worker_id), int(finished))):
+                yield pickle.loads(task_input)
+
+    def load_inputs_page(self, execution_id, finished, offset, limit):
+        execution_ids = self._ancestor_executions(execution_id) + [execution_id] if finished else [execution_id]
+        page = []
+        for chained_execution_id in execution_ids:
+            if len(page) >= limit:
+                break
+            # pages are read with LIMIT and OFFSET in the order of iter_inputs, skipping executions before the offset
+            own_count = self._connection().execute(
+                'SELECT COUNT(*) FROM inputs WHERE execution_id = ? AND finished = ?',
+                (str(chained_execution_id), int(finished))).fetchone()[0]
+            if offset >= own_count:
+                offset -= own_count
+                continue
+
+            page.extend(pickle.loads(task_input) for task_input, in self._connection().execute(
+                f'SELECT task_input FROM inputs WHERE execution_id = ? AND finished = ? '
+                f'ORDER BY {_SQLITE_WORKER_ORDER}, position LIMIT ? OFFSET ?',
+                (str(chained_execution_id), int(finished), limit - len(page), offset)))
+            offset = 0
+        return page
+
+    def count_inputs(self, execution_id):
+        unfinished_count = self._connection().execute(
+            'SELECT COUNT(*) FROM inputs WHERE execution_id = ? AND finished = 0', (str(execution_id),)).fetchone()[0]
+        stream_offset = self.load_stream_offset(execution_id)
+        if stream_offset is not None:
+            return stream_offset - unfinished_count, unfinished_count
+
+        execution_ids = [str(chained_id) for chained_id in self._ancestor_executions(execution_id) + [execution_id]]
+        finished_count = self._connection().execute(
+            f'SELECT COUNT(*) FROM inputs WHERE execution_id IN ({", ".join("?" * len(execution_ids))}) '
+            f'AND finished = 1', execution_ids).fetchone()[0]
+        return finished_count, unfinished_count
+
+    def load_stream_offset(self, execution_id):
+        return self._connection().execute(
+            'SELECT MAX(stream_offset) FROM workers WHERE execution_id = ?', (str(execution_id),)).fetchone()[0]
+
+    def is_finished(self, execution_id, task_input):
+        serialized_input = _serialize_input(task_input)
+        return any(
+            self._connection().execute(
+                'SELECT 1 FROM inputs WHERE execution_id = ? AND task_input = ? AND finished = 1 LIMIT 1',
+                (str(chained_id), serialized_input)).fetchone() is not None
+            for chained_id in [execution_id] + self._ancestor_executions(execution_id))
+
+    def store_parent_execution(self, execution_id, parent_execution_id):
+        with self._connection() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO executions (execution_id, parent_execution_id) VALUES (?, ?)',
+                (str(execution_id), str(parent_execution_id)))
+
+    def load_parent_execution(self, execution_id):
+        row = self._connection().execute(
+            'SELECT parent_execution_id FROM executions WHERE execution_id = ?', (str(execution_id),)).fetchone()
+        return None if row is None else row[0]
+
+    def flatten_execution(self, execution_id):
+        ancestors = self._ancestor_executions(execution_id)
+        if not ancestors:
+            return
+
+        finished_inputs = [task_input for ancestor in ancestors
+                           for task_input in self._iter_own_inputs(ancestor, finished=True)]
+        positions_key = (str(execution_id), '0')
+        with self._connection() as connection:
+            # finished inputs of parent executions are prepended to the finished state (worker 0), in the same
+            # transaction which removes the reference to the parent
+            connection.execute(
+                'INSERT OR IGNORE INTO workers (execution_id, worker_id, stream_offset) VALUES (?, ?, NULL)',
+                positions_key)
+            connection.execute(
+                'UPDATE inputs SET position = position + ? WHERE execution_id = ? AND worker_id = ? AND finished = 1',
+                (len(finished_inputs),) + positions_key)
+            connection.executemany(
+                'INSERT INTO inputs (execution_id, worker_id, finished, position, task_input) VALUES (?, ?, 1, ?, ?)',
+                (positions_key + (position, _serialize_input(task_input))
+                 for position, task_input in enumerate(finished_inputs)))
+            connection.execute('DELETE FROM executions WHERE execution_id = ?', (str(execution_id),))
+
+        if positions_key in self._positions:
+            self._positions[positions_key][0] += len(finished_inputs)
+
+    def create_leases(self, execution_id, shard_ids):
+        with self._connection() as connection:
+            connection.executemany(
+                'INSERT OR IGNORE INTO leases (execution_id, shard_id) VALUES (?, ?)',
+                ((str(execution_id), shard_id) for shard_id in shard_ids))
+
+    def acquire_lease(self, execution_id, shard_id, owner, lease_seconds):
+        connection = self._connection()
+        with connection:
+            # the lease is read and taken in one write transaction, so two nodes never both take it
+            connection.execute('BEGIN IMMEDIATE')
+            lease = connection.execute(
+                'SELECT owner, expires_at, done FROM leases WHERE execution_id = ? AND shard_id = ?',
+                (str(execution_id), shard_id)).fetchone()
+            now = time.time()
+            if lease is None or lease[2] or (lease[0] not in (None, owner) and lease[1] > now):
+                return False
+            connection.execute(
+                'UPDATE leases SET owner = ?, expires_at = ? WHERE execution_id = ? AND shard_id = ?',
+                (owner, now + lease_seconds, str(execution_id), shard_id))
+
+        if lease[0] != owner:
+            # other nodes may have written the shard since this store last did, so it is written whole again
+            self._positions.pop((str(execution_id), str(shard_id)), None)
+        return True
+
+    def release_lease(self, execution_id, shard_id, owner, done):
+        with self._connection() as connection:
+            connection.execute(
+                'UPDATE leases SET owner = NULL, expires_at = 0, done = ? '
+                'WHERE execution_id = ? AND shard_id = ? AND owner = ?',
+                (int(done), str(execution_id), shard_id, owner))
+
+    def load_leases(self, execution_id):
+        return {shard_id: (owner, expires_at, bool(done)) for shard_id, owner, expires_at, done in
+                self._connection().execute(
+                    'SELECT shard_id, owner, expires_at, done FROM leases WHERE execution_id = ?',
+                    (str(execution_id),))}
+
+    def count_task_exceptions(self, execution_id):
+        """
+        :return:  the number of stored exceptions, including repeated ones if exceptions are deduplicated
+        """
+        self._exception_sinks.flush(execution_id)
+        return self._connection().execute(
+            'SELECT COALESCE(SUM(count), 0) FROM exceptions WHERE execution_id = ?', (str(execution_id),)).fetchone()[0]
+
+    def _worker_ids(self, execution_id):
+        return sorted(
+            (worker_id for worker_id, in self._connection().execute(
+                'SELECT worker_id FROM workers WHERE execution_id = ?', (str(execution_id),))),
+            key=_worker_sort_key)
+
+    def _connection(self):
+        connection = getattr(self._connections, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.database_path, timeout=60)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute(f'PRAGMA synchronous={_SQLITE_SYNCHRONOUS[self._fsync_policy]}')
+            self._connections.connection = connection
+        return connection
+
+
+_SQLITE_SYNCHRONOUS = {FSYNC_NEVER: 'OFF', FSYNC_SNAPSHOTS: 'NORMAL', FSYNC_ALWAYS: 'FULL'}
+
+# orders worker ids the way _worker_sort_key does: numeric ids by their value, then the others by their text
+_SQLITE_WORKER_ORDER = "(worker_id = '' OR worker_id GLOB '*[^0-9]*'), CAST(worker_id AS INTEGER), worker_id"
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS workers (
+    execution_id TEXT NOT NULL,
+    worker_id TEXT NOT NULL,
+    stream_offset INTEGER,
+    PRIMARY KEY (execution_id, worker_id)
+);
+CREATE TABLE IF NOT EXISTS inputs (
+    execution_id TEXT NOT NULL,
+    worker_id TEXT NOT NULL,
+    finished INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    task_input BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS inputs_by_worker ON inputs (execution_id, worker_id, finished, position);
+CREATE INDEX IF NOT EXISTS inputs_by_input ON inputs (execution_id, task_input, finished);
+CREATE TABLE IF NOT EXISTS failed_attempts (
+    execution_id TEXT NOT NULL,
+    input_key BLOB NOT NULL,
+    attempts INTEGER NOT NULL,
+    PRIMARY KEY (execution_id, input_key)
+);
+CREATE TABLE IF NOT EXISTS task_durations (
+    execution_id TEXT NOT NULL,
+    input_key BLOB NOT NULL,
+    seconds REAL NOT NULL,
+    PRIMARY KEY (execution_id, input_key)
+);
+CREATE TABLE IF NOT EXISTS executions (
+    execution_id TEXT NOT NULL PRIMARY KEY,
+    parent_execution_id TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leases (
+    execution_id TEXT NOT NULL,
+    shard_id INTEGER NOT NULL,
+    owner TEXT,
+    expires_at REAL NOT NULL DEFAULT 0,
+    done INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (execution_id, shard_id)
+);
+CREATE TABLE IF NOT EXISTS exceptions (
+    execution_id TEXT NOT NULL,
+    exception_index INTEGER NOT NULL,
+    exception BLOB NOT NULL,
+    count INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (execution_id, exception_index)
+);
+"""
+
+
+_JOURNAL_SUFFIX = '.journal'
+_TEMP_SUFFIX = '.tmp'
+_RANGE_SUFFIX = '.range'
+_LOCK_SUFFIX = '.lock'
+
+
+@contextlib.contextmanager
+def _exclusive_file_lock(lock_file_path):
+    with open(lock_file_path, 'a+b') as lf:
+        if fcntl is not None:
+            fcntl.flock(lf.fileno(), fcntl.LOCK_EX)
+        else:
+            lf.seek(0)
+            msvcrt.locking(lf.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lf.fileno(), fcntl.LOCK_UN)
+            else:
+                lf.seek(0)
+                msvcrt.locking(lf.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _read_leases(leases_file):
+    if not os.path.exists(leases_file):
+        return {}
+    with open(leases_file, 'rb') as lf:
+        return pickle.load(lf)
+
+
+def _is_worker_file(file_name):
+    return file_name != 'meta' and not file_name.endswith((_JOURNAL_SUFFIX, _TEMP_SUFFIX))
+
+
+def _worker_sort_key(worker_id):
+    return (0, int(worker_id), '') if worker_id.isdigit() else (1, 0, worker_id)
+
+
+def _write_state_file(file, state, generation, codec):
+    try:
+        encoded_unfinished_inputs = codec.encode_inputs(state.unfinished_inputs)
+        encoded_finished_inputs = codec.encode_inputs(state.finished_inputs)
+    except (TypeError, ValueError, OverflowError) as e:
+        _logger.warning(f'Unable to encode inputs with {codec.name} codec, falling back to pickle. '
+                        f'Failure message: {str(e)}')
+        codec = PickleCodec()
+        encoded_unfinished_inputs = codec.encode_inputs(state.unfinished_inputs)
+        encoded_finished_inputs = codec.encode_inputs(state.finished_inputs)
+
+    # the header goes first and unfinished inputs before finished ones, so that counts and unfinished inputs can be
+    # read without decoding finished inputs
+    header = _state_header(state, generation)
+    header['codec'] = codec.name
+    pickle.dump(header, file)
+    pickle.dump(encoded_unfinished_inputs, file)
+    pickle.dump(encoded_finished_inputs, file)
+
+
+def _write_state_file_atomically(state_file, state, generation, fsync, codec):
+    temp_file = state_file + _TEMP_SUFFIX
+    with open(temp_file, 'wb') as tf:
+        _write_state_file(tf, state, generation, codec)
+        if fsync:
+            tf.flush()
+            os.fsync(tf.fileno())
+    os.replace(temp_file, state_file)
+
+    if fsync and hasattr(os, 'O_DIRECTORY'):
+        # the rename itself is only durable once the directory is synced
+        directory = os.open(os.path.dirname(state_file), os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+
+def _create_codec(codec):
+    if codec is None:
+        return PickleCodec()
+    if isinstance(codec, str):
+        return get_codec(codec)
+
+    # custom codecs have to be found by name, when the store reads what it wrote
+    register_codec(codec)
+    return codec
+
+
+def _decode_record(record):
+    if isinstance(record, _EncodedRecord):
+        return get_codec(record.codec_name).decode_object(record.data)
+    return record
+
+
+def _check_fsync_policy(fsync_policy):
+    if fsync_policy not in (FSYNC_NEVER, FSYNC_SNAPSHOTS, FSYNC_ALWAYS):
+        raise ValueError(f'Unknown fsync policy {fsync_policy}, expected one of '
+                         f'{FSYNC_NEVER}, {FSYNC_SNAPSHOTS} or {FSYNC_ALWAYS}')
+
+
+def _read_state_file(state_file, load_unfinished=True, load_finished=True):
+    """
+    :return:  a tuple which consists of the header of the state, unfinished and finished inputs (None if not loaded)
+    """
+    with open(state_file, 'rb') as sf:
+        header = pickle.load(sf)
+        if isinstance(header, PyloExecutionState):
+            # states written before headers were introduced are a single object, optionally followed by a generation
+            state = header
+            return _state_header(state, _load_or_default(sf)), state.unfinished_inputs, state.finished_inputs
+
+        unfinished_inputs = pickle.load(sf) if load_unfinished or load_finished else None
+        finished_inputs = pickle.load(sf) if load_finished else None
+        # states written before codecs were introduced hold pickled inputs
+        if 'codec' in header:
+            codec = get_codec(header['codec'])
+            if load_unfinished or load_finished:
+                unfinished_inputs = codec.decode_inputs(unfinished_inputs)
+            if load_finished:
+                finished_inputs = codec.decode_inputs(finished_inputs)
+        return header, unfinished_inputs, finished_inputs
+
+
+def _state_header(state, generation):
+    return {
+        'execution_id': state.execution_id,
+        'finished_inputs': len(state.finished_inputs),
+        'unfinished_inputs': len(state.unfinished_inputs),
+        'stream_offset': state.stream_offset,
+        'generation': generation,
+        'failed_attempts': state.failed_attempts,
+    }
+
+
+def _next_generation(state_file):
+    if not os.path.exists(state_file):
+        return 0
+    header, _, _ = _read_state_file(state_file, load_unfinished=False, load_finished=False)
+    return 0 if header['generation'] is None else header['generation'] + 1
+
+
+def _read_journal(state_file, generation):
+    journal_file = state_file + _JOURNAL_SUFFIX
+    if generation is None or not os.path.exists(journal_file):
+        return []
+
+    with open(journal_file, 'rb') as jf:
+        if _load_or_default(jf) != generation:
+            return []
+        return _load_all(jf)
+
+
+def _load_or_default(file, default=None):
+    try:
+        return pickle.load(file)
+    except EOFError:
+        return default
+
+
+def _load_all(file):
+    objects = []
+    while True:
+        try:
+            objects.append(pickle.load(file))
+        except EOFError:
+            break
+        except (pickle.UnpicklingError, ValueError):
+            # the last record is cut short if we crashed while appending it
+            _logger.warning(f'Ignoring a partially written record in {file.name}')
+            break
+    return objects
+
+
+def _serialize_input(task_input):
+    # a fixed protocol, so that equal inputs are always serialized (and therefore indexed) the same way
+    return pickle.dumps(task_input, protocol=4)
+
 
-        exception_file = os.path.join(meta_files_path, 'exceptions')
-        pickle.dump(exception, open(exception_file, "ab"))
+def _input_key(task_input):
+    try:
+        hash(task_input)
+        return task_input
+    except TypeError:
+        return pickle.dumps(task_input)
 
 
 def _split_list_into_chunks(input_list, number_of_chunks):
     input_list = list(input_list)
     input_list_len = len(input_list)
+    if input_list_len == 0:
+        return []
     chunk_size = math.ceil(input_list_len / number_of_chunks)
     return [input_list[i:i + chunk_size] for i in range(0, input_list_len, chunk_size)]
@@ -0,0 +1,458 @@
+# coding=utf-8
+import atexit
+import logging
+import os
+import signal
+import threading
+import weakref
+from collections import OrderedDict
+
+from pylo.state import PyloExecutionStore, PyloExecutionState, PyloBitmapExecutionState, FINISHED, FAILED, \
+    _ASSIGNED, _input_key
+
+_logger = logging.getLogger(__name__)
+
+# how long a signal handler waits for the spill, before it lets the signal take its course
+SIGNAL_SPILL_TIMEOUT_SECONDS = 10.0
+
+# tiered stores which are not closed yet, spilled when the process exits or gets one of their spill_on_signals. Stores
+# are only weakly referenced, so that stores which are dropped without being closed are not kept alive
+_open_stores = weakref.WeakSet()
+_open_stores_lock = threading.Lock()
+# signal number -> the handler which was installed before ours. Ours is installed once for each signal, and stays
+# installed, so that stores can be closed in any order
+_previous_signal_handlers = {}
+
+
+class PyloTieredExecutionStore(PyloExecutionStore):
+    """
+    Keeps changes of worker states (their journals) and exceptions of running executions in memory, and spills them to
+    a backing store (any PyloExecutionStore) every spill_interval_seconds, once more than max_unspilled_changes changes
+    (inputs which finished, failed or moved between workers, and exceptions) are only in memory, when an execution
+    finishes, when the process exits, and when one of spill_on_signals arrives. Snapshots of workers then cost next to
+    nothing. States of running executions (load_whole_state, count_inputs and the like) are read from the backing
+    store, with the changes in memory applied on top.
+
+    The first state stored for each worker is written to the backing store straight away, so every input of an
+    execution is always in the backing store, as finished or unfinished. If the process crashes, changes since the
+    latest spill are lost, i.e. at most spill_interval_seconds worth of them, and never more than
+    max_unspilled_changes: inputs which finished since are unfinished in the backing store, and run again when the
+    execution is resumed, and their exceptions are not stored. Spills write workers in the order they last changed, so
+    inputs which moved between workers are never lost.
+
+    Memory holds only the unspilled changes, i.e. about max_unspilled_changes journal entries and exceptions, however
+    many inputs executions have, plus one worker state at a time while it is being spilled. In exchange, a spill reads
+    the state of each worker which changed from the backing store, to apply the changes to it, and so does every read
+    of a running execution with unspilled changes.
+    Executions with no unspilled changes, and executions which are not running, are read from the backing store as
+    they are. Bitmap states are passed through to the backing store, and so are leases, since nodes sharing a store
+    have to see each other's changes straight away. Stores which are dropped without being closed stop spilling, and
+    lose changes which are not spilled yet, so close the store (or finish its executions) before dropping it.
+    """
+
+    def __init__(self, backing_store, spill_interval_seconds=5.0, max_unspilled_changes=100000,
+                 spill_on_signals=(signal.SIGTERM,)):
+        """
+        :param backing_store:  the store which changes are spilled to
+        :param spill_interval_seconds:  how often changes are spilled
+        :param max_unspilled_changes:  once more changes than this are only in memory, the worker which stores one more
+                                       spills them, and waits for it. Bounds the memory the store takes, along with
+                                       exceptions which are not spilled yet
+        :param spill_on_signals:  signals on which changes are spilled, before the signal is handled as it was before.
+                                  A handler is installed once for each signal, and serves all open tiered stores. It
+                                  can only be installed from the main thread, elsewhere signals are left as they are
+        """
+        self.backing_store = backing_store
+        self._spill_interval_seconds = spill_interval_seconds
+        self._max_unspilled_changes = max_unspilled_changes
+        self._lock = threading.Lock()
+        # taken for the whole of a spill, so that spills write in the order changes were made, and by reads of running
+        # executions, which would otherwise miss changes which are being spilled
+        self._spill_lock = threading.RLock()
+        # execution id -> worker id -> _UnspilledChanges, of running executions
+        self._executions = {}
+        # (execution id, worker id) -> _UnspilledChanges which are not empty, in the order they last changed
+        self._changed_workers = OrderedDict()
+        # (execution id, exception) which are not spilled yet
+        self._unspilled_exceptions = []
+        self._unspilled_changes = 0
+
+        self._closed = threading.Event()
+        self._spill_requested = threading.Event()
+        # the spiller references the store weakly, so that it stops once the store is dropped
+        self._spiller = threading.Thread(
+            target=_spill_periodically,
+            args=(weakref.ref(self), self._closed, self._spill_requested, spill_interval_seconds),
+            name='pylo-spiller', daemon=True)
+        self._spiller.start()
+        self.spill_on_signals = frozenset(spill_on_signals)
+        _register_open_store(self)
+
+    def store_worker_state(self, execution_id, worker_id, task_execution_state):
+        if isinstance(task_execution_state, PyloBitmapExecutionState):
+            self.backing_store.store_worker_state(execution_id, worker_id, task_execution_state)
+            return
+
+        key = (str(execution_id), str(worker_id))
+        with self._lock:
+            changes = self._executions.get(key[0], {}).get(key[1])
+            if changes is not None:
+                journal = task_execution_state.take_journal()
+                changes.add(journal, task_execution_state)
+                self._changed_workers[key] = changes
+                self._changed_workers.move_to_end(key)
+                self._unspilled_changes += len(journal)
+                must_spill = self._unspilled_changes > self._max_unspilled_changes
+
+        if changes is None:
+            # new workers are written through, so that their inputs are never only in memory
+            with self._spill_lock:
+                self.backing_store.store_worker_state(execution_id, worker_id, task_execution_state)
+                with self._lock:
+                    self._executions.setdefault(key[0], {})[key[1]] = \
+                        _UnspilledChanges(execution_id, worker_id, task_execution_state.stream_offset)
+        elif must_spill:
+            self.spill()
+
+    def store_task_exception(self, execution_id, exception):
+        with self._lock:
+            if str(execution_id) not in self._executions:
+                must_spill = None
+            else:
+                self._unspilled_exceptions.append((execution_id, exception))
+                self._unspilled_changes += 1
+                must_spill = self._unspilled_changes > self._max_unspilled_changes
+
+        if must_spill is None:
+            self.backing_store.store_task_exception(execution_id, exception)
+        elif must_spill:
+            self.spill()
+
+    def spill(self):
+        """
+        Writes all changes which are only in memory to the backing store, and returns once they are written.
+        """
+        with self._spill_lock:
+            with self._lock:
+                changed_workers = list(self._changed_workers.values())
+                taken_changes = [changes.take() for changes in changed_workers]
+                self._changed_workers.clear()
+                exceptions, self._unspilled_exceptions = self._unspilled_exceptions, []
+                self._unspilled_changes = 0
+
+            for index, (changes, taken) in enumerate(zip(changed_workers, taken_changes)):
+                try:
+                    worker_state = taken.apply_to(
+                        self.backing_store.load_worker_state(changes.execution_id, changes.worker_id))
+                    self.backing_store.store_worker_state(changes.execution_id, changes.worker_id, worker_state)
+                except Exception:
+                    self._keep_unspilled(changed_workers[index:], taken_changes[index:], exceptions)
+                    raise
+            for index, (execution_id, exception) in enumerate(exceptions):
+                try:
+                    self.backing_store.store_task_exception(execution_id, exception)
+                except Exception:
+                    self._keep_unspilled([], [], exceptions[index:])
+                    raise
+
+    def _keep_unspilled(self, changed_workers, taken_changes, exceptions):
+        """
+        Puts changes which failed to be spilled back in memory, in front of newer changes, for the next spill to retry.
+        """
+        with self._lock:
+            for changes, taken in reversed(list(zip(changed_workers, taken_changes))):
+                changes.prepend(taken)
+                key = (str(changes.execution_id), str(changes.worker_id))
+                self._changed_workers[key] = changes
+                self._changed_workers.move_to_end(key, last=False)
+                self._unspilled_changes += len(taken.journal)
+            self._unspilled_exceptions[:0] = exceptions
+            self._unspilled_changes += len(exceptions)
+
+    def close(self):
+        """
+        Stops spilling in the background, and spills what is left. It is called when the process exits.
+        """
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._spill_requested.set()
+        self._spiller.join()
+        self.spill()
+        with _open_stores_lock:
+            _open_stores.discard(self)
+
+    def finish_execution(self, execution_id):
+        self.spill()
+        self.backing_store.finish_execution(execution_id)
+        with self._lock:
+            self._executions.pop(str(execution_id), None)
+
+    def load_whole_state(self, execution_id):
+        with self._spill_lock:
+            unspilled_changes = self._unspilled_changes_of(execution_id)
+            if unspilled_changes is None:
+                return self.backing_store.load_whole_state(execution_id)
+
+            worker_states = [
+                changes.apply_to(self.backing_store.load_worker_state(execution_id, changes.worker_id), journaled=False)
+                for changes in unspilled_changes]
+        state = PyloExecutionState.merge(execution_id, worker_states)
+        parent_execution_id = self.backing_store.load_parent_execution(execution_id)
+        if parent_execution_id is not None:
+            state.finished_inputs = list(self.backing_store.iter_inputs(parent_execution_id, finished=True)) + \
+                state.finished_inputs
+        return state
+
+    def load_worker_state(self, execution_id, worker_id):
+        with self._spill_lock:
+            with self._lock:
+                changes = self._executions.get(str(execution_id), {}).get(str(worker_id))
+                changes = changes.copy() if changes is not None else None
+            worker_state = self.backing_store.load_worker_state(execution_id, worker_id)
+            return changes.apply_to(worker_state, journaled=False) if changes is not None else worker_state
+
+    def iter_inputs(self, execution_id, finished):
+        with self._spill_lock:
+            if self._unspilled_changes_of(execution_id) is not None:
+                return super().iter_inputs(execution_id, finished)
+            return self.backing_store.iter_inputs(execution_id, finished)
+
+    def load_inputs_page(self, execution_id, finished, offset, limit):
+        with self._spill_lock:
+            if self._unspilled_changes_of(execution_id) is not None:
+                return super().load_inputs_page(execution_id, finished, offset, limit)
+            return self.backing_store.load_inputs_page(execution_id, finished, offset, limit)
+
+    def count_inputs(self, execution_id):
+        with self._spill_lock:
+            if self._unspilled_changes_of(execution_id) is not None:
+                return super().count_inputs(execution_id)
+            return self.backing_store.count_inputs(execution_id)
+
+    def load_stream_offset(self, execution_id):
+        with self._spill_lock:
+            if self._unspilled_changes_of(execution_id) is not None:
+                return super().load_stream_offset(execution_id)
+            return self.backing_store.load_stream_offset(execution_id)
+
+    def load_failed_attempts(self, execution_id):
+        with self._spill_lock:
+            if self._unspilled_changes_of(execution_id) is not None:
+                return super().load_failed_attempts(execution_id)
+            return self.backing_store.load_failed_attempts(execution_id)
+
+    def load_task_exceptions(self, execution_id):
+        return [exception for exception, _ in self.load_task_exception_counts(execution_id)]
+
+    def load_task_exception_counts(self, execution_id):
+        # exceptions which are being spilled are in neither place, so we wait for the spill
+        with self._spill_lock, self._lock:
+            unspilled_exceptions = [(exception, 1) for exceptions_execution_id, exception in self._unspilled_exceptions
+                                    if str(exceptions_execution_id) == str(execution_id)]
+            return self.backing_store.load_task_exception_counts(execution_id) + unspilled_exceptions
+
+    @property
+    def supports_parent_references(self):
+        return self.backing_store.supports_parent_references
+
+    def store_parent_execution(self, execution_id, parent_execution_id):
+        self.backing_store.store_parent_execution(execution_id, parent_execution_id)
+
+    def load_parent_execution(self, execution_id):
+        return self.backing_store.load_parent_execution(execution_id)
+
+    def flatten_execution(self, execution_id):
+        self.backing_store.flatten_execution(execution_id)
+
+    def load_bitmap_state(self, execution_id):
+        return self.backing_store.load_bitmap_state(execution_id)
+
+    @property
+    def supports_leases(self):
+        return self.backing_store.supports_leases
+
+    def create_leases(self, execution_id, shard_ids):
+        self.backing_store.create_leases(execution_id, shard_ids)
+
+    def acquire_lease(self, execution_id, shard_id, owner, lease_seconds):
+        return self.backing_store.acquire_lease(execution_id, shard_id, owner, lease_seconds)
+
+    def release_lease(self, execution_id, shard_id, owner, done):
+        self.backing_store.release_lease(execution_id, shard_id, owner, done)
+
+    def load_leases(self, execution_id):
+        return self.backing_store.load_leases(execution_id)
+
+    @property
+    def supports_task_durations(self):
+        return self.backing_store.supports_task_durations
+
+    def store_task_durations(self, execution_id, durations):
+        self.backing_store.store_task_durations(execution_id, durations)
+
+    def load_task_durations(self, execution_id):
+        return self.backing_store.load_task_durations(execution_id)
+
+    def _unspilled_changes_of(self, execution_id):
+        """
+        :return:  copies of changes of each worker of the given execution, or None if the execution is not running or
+                  has no unspilled changes, so that the backing store is up to date. The caller has to hold the spill
+                  lock, so that no changes are being spilled
+        """
+        with self._lock:
+            workers_changes = self._executions.get(str(execution_id), {}).values()
+            if not any(changes.journal for changes in workers_changes):
+                return None
+            return [changes.copy() for changes in workers_changes]
+
+
+def _spill_periodically(store_reference, closed, spill_requested, spill_interval_seconds):
+    while not closed.is_set():
+        spill_requested.wait(spill_interval_seconds)
+        spill_requested.clear()
+        store = store_reference()
+        if store is None:
+            return
+        try:
+            store.spill()
+        except Exception as e:
+            _logger.error(f'Failed to spill changes to the backing store, they will be retried with the next '
+                          f'spill. Failure message: {str(e)}')
+        del store
+
+
+def _register_open_store(store):
+    with _open_stores_lock:
+        _open_stores.add(store)
+        missing_handlers = store.spill_on_signals - _previous_signal_handlers.keys()
+        if not missing_handlers:
+            return
+        if threading.current_thread() is not threading.main_thread():
+            _logger.warning('Signal handlers can only be installed from the main thread, so changes are not spilled '
+                            'on signals')
+            return
+        for signal_number in missing_handlers:
+            # handlers which were not installed from Python are None
+            _previous_signal_handlers[signal_number] = \
+                signal.signal(signal_number, _spill_open_stores_on_signal) or signal.SIG_DFL
+
+
+def _close_open_stores():
+    with _open_stores_lock:
+        stores = list(_open_stores)
+    for store in stores:
+        try:
+            store.close()
+        except Exception as e:
+            _logger.error(f'Failed to spill changes to the backing store on exit. Failure message: {str(e)}')
+
+
+def _spill_open_stores_on_signal(signal_number, frame):
+    # the signal interrupts the main thread, which may hold locks of the stores, so the spill runs in another thread,
+    # which the handler gives up on after a while rather than deadlock
+    _logger.warning(f'Received signal {signal_number}, spilling changes to the backing store')
+    spill_thread = threading.Thread(target=_spill_stores_on_signal, args=(signal_number,), name='pylo-signal-spill',
+                                    daemon=True)
+    spill_thread.start()
+    spill_thread.join(SIGNAL_SPILL_TIMEOUT_SECONDS)
+    if spill_thread.is_alive():
+        _logger.error(f'Gave up waiting for changes to be spilled on signal {signal_number}')
+
+    previous_handler = _previous_signal_handlers.get(signal_number, signal.SIG_DFL)
+    if callable(previous_handler):
+        previous_handler(signal_number, frame)
+    elif previous_handler == signal.SIG_DFL:
+        signal.signal(signal_number, signal.SIG_DFL)
+        del _previous_signal_handlers[signal_number]
+        os.kill(os.getpid(), signal_number)
+
+
+def _spill_stores_on_signal(signal_number):
+    with _open_stores_lock:
+        stores = [store for store in _open_stores if signal_number in store.spill_on_signals]
+    for store in stores:
+        try:
+            store.spill()
+        except Exception as e:
+            _logger.error(f'Failed to spill changes to the backing store on signal {signal_number}. Failure message: '
+                          f'{str(e)}')
+
+
+def _forget_open_stores():
+    # a forked child has none of the spiller threads, and the lock may have been held by a thread which is gone
+    global _open_stores_lock
+    _open_stores_lock = threading.Lock()
+    _open_stores.clear()
+
+
+atexit.register(_close_open_stores)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_forget_open_stores)
+
+
+class _UnspilledChanges:
+    """
+    Changes of a worker state which are not spilled yet: its journal, and the stream offset and failed attempts of
+    inputs in the journal which the worker state had when it was last stored.
+    """
+    def __init__(self, execution_id, worker_id, stream_offset):
+        self.execution_id = execution_id
+        self.worker_id = worker_id
+        self.journal = []
+        self.stream_offset = stream_offset
+        # input key -> failed attempts, of inputs which failed or were assigned to the worker since the last spill
+        self.failed_attempts = {}
+
+    def add(self, journal, task_execution_state):
+        self.journal.extend(journal)
+        self.stream_offset = task_execution_state.stream_offset
+        for status, task_input in journal:
+            if status in (FINISHED, FAILED, _ASSIGNED):
+                key = _input_key(task_input)
+                attempts = task_execution_state.failed_attempts.get(key)
+                if attempts is None:
+                    self.failed_attempts.pop(key, None)
+                else:
+                    self.failed_attempts[key] = attempts
+
+    def take(self):
+        """
+        :return:  a copy of the changes, which are emptied
+        """
+        taken = self.copy()
+        self.journal = []
+        self.failed_attempts = {}
+        return taken
+
+    def copy(self):
+        changes = _UnspilledChanges(self.execution_id, self.worker_id, self.stream_offset)
+        changes.journal = list(self.journal)
+        changes.failed_attempts = dict(self.failed_attempts)
+        return changes
+
+    def prepend(self, older_changes):
+        """
+        Puts older changes, which failed to be spilled, in front of these.
+        """
+        finished_keys = {_input_key(task_input) for status, task_input in self.journal if status == FINISHED}
+        failed_attempts = {key: attempts for key, attempts in older_changes.failed_attempts.items()
+                           if key not in finished_keys}
+        failed_attempts.update(self.failed_attempts)
+        self.journal[:0] = older_changes.journal
+        self.failed_attempts = failed_attempts
+
+    def apply_to(self, worker_state, journaled=True):
+        """
+        Applies the changes to the state of the worker as it is in the backing store.
+        :param journaled:  if set to true, the changes are left in the journal of the state, for the backing store to
+                           persist them
+        :return:  the given state
+        """
+        worker_state.replay_journal(self.journal)
+        for key, attempts in self.failed_attempts.items():
+            worker_state.failed_attempts[key] = attempts
+        worker_state.stream_offset = self.stream_offset
+        if journaled:
+            worker_state.prepend_journal(list(self.journal))
+        return worker_state
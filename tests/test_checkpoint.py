@@ -0,0 +1,123 @@
+# coding=utf-8
+import threading
+
+import pytest
+
+from pylo.checkpoint import PyloCheckpointer
+from pylo.state import PyloExecutionState, PyloFileSystemExecutionStore
+
+
+def test_stores_latest_snapshot_with_journals_of_older_ones(tmpdir):
+    store = PyloFileSystemExecutionStore(tmpdir, journaled=True)
+    state = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[1, 2, 3, 4])
+    store.store_worker_state(execution_id=1, worker_id=1, task_execution_state=state)
+    under_test = PyloCheckpointer(store, interval_seconds=60)
+
+    state.mark_finished(state.next_unfinished())
+    under_test.submit(1, 1, state.snapshot())
+    state.mark_failed(state.next_unfinished())
+    under_test.submit(1, 1, state.snapshot(), wait=True)
+
+    assert store.load_worker_state(execution_id=1, worker_id=1) == state
+    under_test.close()
+
+
+def test_applies_changes_of_added_workers_to_its_copy_of_their_states(tmpdir):
+    store = PyloFileSystemExecutionStore(tmpdir, journaled=True)
+    state = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[1, 2, 3, 4])
+    store.store_worker_state(execution_id=1, worker_id=1, task_execution_state=state)
+    under_test = PyloCheckpointer(store, interval_seconds=60)
+    under_test.add_worker(1, 1, state)
+
+    state.mark_finished(state.next_unfinished())
+    under_test.submit_changes(1, 1, state.take_journal(), state.stream_offset)
+    state.mark_failed(state.next_unfinished())
+    in_flight_input = state.next_unfinished()
+    under_test.submit_changes(1, 1, state.take_journal(), state.stream_offset, wait=True)
+
+    assert store.load_worker_state(execution_id=1, worker_id=1) == \
+        PyloExecutionState(execution_id=1, finished_inputs=[1], unfinished_inputs=[in_flight_input, 4, 2])
+    under_test.close()
+
+
+def test_asks_sources_for_snapshots_every_interval(tmpdir):
+    store = PyloFileSystemExecutionStore(tmpdir)
+    state = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[1, 2])
+    state.mark_finished(state.next_unfinished())
+    checkpointed = threading.Event()
+
+    def checkpoint():
+        under_test.submit(1, 1, state.snapshot())
+        checkpointed.set()
+
+    under_test = PyloCheckpointer(store, interval_seconds=0.01)
+    under_test.add_source(checkpoint)
+
+    assert checkpointed.wait(timeout=5)
+    under_test.close()
+    assert store.load_worker_state(execution_id=1, worker_id=1) == state
+
+
+def test_retries_snapshots_which_failed_to_store(tmpdir):
+    store = FailingOnceStore(tmpdir, journaled=True)
+    state = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[1, 2, 3])
+    store.store_worker_state(execution_id=1, worker_id=1, task_execution_state=state)
+    store.fail_next = True
+    under_test = PyloCheckpointer(store, interval_seconds=60)
+
+    state.mark_finished(state.next_unfinished())
+    with pytest.raises(IOError):
+        under_test.submit(1, 1, state.snapshot(), wait=True)
+    state.mark_finished(state.next_unfinished())
+    under_test.submit(1, 1, state.snapshot(), wait=True)
+
+    assert store.load_worker_state(execution_id=1, worker_id=1) == state
+    under_test.close()
+
+
+def test_close_retries_pending_snapshots_once_and_raises_if_they_fail(tmpdir):
+    store = FailingOnceStore(tmpdir, journaled=True)
+    state = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[1, 2, 3])
+    store.store_worker_state(execution_id=1, worker_id=1, task_execution_state=state)
+    under_test = PyloCheckpointer(store, interval_seconds=60)
+    store.fail_next = True
+    state.mark_finished(state.next_unfinished())
+    under_test.submit(1, 1, state.snapshot())
+    under_test.close()
+    assert store.load_worker_state(execution_id=1, worker_id=1) == state
+
+    store.fail_always = True
+    under_test = PyloCheckpointer(store, interval_seconds=60)
+    state.mark_finished(state.next_unfinished())
+    under_test.submit(1, 1, state.snapshot())
+    with pytest.raises(IOError):
+        under_test.close()
+
+
+def test_retries_changes_which_failed_to_store(tmpdir):
+    store = FailingOnceStore(tmpdir, journaled=True)
+    state = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[1, 2, 3])
+    store.store_worker_state(execution_id=1, worker_id=1, task_execution_state=state)
+    under_test = PyloCheckpointer(store, interval_seconds=60)
+    under_test.add_worker(1, 1, state)
+    store.fail_next = True
+
+    state.mark_finished(state.next_unfinished())
+    with pytest.raises(IOError):
+        under_test.submit_changes(1, 1, state.take_journal(), state.stream_offset, wait=True)
+    state.mark_finished(state.next_unfinished())
+    under_test.submit_changes(1, 1, state.take_journal(), state.stream_offset, wait=True)
+
+    assert store.load_worker_state(execution_id=1, worker_id=1) == state
+    under_test.close()
+
+
+class FailingOnceStore(PyloFileSystemExecutionStore):
+    fail_next = False
+    fail_always = False
+
+    def store_worker_state(self, execution_id, worker_id, task_execution_state):
+        if self.fail_next or self.fail_always:
+            self.fail_next = False
+            raise IOError('I run out of disk space')
+        super().store_worker_state(execution_id, worker_id, task_execution_state)
@@ -0,0 +1,48 @@
+# coding=utf-8
+import pytest
+
+from pylo.codec import CompressedCodec, Int64Codec, LinesCodec, PickleCodec, VarintCodec, get_codec
+
+
+@pytest.mark.parametrize('codec, task_inputs', [
+    (PickleCodec(), [1, 'a', (2, 'b'), None]),
+    (Int64Codec(), [5, -3, 2 ** 40, 0]),
+    (VarintCodec(), [5, -3, 2 ** 70, 0, 1, 2, 3]),
+    (LinesCodec(), ['a', '', 'ąę', 'b c']),
+    (CompressedCodec(VarintCodec()), list(range(1000))),
+])
+def test_encodes_and_decodes_inputs(codec, task_inputs):
+    assert codec.decode_inputs(codec.encode_inputs(task_inputs)) == task_inputs
+    assert codec.decode_inputs(codec.encode_inputs([])) == []
+
+
+def test_varint_encodes_ranges_with_a_byte_per_input():
+    assert len(VarintCodec().encode_inputs(range(1000))) == 1000
+
+
+@pytest.mark.parametrize('codec, task_inputs', [
+    (Int64Codec(), ['a']),
+    (Int64Codec(), [2 ** 70]),
+    (VarintCodec(), [True]),
+    (LinesCodec(), [1]),
+    (LinesCodec(), ['a\nb']),
+])
+def test_rejects_unsupported_inputs(codec, task_inputs):
+    with pytest.raises((TypeError, ValueError, OverflowError)):
+        codec.encode_inputs(task_inputs)
+
+
+def test_finds_codecs_by_name():
+    codec = get_codec('lines+gzip')
+
+    assert codec.name == 'lines+gzip'
+    assert codec.decode_object(codec.encode_object(Exception('I run out of memory'))).args == ('I run out of memory',)
+    with pytest.raises(ValueError):
+        get_codec('morse')
+
+
+def test_zstd_compression():
+    pytest.importorskip('zstandard')
+    codec = get_codec('int64+zstd')
+
+    assert codec.decode_inputs(codec.encode_inputs(list(range(1000)))) == list(range(1000))
@@ -0,0 +1,50 @@
+# coding=utf-8
+import pytest
+
+from pylo.concurrency import PyloConcurrencyController
+
+
+def run_round(controller, latency_seconds=0.01, failed=False):
+    for _ in range(controller.concurrency):
+        controller.acquire()
+    for _ in range(controller.concurrency):
+        controller.release(latency_seconds, failed)
+
+
+def test_increases_concurrency_additively_while_tasks_succeed():
+    under_test = PyloConcurrencyController(min_concurrency=1, max_concurrency=3)
+
+    for expected_concurrency in [2, 3, 3]:
+        run_round(under_test)
+        assert under_test.concurrency == expected_concurrency
+    assert [concurrency for _, concurrency in under_test.history] == [1, 2, 3]
+
+
+def test_decreases_concurrency_multiplicatively_on_failures_and_latency():
+    under_test = PyloConcurrencyController(min_concurrency=2, max_concurrency=8)
+    for _ in range(6):
+        run_round(under_test)
+    assert under_test.concurrency == 8
+
+    run_round(under_test, failed=True)
+    assert under_test.concurrency == 4
+    run_round(under_test, latency_seconds=1.0)
+    assert under_test.concurrency == 2
+    run_round(under_test, latency_seconds=1.0)
+    assert under_test.concurrency == 2
+
+
+def test_reports_changes_of_concurrency():
+    changes = []
+    under_test = PyloConcurrencyController(min_concurrency=1, max_concurrency=2, on_change=changes.append)
+
+    for _ in range(3):
+        run_round(under_test)
+    run_round(under_test, failed=True)
+
+    assert changes == [2, 1]
+
+
+def test_rejects_invalid_bounds():
+    with pytest.raises(ValueError):
+        PyloConcurrencyController(min_concurrency=3, max_concurrency=2)
@@ -0,0 +1,132 @@
+import multiprocessing
+import os
+
+import pytest
+
+from pylo.execution import Pylo
+from pylo.executor import PyloDistributedExecutor
+from pylo.state import PyloFileSystemExecutionStore
+
+
+@pytest.mark.parametrize('sqlite_store', [False, True])
+def test_nodes_run_execution_together(tmpdir, sqlite_store):
+    task_inputs = [i for i in range(1, 200)]
+    pylo = Pylo.distributed(tmpdir, number_of_workers=2, sqlite_store=sqlite_store, task_executions_before_flush=10)
+    execution_id = pylo.create_execution(task_inputs)
+
+    nodes = [multiprocessing.Process(target=join_node, args=(str(tmpdir), sqlite_store, execution_id, node_id))
+             for node_id in ['first', 'second', 'third']]
+    for node in nodes:
+        node.start()
+    for node in nodes:
+        node.join()
+
+    assert [node.exitcode for node in nodes] == [0, 0, 0]
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert sorted(finished_inputs) == task_inputs
+    assert unfinished_inputs == []
+    # no node crashed, so every input ran once, except for the retry of the input which failed
+    assert sorted(read_ran_inputs(tmpdir, ['first', 'second', 'third'])) == sorted(task_inputs + [11])
+    assert [str(e) for e in pylo.get_exceptions(execution_id)] == ['Failed to run 11 on the first attempt']
+
+
+@pytest.mark.parametrize('sqlite_store', [False, True])
+def test_node_takes_over_shards_of_crashed_node(tmpdir, sqlite_store):
+    task_inputs = [i for i in range(1, 100)]
+    pylo = Pylo.distributed(tmpdir, number_of_workers=1, number_of_shards=5, lease_seconds=0.5,
+                            sqlite_store=sqlite_store, task_executions_before_flush=1)
+    execution_id = pylo.create_execution(task_inputs)
+
+    crashing_node = multiprocessing.Process(target=join_crashing_node, args=(str(tmpdir), sqlite_store, execution_id))
+    crashing_node.start()
+    crashing_node.join()
+    assert crashing_node.exitcode == 1
+
+    pylo.join_execution(execution_id, InputRecorder(str(tmpdir), 'survivor'))
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert sorted(finished_inputs) == task_inputs
+    assert unfinished_inputs == []
+    crashed_node_inputs = read_ran_inputs(tmpdir, ['crashed'])
+    survivor_inputs = read_ran_inputs(tmpdir, ['survivor'])
+    assert 42 in survivor_inputs
+    # inputs of the crashed node were snapshotted after every task, so only the input it crashed on ran twice
+    assert set(crashed_node_inputs) & set(survivor_inputs) == {42}
+
+
+def test_workers_keep_their_context_across_shards(tmpdir):
+    contexts = []
+    pylo = Pylo.distributed(tmpdir, number_of_workers=2, number_of_shards=8,
+                            worker_initializer=lambda: contexts.append({'inputs': [], 'closed': False}) or contexts[-1],
+                            worker_finalizer=lambda context: context.update(closed=True))
+    execution_id = pylo.create_execution([i for i in range(1, 100)])
+
+    pylo.join_execution(execution_id, lambda n, context: context['inputs'].append(n))
+
+    assert len(contexts) == 2
+    assert sorted(n for context in contexts for n in context['inputs']) == [i for i in range(1, 100)]
+    assert all(context['closed'] for context in contexts)
+
+
+def test_join_execution_requires_shards(tmpdir):
+    pylo = Pylo.distributed(tmpdir, number_of_workers=1)
+    execution_id = Pylo.local_multithread(tmpdir, number_of_workers=1).start_from_scratch([1, 2], InputRecorder(
+        str(tmpdir), 'local'))
+
+    with pytest.raises(ValueError):
+        pylo.join_execution(execution_id, InputRecorder(str(tmpdir), 'node'))
+
+
+def test_store_has_to_support_leases(tmpdir):
+    pylo = Pylo(PyloDistributedExecutor(1, max_worker_failures=1, executions_before_flush=1, store_exceptions=True),
+                StoreWithoutLeases(tmpdir))
+
+    with pytest.raises(ValueError):
+        pylo.create_execution([1, 2])
+    assert os.listdir(tmpdir) == []
+
+
+def join_node(store_dir, sqlite_store, execution_id, node_id):
+    pylo = Pylo.distributed(store_dir, number_of_workers=2, node_id=node_id, sqlite_store=sqlite_store,
+                            task_executions_before_flush=10)
+    pylo.join_execution(execution_id, InputRecorder(store_dir, node_id, fail_first_attempt_of=11))
+
+
+def join_crashing_node(store_dir, sqlite_store, execution_id):
+    pylo = Pylo.distributed(store_dir, number_of_workers=1, lease_seconds=0.5, sqlite_store=sqlite_store,
+                            task_executions_before_flush=1)
+    pylo.join_execution(execution_id, InputRecorder(store_dir, 'crashed', crash_on=42))
+
+
+class InputRecorder:
+    """
+    Task which appends its input to a file per node, so that tests can tell which node ran which inputs.
+    """
+    def __init__(self, store_dir, node_id, crash_on=None, fail_first_attempt_of=None):
+        self.ran_inputs_file = os.path.join(store_dir, f'ran-{node_id}')
+        self.crash_on = crash_on
+        self.fail_first_attempt_of = fail_first_attempt_of
+        self.failed = False
+
+    def __call__(self, n):
+        with open(self.ran_inputs_file, 'a') as rf:
+            rf.write(f'{n}\n')
+        if n == self.crash_on:
+            os._exit(1)
+        if n == self.fail_first_attempt_of and not self.failed:
+            self.failed = True
+            raise ValueError(f'Failed to run {n} on the first attempt')
+
+
+def read_ran_inputs(store_dir, node_ids):
+    ran_inputs = []
+    for node_id in node_ids:
+        ran_inputs_file = os.path.join(str(store_dir), f'ran-{node_id}')
+        if os.path.exists(ran_inputs_file):
+            with open(ran_inputs_file) as rf:
+                ran_inputs.extend(int(line) for line in rf)
+    return ran_inputs
+
+
+class StoreWithoutLeases(PyloFileSystemExecutionStore):
+    supports_leases = False
@@ -0,0 +1,111 @@
+import asyncio
+import os
+
+import pytest
+
+from pylo.execution import Pylo
+
+
+def test_multiple_inputs(tmpdir):
+    fetcher = SlowFetcher()
+    inputs = [i for i in range(1, 2000)]
+
+    pylo = Pylo.local_asyncio(tmpdir, max_concurrency=500, task_executions_before_flush=100)
+    execution_id = pylo.start_from_scratch(inputs, fetcher.fetch)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert sorted(finished_inputs) == inputs
+    assert unfinished_inputs == []
+    assert sorted(fetcher.inputs_history) == inputs
+
+
+def test_concurrency_is_bounded(tmpdir):
+    fetcher = SlowFetcher()
+
+    pylo = Pylo.local_asyncio(tmpdir, max_concurrency=10)
+    pylo.start_from_scratch([i for i in range(1, 200)], fetcher.fetch)
+
+    assert fetcher.max_concurrent_fetches == 10
+
+
+@pytest.mark.parametrize('store_kind', [
+    {}, {'journaled_store': True}, {'sqlite_store': True}, {'spill_interval_seconds': 60},
+])
+def test_resume_when_failed(tmpdir, store_kind):
+    inputs = [i for i in range(1, 100)]
+    fail_for_inputs = [11, 56]
+
+    pylo = Pylo.local_asyncio(
+        tmpdir, max_concurrency=10, max_worker_failures=4, task_executions_before_flush=5, **store_kind)
+    execution_id = pylo.start_from_scratch(inputs, SlowFetcher(fail_for_inputs).fetch)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert len(finished_inputs) == len(inputs) - len(fail_for_inputs)
+    assert sorted(unfinished_inputs) == fail_for_inputs
+    assert len(pylo.get_exceptions(execution_id)) >= 4
+
+    new_execution_id = pylo.start_from_past_execution(execution_id, SlowFetcher().fetch)
+    finished_inputs, unfinished_inputs = pylo.get_state(new_execution_id)
+    assert sorted(finished_inputs) == inputs
+    assert unfinished_inputs == []
+
+
+def test_streamed_inputs(tmpdir):
+    fetcher = SlowFetcher()
+
+    pylo = Pylo.local_asyncio(tmpdir, max_concurrency=20, task_executions_before_flush=50)
+    execution_id = pylo.start_from_scratch((i for i in range(1, 500)), fetcher.fetch, stream_inputs=True)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id, task_inputs=range(1, 500))
+    assert sorted(finished_inputs) == list(range(1, 500))
+    assert unfinished_inputs == []
+
+
+def test_worker_context_is_shared_by_all_tasks(tmpdir):
+    sessions = []
+
+    async def open_session():
+        await asyncio.sleep(0)
+        sessions.append({'fetches': 0, 'closed': False})
+        return sessions[-1]
+
+    async def close_session(session):
+        session['closed'] = True
+
+    async def fetch(task_input, session):
+        await asyncio.sleep(0.001)
+        session['fetches'] += 1
+
+    pylo = Pylo.local_asyncio(tmpdir, max_concurrency=10, worker_initializer=open_session,
+                              worker_finalizer=close_session)
+    execution_id = pylo.start_from_scratch([i for i in range(1, 100)], fetch)
+
+    assert pylo.get_state(execution_id)[1] == []
+    assert sessions == [{'fetches': 99, 'closed': True}]
+
+
+def test_rejects_task_functions_which_are_not_coroutine_functions(tmpdir):
+    pylo = Pylo.local_asyncio(tmpdir, max_concurrency=10)
+
+    with pytest.raises(TypeError):
+        pylo.start_from_scratch([i for i in range(1, 100)], lambda task_input: None)
+    assert os.listdir(tmpdir) == []
+
+
+class SlowFetcher:
+    def __init__(self, fail_for_inputs=()):
+        self.inputs_history = []
+        self.max_concurrent_fetches = 0
+        self._concurrent_fetches = 0
+        self._fail_for_inputs = fail_for_inputs
+
+    async def fetch(self, task_input):
+        self._concurrent_fetches += 1
+        self.max_concurrent_fetches = max(self.max_concurrent_fetches, self._concurrent_fetches)
+        try:
+            await asyncio.sleep(0.001)
+            if task_input in self._fail_for_inputs:
+                raise Exception(f'Failed to fetch {task_input}')
+            self.inputs_history.append(task_input)
+        finally:
+            self._concurrent_fetches -= 1
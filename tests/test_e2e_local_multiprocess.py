@@ -0,0 +1,121 @@
+import os
+
+import pytest
+
+from pylo.execution import Pylo
+
+
+def test_multiple_inputs(tmpdir):
+    numbers_to_factories = [i for i in range(1, 10000)]
+
+    pylo = Pylo.local_multiprocess(tmpdir, number_of_workers=2)
+    execution_id = pylo.start_from_scratch(numbers_to_factories, compute_factors)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert sorted(finished_inputs) == numbers_to_factories
+    assert unfinished_inputs == []
+
+
+@pytest.mark.parametrize('store_kind', [
+    {}, {'journaled_store': True}, {'sqlite_store': True}, {'spill_interval_seconds': 60},
+])
+def test_resume_when_failed(tmpdir, store_kind):
+    numbers_to_factories = [i for i in range(1, 100)]
+
+    pylo = Pylo.local_multiprocess(
+        tmpdir, number_of_workers=2, max_worker_failures=2, task_executions_before_flush=7, **store_kind)
+    execution_id = pylo.start_from_scratch(numbers_to_factories, fail_for_11_and_56)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert len(finished_inputs) == len(numbers_to_factories) - 2
+    assert sorted(unfinished_inputs) == [11, 56]
+
+    new_execution_id = pylo.start_from_past_execution(execution_id, compute_factors)
+    finished_inputs, unfinished_inputs = pylo.get_state(new_execution_id)
+    assert sorted(finished_inputs) == numbers_to_factories
+    assert unfinished_inputs == []
+
+
+@pytest.mark.parametrize('sqlite_store', [False, True])
+def test_bitmap_state_resume_when_failed(tmpdir, sqlite_store):
+    numbers_to_factories = range(1, 100)
+
+    # both failing inputs are in the part of the first worker
+    pylo = Pylo.local_multiprocess(
+        tmpdir, number_of_workers=2, max_worker_failures=3, task_executions_before_flush=7, sqlite_store=sqlite_store)
+    execution_id = pylo.start_from_scratch(numbers_to_factories, fail_for_11_and_56, bitmap_state=True)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert len(finished_inputs) == len(numbers_to_factories) - 2
+    assert sorted(unfinished_inputs) == [11, 56]
+
+    new_execution_id = pylo.start_from_past_execution(execution_id, compute_factors)
+    finished_inputs, unfinished_inputs = pylo.get_state(new_execution_id)
+    assert sorted(finished_inputs) == list(numbers_to_factories)
+    assert unfinished_inputs == []
+
+
+def test_give_up_when_max_failures_exceeded(tmpdir):
+    pylo = Pylo.local_multiprocess(tmpdir, number_of_workers=2, max_worker_failures=10)
+    execution_id = pylo.start_from_scratch([1], always_fail)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert finished_inputs == []
+    assert unfinished_inputs == [1]
+    assert len(pylo.get_exceptions(execution_id)) == 10
+
+
+def test_loads_exceptions_when_failing(tmpdir):
+    pylo = Pylo.local_multiprocess(tmpdir, number_of_workers=1, max_worker_failures=1)
+    execution_id = pylo.start_from_scratch([i for i in range(1, 100)], fail_for_11_and_56)
+
+    exceptions = pylo.get_exceptions(execution_id)
+    assert [str(e) for e in exceptions] == ['Failed to compute factors for 11']
+
+
+def test_batched_task_function(tmpdir):
+    pylo = Pylo.local_multiprocess(tmpdir, number_of_workers=2, max_worker_failures=3, task_batch_size=8)
+    execution_id = pylo.start_from_scratch([i for i in range(1, 100)], fail_batches_with_11_and_56)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert sorted(finished_inputs) == [i for i in range(1, 100) if i not in (11, 56)]
+    assert sorted(unfinished_inputs) == [11, 56]
+
+
+def test_worker_context_is_created_in_worker_processes(tmpdir):
+    pylo = Pylo.local_multiprocess(tmpdir, number_of_workers=2, worker_initializer=os.getpid)
+    execution_id = pylo.start_from_scratch([i for i in range(1, 100)], compute_factors_in_initialized_process)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert sorted(finished_inputs) == [i for i in range(1, 100)]
+    assert unfinished_inputs == []
+
+
+def compute_factors_in_initialized_process(n, initialized_in_process):
+    if initialized_in_process != os.getpid():
+        raise Exception(f'Worker context of process {initialized_in_process} used in process {os.getpid()}')
+    return compute_factors(n)
+
+
+def compute_factors(n):
+    factors = set()
+    for i in range(1, int(n ** 0.5) + 1):
+        if n % i == 0:
+            factors.add(i)
+            factors.add(n // i)
+    return factors
+
+
+def fail_for_11_and_56(n):
+    if n in (11, 56):
+        raise Exception(f'Failed to compute factors for {n}')
+    return compute_factors(n)
+
+
+def always_fail(n):
+    raise Exception(f'Failed to compute factors for {n}')
+
+
+def fail_batches_with_11_and_56(numbers):
+    for n in numbers:
+        fail_for_11_and_56(n)
@@ -1,4 +1,12 @@
+import threading
+import time
+
+import pytest
+
 from pylo.execution import Pylo
+from pylo.executor import PyloLocalMultiThreadExecutor
+from pylo.metrics import PyloHooks, PyloMetrics
+from pylo.state import PyloFileSystemExecutionStore
 
 
 def test_single_input(tmpdir):
@@ -55,6 +63,235 @@ def test_resume_when_failed(tmpdir):
     assert unfinished_inputs == []
 
 
+@pytest.mark.parametrize('sqlite_store', [False, True])
+def test_resume_chain_and_flatten(tmpdir, sqlite_store):
+    numbers_to_factories = [i for i in range(1, 100)]
+
+    pylo = Pylo.local_multithread(tmpdir, number_of_workers=2, max_worker_failures=3, sqlite_store=sqlite_store)
+    execution_id = pylo.start_from_scratch(
+        numbers_to_factories, FailingFactorsCalculator([11, 56, 70]).compute_factors)
+    execution_id = pylo.start_from_past_execution(execution_id, FailingFactorsCalculator([56]).compute_factors)
+    successful_calc = FactorsCalculator()
+    execution_id = pylo.start_from_past_execution(execution_id, successful_calc.compute_factors)
+    assert successful_calc.inputs_history == [56]
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert sorted(finished_inputs) == numbers_to_factories
+    assert unfinished_inputs == []
+
+    pylo.flatten_execution(execution_id)
+    assert pylo.get_state(execution_id) == (finished_inputs, [])
+    assert pylo.count_inputs(execution_id) == (len(numbers_to_factories), 0)
+
+
+def test_resume_copies_past_state_when_store_does_not_support_references(tmpdir):
+    task_store = CopyingExecutionStore(tmpdir)
+    pylo = multithread_pylo(task_store)
+    execution_id = pylo.start_from_scratch(
+        [i for i in range(1, 100)], FailingFactorsCalculator([11, 56]).compute_factors)
+
+    new_execution_id = pylo.start_from_past_execution(execution_id, FactorsCalculator().compute_factors)
+    pylo.flatten_execution(new_execution_id)
+
+    assert task_store.load_parent_execution(new_execution_id) is None
+    assert sorted(task_store.load_whole_state(new_execution_id).finished_inputs) == [i for i in range(1, 100)]
+    assert pylo.count_inputs(new_execution_id) == (99, 0)
+
+
+def test_resume_stores_no_reference_when_past_state_fails_to_load(tmpdir):
+    pylo = multithread_pylo(PyloFileSystemExecutionStore(tmpdir))
+    execution_id = pylo.start_from_scratch(
+        [i for i in range(1, 100)], FailingFactorsCalculator([11, 56]).compute_factors)
+
+    pylo = multithread_pylo(UnreadableFailedAttemptsStore(tmpdir))
+    with pytest.raises(OSError):
+        pylo.start_from_past_execution(execution_id, FactorsCalculator().compute_factors)
+
+    assert [path for path in tmpdir.visit() if path.basename == 'parent'] == []
+
+
+@pytest.mark.parametrize('store_kind', [{}, {'journaled_store': True}, {'sqlite_store': True}])
+def test_background_checkpoints(tmpdir, store_kind):
+    numbers_to_factories = [i for i in range(1, 1000)]
+    fail_for_numbers = [11, 56]
+
+    pylo = Pylo.local_multithread(
+        tmpdir, number_of_workers=3, max_worker_failures=2, task_executions_before_flush=10,
+        checkpoint_interval_seconds=0.01, work_stealing=True, fsync_policy='always', **store_kind)
+    execution_id = pylo.start_from_scratch(
+        numbers_to_factories, FailingFactorsCalculator(fail_for_numbers).compute_factors)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert sorted(finished_inputs + unfinished_inputs) == numbers_to_factories
+    assert set(fail_for_numbers) <= set(unfinished_inputs)
+
+
+def test_checkpoints_progress_while_task_is_running(tmpdir):
+    release = threading.Event()
+
+    def wait_for_release(n):
+        if n == 4:
+            release.wait(timeout=10)
+
+    pylo = Pylo.local_multithread(
+        tmpdir, number_of_workers=1, task_executions_before_flush=None, checkpoint_interval_seconds=0.01)
+    pylo_thread = threading.Thread(target=pylo.start_from_scratch, args=([1, 2, 3, 4], wait_for_release))
+    pylo_thread.start()
+
+    reader = Pylo.local_multithread(tmpdir, number_of_workers=2)
+    execution_dir = tmpdir.join('pylo')
+    deadline = time.monotonic() + 10
+    finished_inputs = unfinished_inputs = []
+    while time.monotonic() < deadline and finished_inputs != [1, 2, 3]:
+        time.sleep(0.01)
+        executions = [path.basename for path in execution_dir.listdir()] if execution_dir.exists() else []
+        if executions:
+            finished_inputs, unfinished_inputs = reader.get_state(executions[0])
+
+    release.set()
+    pylo_thread.join()
+    # the input of the running task is stored as unfinished
+    assert finished_inputs == [1, 2, 3]
+    assert unfinished_inputs == [4]
+
+
+@pytest.mark.parametrize('codec', ['varint', 'int64+gzip'])
+def test_compact_codec(tmpdir, codec):
+    numbers_to_factories = [i for i in range(1, 100)]
+    fail_for_numbers = [11, 56]
+
+    pylo = Pylo.local_multithread(tmpdir, number_of_workers=2, max_worker_failures=2, journaled_store=True,
+                                  task_executions_before_flush=5, codec=codec)
+    execution_id = pylo.start_from_scratch(
+        numbers_to_factories, FailingFactorsCalculator(fail_for_numbers).compute_factors)
+    new_execution_id = pylo.start_from_past_execution(execution_id, FactorsCalculator().compute_factors)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(new_execution_id)
+    assert sorted(finished_inputs) == numbers_to_factories
+    assert unfinished_inputs == []
+    assert len(pylo.get_exceptions(execution_id)) >= len(fail_for_numbers)
+
+
+@pytest.mark.parametrize('sqlite_store,work_stealing', [(False, False), (False, True), (True, False)])
+def test_bitmap_state_resume_when_failed(tmpdir, sqlite_store, work_stealing):
+    numbers_to_factories = range(1, 10000)
+    fail_for_numbers = [11, 56, 9999]
+
+    pylo = Pylo.local_multithread(tmpdir, number_of_workers=3, max_worker_failures=3, sqlite_store=sqlite_store,
+                                  work_stealing=work_stealing)
+    execution_id = pylo.start_from_scratch(
+        numbers_to_factories, FailingFactorsCalculator(fail_for_numbers).compute_factors, bitmap_state=True)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert len(finished_inputs) == len(numbers_to_factories) - len(fail_for_numbers)
+    assert sorted(unfinished_inputs) == fail_for_numbers
+    assert pylo.count_inputs(execution_id) == (len(finished_inputs), len(fail_for_numbers))
+
+    calculator = FactorsCalculator()
+    new_execution_id = pylo.start_from_past_execution(execution_id, calculator.compute_factors)
+    finished_inputs, unfinished_inputs = pylo.get_state(new_execution_id)
+    assert sorted(calculator.inputs_history) == fail_for_numbers
+    assert sorted(finished_inputs) == list(numbers_to_factories)
+    assert unfinished_inputs == []
+
+
+def test_adaptive_concurrency(tmpdir):
+    numbers_to_factories = [i for i in range(1, 200)]
+    running = []
+    max_running = [0]
+    lock = threading.Lock()
+
+    def compute_factors(n):
+        with lock:
+            running.append(n)
+            max_running[0] = max(max_running[0], len(running))
+        time.sleep(0.001)
+        with lock:
+            running.remove(n)
+
+    metrics = PyloMetrics()
+    pylo = Pylo.local_multithread(tmpdir, number_of_workers=4, min_number_of_workers=1, work_stealing=True,
+                                  hooks=[metrics])
+    execution_id = pylo.start_from_scratch(numbers_to_factories, compute_factors)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert sorted(finished_inputs) == numbers_to_factories
+    assert unfinished_inputs == []
+    history = metrics.stats()['concurrency_history']
+    assert history[0][1] == 1
+    assert max_running[0] <= max(concurrency for _, concurrency in history)
+    assert metrics.stats()['concurrency'] == history[-1][1]
+
+
+def test_retries_failed_inputs_after_backoff(tmpdir):
+    numbers_to_factories = [i for i in range(1, 50)]
+    attempts_times = {}
+    lock = threading.Lock()
+
+    def compute_factors(n):
+        with lock:
+            attempts_times.setdefault(n, []).append(time.monotonic())
+            if len(attempts_times[n]) < 3 and n % 10 == 0:
+                raise Exception(f'Failed to compute factors for {n}')
+
+    pylo = Pylo.local_multithread(tmpdir, number_of_workers=2, retry_delay_seconds=0.05)
+    execution_id = pylo.start_from_scratch(numbers_to_factories, compute_factors)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert sorted(finished_inputs) == numbers_to_factories
+    assert unfinished_inputs == []
+    for n in [10, 20, 30, 40]:
+        first, second, third = attempts_times[n]
+        # the first delay is at least half of retry_delay_seconds, because of jitter, and the second one is doubled
+        assert second - first >= 0.025
+        assert third - second >= 0.05
+
+
+@pytest.mark.parametrize('sqlite_store', [False, True])
+@pytest.mark.parametrize('bitmap_state', [False, True])
+def test_stops_retrying_inputs_after_max_attempts(tmpdir, sqlite_store, bitmap_state):
+    numbers_to_factories = range(1, 100) if bitmap_state else [i for i in range(1, 100)]
+    calculator = FailingFactorsCalculator(only_fail_for_numbers=[13])
+
+    pylo = Pylo.local_multithread(tmpdir, number_of_workers=2, max_worker_failures=10, sqlite_store=sqlite_store,
+                                  retry_delay_seconds=0.001, max_attempts=3)
+    execution_id = pylo.start_from_scratch(numbers_to_factories, calculator.compute_factors, bitmap_state=bitmap_state)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert len(finished_inputs) == len(numbers_to_factories) - 1
+    assert unfinished_inputs == [13]
+    assert pylo.get_failed_attempts(execution_id) == {13: 3}
+
+    # attempts carry over to resumed executions, so the input is not retried again
+    calculator = FactorsCalculator()
+    new_execution_id = pylo.start_from_past_execution(execution_id, calculator.compute_factors)
+    assert calculator.inputs_history == []
+    assert pylo.get_state(new_execution_id)[1] == [13]
+
+
+def test_metrics_and_hooks(tmpdir):
+    numbers_to_factories = [i for i in range(1, 100)]
+    flushed_workers = set()
+
+    class FlushHook(PyloHooks):
+        def on_flush(self, execution_id, worker_id, seconds):
+            flushed_workers.add(worker_id)
+
+    metrics = PyloMetrics()
+    pylo = Pylo.local_multithread(tmpdir, number_of_workers=2, task_executions_before_flush=10,
+                                  hooks=[metrics, FlushHook()])
+    pylo.start_from_scratch(numbers_to_factories, FailingFactorsCalculator(only_fail_for_numbers=[50]).compute_factors)
+
+    stats = metrics.stats()
+    assert stats['tasks_completed'] == len(numbers_to_factories) - 1
+    assert stats['tasks_failed'] >= 1
+    assert sum(stats['latency_histogram'].values()) == stats['tasks_completed'] + stats['tasks_failed']
+    assert sorted(stats['workers']) == ['1', '2']
+    assert stats['store_calls']['store_worker_state']['calls'] >= stats['flushes']
+    assert stats['store_calls']['store_task_exception']['calls'] == stats['tasks_failed']
+    assert flushed_workers == {1, 2}
+
+
 def test_give_up_when_max_failures_exceeded(tmpdir):
     always_fail_calculator = FailingFactorsCalculator()
     numbers_to_factories = [1]
@@ -80,6 +317,18 @@ def test_loads_exceptions_when_failing(tmpdir):
     assert [str(e) for e in exceptions] == ['Failed to compute factors for 11', 'Failed to compute factors for 56']
 
 
+def test_deduplicates_and_caps_exceptions(tmpdir):
+    always_fail_calculator = FailingFactorsCalculator()
+
+    pylo = Pylo.local_multithread(
+        tmpdir, number_of_workers=2, max_worker_failures=50, deduplicate_exceptions=True, max_stored_exceptions=3)
+    execution_id = pylo.start_from_scratch([i for i in range(1, 10)], always_fail_calculator.compute_factors)
+
+    exception_counts = pylo.get_exception_counts(execution_id)
+    assert len(exception_counts) == 3
+    assert sum(count for _, count in exception_counts) >= 3
+
+
 def test_input_is_set(tmpdir):
     calculator = FactorsCalculator()
     numbers_to_factories = {1}
@@ -92,6 +341,339 @@ def test_input_is_set(tmpdir):
     assert unfinished_inputs == []
 
 
+def test_resume_when_failed_with_journaled_store(tmpdir):
+    numbers_to_factories = [i for i in range(1, 100)]
+    fail_for_numbers = [11, 56]
+
+    pylo = Pylo.local_multithread(
+        tmpdir, number_of_workers=2, max_worker_failures=2, task_executions_before_flush=5, journaled_store=True)
+    execution_id = pylo.start_from_scratch(
+        numbers_to_factories, FailingFactorsCalculator(fail_for_numbers).compute_factors)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert len(finished_inputs) == len(numbers_to_factories) - len(fail_for_numbers)
+    assert sorted(unfinished_inputs) == fail_for_numbers
+
+    new_execution_id = pylo.start_from_past_execution(execution_id, FactorsCalculator().compute_factors)
+    finished_inputs, unfinished_inputs = pylo.get_state(new_execution_id)
+    assert sorted(finished_inputs) == numbers_to_factories
+    assert unfinished_inputs == []
+
+
+def test_resume_when_failed_with_sqlite_store(tmpdir):
+    numbers_to_factories = [i for i in range(1, 100)]
+    fail_for_numbers = [11, 56]
+
+    pylo = Pylo.local_multithread(
+        tmpdir, number_of_workers=3, max_worker_failures=2, task_executions_before_flush=5, sqlite_store=True,
+        work_stealing=True)
+    execution_id = pylo.start_from_scratch(
+        numbers_to_factories, FailingFactorsCalculator(fail_for_numbers).compute_factors)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert sorted(finished_inputs + unfinished_inputs) == numbers_to_factories
+    assert set(fail_for_numbers) <= set(unfinished_inputs)
+    assert len(pylo.get_exceptions(execution_id)) >= 2
+
+    new_execution_id = pylo.start_from_past_execution(execution_id, FactorsCalculator().compute_factors)
+    finished_inputs, unfinished_inputs = pylo.get_state(new_execution_id)
+    assert sorted(finished_inputs) == numbers_to_factories
+    assert unfinished_inputs == []
+
+
+def test_work_stealing_with_skewed_inputs(tmpdir):
+    calculator = FactorsCalculator()
+    numbers_to_factories = [i for i in range(1, 200)]
+
+    def slow_for_first_inputs(n):
+        if n < 10:
+            time.sleep(0.01)
+        calculator.compute_factors(n)
+
+    pylo = Pylo.local_multithread(tmpdir, number_of_workers=4, task_executions_before_flush=10, work_stealing=True)
+    execution_id = pylo.start_from_scratch(numbers_to_factories, slow_for_first_inputs)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert sorted(finished_inputs) == numbers_to_factories
+    assert unfinished_inputs == []
+    assert sorted(calculator.inputs_history) == numbers_to_factories
+
+
+def test_work_stealing_resume_when_failed(tmpdir):
+    numbers_to_factories = [i for i in range(1, 100)]
+    fail_for_numbers = [11, 56]
+
+    pylo = Pylo.local_multithread(
+        tmpdir, number_of_workers=3, max_worker_failures=2, journaled_store=True, work_stealing=True)
+    execution_id = pylo.start_from_scratch(
+        numbers_to_factories, FailingFactorsCalculator(fail_for_numbers).compute_factors)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert sorted(finished_inputs + unfinished_inputs) == numbers_to_factories
+    assert set(fail_for_numbers) <= set(unfinished_inputs)
+
+    new_execution_id = pylo.start_from_past_execution(execution_id, FactorsCalculator().compute_factors)
+    finished_inputs, unfinished_inputs = pylo.get_state(new_execution_id)
+    assert sorted(finished_inputs) == numbers_to_factories
+    assert unfinished_inputs == []
+
+
+def test_streamed_inputs_are_read_lazily(tmpdir):
+    calculator = FactorsCalculator()
+    generated_inputs = []
+
+    def generate_numbers():
+        for i in range(1, 1000):
+            generated_inputs.append(i)
+            yield i
+
+    def compute_factors_and_check_window(n):
+        # each of the two workers holds at most one batch of inputs
+        assert len(generated_inputs) - len(calculator.inputs_history) <= 2 * 10
+        calculator.compute_factors(n)
+
+    pylo = Pylo.local_multithread(tmpdir, number_of_workers=2, stream_batch_size=10)
+    execution_id = pylo.start_from_scratch(generate_numbers(), compute_factors_and_check_window, stream_inputs=True)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id, task_inputs=range(1, 1000))
+    assert sorted(finished_inputs) == list(range(1, 1000))
+    assert unfinished_inputs == []
+    assert sorted(calculator.inputs_history) == list(range(1, 1000))
+
+
+def test_streamed_inputs_resume_when_failed(tmpdir):
+    numbers_to_factories = [i for i in range(1, 100)]
+    fail_for_numbers = [11, 56]
+
+    pylo = Pylo.local_multithread(tmpdir, number_of_workers=2, max_worker_failures=2, stream_batch_size=7)
+    execution_id = pylo.start_from_scratch(
+        iter(numbers_to_factories), FailingFactorsCalculator(fail_for_numbers).compute_factors, stream_inputs=True)
+
+    with pytest.raises(ValueError):
+        pylo.get_state(execution_id)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id, task_inputs=iter(numbers_to_factories))
+    assert set(fail_for_numbers) <= set(unfinished_inputs)
+    assert not set(finished_inputs) & set(unfinished_inputs)
+
+    calculator = FactorsCalculator()
+    new_execution_id = pylo.start_from_past_execution(
+        execution_id, calculator.compute_factors, task_inputs=iter(numbers_to_factories))
+
+    finished_inputs, unfinished_inputs = pylo.get_state(new_execution_id, task_inputs=iter(numbers_to_factories))
+    assert sorted(finished_inputs) == numbers_to_factories
+    assert unfinished_inputs == []
+    assert set(fail_for_numbers) <= set(calculator.inputs_history)
+
+
+@pytest.mark.parametrize('stream_inputs', [False, True])
+def test_counts_and_pages_match_state(tmpdir, stream_inputs):
+    numbers_to_factories = [i for i in range(1, 100)]
+    fail_for_numbers = [11, 56]
+
+    pylo = Pylo.local_multithread(tmpdir, number_of_workers=2, max_worker_failures=2, journaled_store=True)
+    execution_id = pylo.start_from_scratch(
+        iter(numbers_to_factories) if stream_inputs else numbers_to_factories,
+        FailingFactorsCalculator(fail_for_numbers).compute_factors, stream_inputs=stream_inputs)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id, task_inputs=iter(numbers_to_factories))
+    assert pylo.count_inputs(execution_id) == (len(finished_inputs), len(unfinished_inputs))
+    assert sorted(pylo.iter_finished_inputs(execution_id, task_inputs=iter(numbers_to_factories))) == \
+        sorted(finished_inputs)
+    assert sorted(pylo.iter_unfinished_inputs(execution_id)) == sorted(unfinished_inputs)
+    assert pylo.get_unfinished_inputs_page(execution_id, offset=1, limit=3) == \
+        list(pylo.iter_unfinished_inputs(execution_id))[1:4]
+    assert pylo.get_finished_inputs_page(execution_id, offset=2, limit=5, task_inputs=iter(numbers_to_factories)) == \
+        list(pylo.iter_finished_inputs(execution_id, task_inputs=iter(numbers_to_factories)))[2:7]
+
+
+def test_batched_task_function(tmpdir):
+    batch_calculator = BatchFactorsCalculator()
+    numbers_to_factories = [i for i in range(1, 100)]
+
+    pylo = Pylo.local_multithread(tmpdir, number_of_workers=2, task_batch_size=10)
+    execution_id = pylo.start_from_scratch(numbers_to_factories, batch_calculator.compute_factors)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert sorted(finished_inputs) == numbers_to_factories
+    assert unfinished_inputs == []
+    assert max(len(batch) for batch in batch_calculator.batches) == 10
+
+
+def test_batched_task_function_returning_results_finishes_all_inputs(tmpdir):
+    pylo = Pylo.local_multithread(tmpdir, number_of_workers=2, task_batch_size=10)
+    execution_id = pylo.start_from_scratch([i for i in range(100)], lambda numbers: [n * 2 for n in numbers])
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert sorted(finished_inputs) == [i for i in range(100)]
+    assert unfinished_inputs == []
+    assert pylo.get_exceptions(execution_id) == []
+
+
+def test_batched_task_function_reports_failures_per_input(tmpdir):
+    batch_calculator = BatchFactorsCalculator(fail_for_numbers=[11, 56], report_failures=True)
+
+    pylo = Pylo.local_multithread(tmpdir, number_of_workers=2, max_worker_failures=2, task_batch_size=10)
+    execution_id = pylo.start_from_scratch([i for i in range(1, 100)], batch_calculator.compute_factors)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert len(finished_inputs) == 97
+    assert sorted(unfinished_inputs) == [11, 56]
+    assert sorted(str(e) for e in pylo.get_exceptions(execution_id)) == \
+        ['Failed to compute factors for 11'] * 2 + ['Failed to compute factors for 56'] * 2
+
+
+def test_failed_batches_are_split_to_isolate_failing_inputs(tmpdir):
+    batch_calculator = BatchFactorsCalculator(fail_for_numbers=[11])
+
+    pylo = Pylo.local_multithread(tmpdir, number_of_workers=1, max_worker_failures=3, task_batch_size=16)
+    execution_id = pylo.start_from_scratch([i for i in range(1, 100)], batch_calculator.compute_factors)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert sorted(finished_inputs) == [i for i in range(1, 100) if i != 11]
+    assert unfinished_inputs == [11]
+    assert [str(e) for e in pylo.get_exceptions(execution_id)] == ['Failed to compute factors for 11'] * 3
+
+
+def test_failed_batches_fail_all_inputs_when_not_split(tmpdir):
+    batch_calculator = BatchFactorsCalculator(fail_for_numbers=[11])
+
+    pylo = Pylo.local_multithread(
+        tmpdir, number_of_workers=1, max_worker_failures=16, task_batch_size=16, split_failed_batches=False)
+    execution_id = pylo.start_from_scratch([i for i in range(1, 100)], batch_calculator.compute_factors)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert finished_inputs == []
+    assert len(pylo.get_exceptions(execution_id)) == 16
+
+
+def test_worker_context_is_created_once_per_worker_and_finalized(tmpdir):
+    connections = ConnectionPool()
+
+    pylo = Pylo.local_multithread(tmpdir, number_of_workers=3, max_worker_failures=2,
+                                  worker_initializer=connections.open, worker_finalizer=connections.close)
+    execution_id = pylo.start_from_scratch([i for i in range(1, 100)], connections.compute_factors)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert sorted(finished_inputs + unfinished_inputs) == [i for i in range(1, 100)]
+    # the worker which got input 66 gives up after failing for it twice, and still closes its connection
+    assert unfinished_inputs != []
+    assert len(connections.opened) == 3
+    assert sorted(map(id, connections.closed)) == sorted(map(id, connections.opened))
+    # every connection was only used by the thread which opened it
+    assert all(len(connection['threads']) == 1 for connection in connections.opened)
+
+
+def test_worker_gives_up_when_initializer_fails(tmpdir):
+    def open_connection():
+        raise ConnectionError('Unable to connect')
+
+    pylo = Pylo.local_multithread(tmpdir, number_of_workers=2, worker_initializer=open_connection)
+    execution_id = pylo.start_from_scratch([i for i in range(1, 10)], lambda n, connection: None)
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert finished_inputs == []
+    assert sorted(unfinished_inputs) == [i for i in range(1, 10)]
+    assert [str(e) for e in pylo.get_exceptions(execution_id)] == ['Unable to connect'] * 2
+
+
+def test_skips_inputs_finished_by_earlier_executions_of_task(tmpdir):
+    calculator = FactorsCalculator()
+
+    pylo = Pylo.local_multithread(tmpdir, number_of_workers=2)
+    pylo.start_from_scratch([i for i in range(1, 50)], calculator.compute_factors, task_name='factors')
+    execution_id = pylo.start_from_scratch([i for i in range(1, 100)], calculator.compute_factors, task_name='factors')
+
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert sorted(finished_inputs) == [i for i in range(1, 100)]
+    assert unfinished_inputs == []
+    # each input ran once, the second execution only ran inputs which the first did not finish
+    assert sorted(calculator.inputs_history) == [i for i in range(1, 100)]
+
+    # other tasks run all of their inputs
+    pylo.start_from_scratch([i for i in range(1, 10)], calculator.compute_factors, task_name='other factors')
+    assert sorted(calculator.inputs_history) == sorted([i for i in range(1, 100)] + [i for i in range(1, 10)])
+
+
+def test_resume_skips_inputs_finished_by_other_executions_of_task(tmpdir):
+    failing_calc = FailingFactorsCalculator([11, 56])
+    successful_calc = FactorsCalculator()
+
+    pylo = Pylo.local_multithread(tmpdir, number_of_workers=2, max_worker_failures=2)
+    execution_id = pylo.start_from_scratch([i for i in range(1, 100)], failing_calc.compute_factors,
+                                           task_name='factors')
+    pylo.start_from_scratch([11], successful_calc.compute_factors, task_name='factors')
+    new_execution_id = pylo.start_from_past_execution(execution_id, successful_calc.compute_factors,
+                                                      task_name='factors')
+
+    finished_inputs, unfinished_inputs = pylo.get_state(new_execution_id)
+    assert sorted(finished_inputs) == [i for i in range(1, 100)]
+    assert unfinished_inputs == []
+    assert sorted(successful_calc.inputs_history) == [11, 56]
+
+
+def test_task_name_is_not_supported_with_streamed_inputs(tmpdir):
+    pylo = Pylo.local_multithread(tmpdir, number_of_workers=2)
+
+    with pytest.raises(ValueError):
+        pylo.start_from_scratch(iter([1, 2]), lambda n: None, stream_inputs=True, task_name='factors')
+
+
+def test_schedules_inputs_by_recorded_durations(tmpdir):
+    slow_calculator = SlowFactorsCalculator(slow_numbers=[90, 95])
+
+    pylo = Pylo.local_multithread(tmpdir, number_of_workers=2, record_task_durations=True)
+    execution_id = pylo.start_from_scratch([i for i in range(1, 100)], slow_calculator.compute_factors)
+    # split in order, the second worker got both slow inputs
+    assert slow_calculator.first_inputs_by_worker() == [1, 51]
+
+    slow_calculator = SlowFactorsCalculator(slow_numbers=[90, 95])
+    pylo.start_from_scratch([i for i in range(1, 100)], slow_calculator.compute_factors, durations_from=execution_id)
+    assert slow_calculator.first_inputs_by_worker() == [90, 95]
+
+    slow_calculator = SlowFactorsCalculator(slow_numbers=[])
+    pylo.start_from_scratch([i for i in range(1, 100)], slow_calculator.compute_factors, cost_hint=lambda n: n)
+    assert slow_calculator.first_inputs_by_worker() == [98, 99]
+
+
+def test_recording_task_durations_requires_store_support(tmpdir):
+    pylo = Pylo(PyloLocalMultiThreadExecutor(2, max_worker_failures=2, executions_before_flush=1000,
+                                             store_exceptions=True, record_task_durations=True),
+                StoreWithoutTaskDurations(tmpdir))
+
+    with pytest.raises(ValueError):
+        pylo.start_from_scratch([i for i in range(1, 100)], FactorsCalculator().compute_factors)
+    with pytest.raises(ValueError):
+        multithread_pylo(StoreWithoutTaskDurations(tmpdir)).start_from_scratch(
+            [i for i in range(1, 100)], FactorsCalculator().compute_factors, durations_from='any')
+
+
+class ConnectionPool:
+    """
+    Stands in for a database, which each worker opens its own connection to.
+    """
+    def __init__(self):
+        self.opened = []
+        self.closed = []
+        self._lock = threading.Lock()
+
+    def open(self):
+        connection = {'threads': set()}
+        with self._lock:
+            self.opened.append(connection)
+        return connection
+
+    def close(self, connection):
+        with self._lock:
+            self.closed.append(connection)
+
+    def compute_factors(self, n, connection):
+        connection['threads'].add(threading.get_ident())
+        if n == 66:
+            raise Exception(f'Failed to compute factors for {n}')
+        return FactorsCalculator().compute_factors(n)
+
+
 class FactorsCalculator:
     def __init__(self):
         self.inputs_history = []
@@ -106,6 +688,26 @@ class FactorsCalculator:
         return factors
 
 
+class SlowFactorsCalculator:
+    def __init__(self, slow_numbers):
+        self._slow_numbers = slow_numbers
+        self._factors_calculator = FactorsCalculator()
+        # thread name -> inputs in the order the thread ran them
+        self.inputs_by_thread = {}
+        self._lock = threading.Lock()
+
+    def compute_factors(self, n):
+        with self._lock:
+            # names are unique, unlike ids of threads which are no longer alive
+            self.inputs_by_thread.setdefault(threading.current_thread().name, []).append(n)
+        if n in self._slow_numbers:
+            time.sleep(0.1)
+        return self._factors_calculator.compute_factors(n)
+
+    def first_inputs_by_worker(self):
+        return sorted(inputs[0] for inputs in self.inputs_by_thread.values())
+
+
 class FailingFactorsCalculator:
     def __init__(self, only_fail_for_numbers=None):
         self._only_fail_for_numbers = only_fail_for_numbers
@@ -116,3 +718,41 @@ class FailingFactorsCalculator:
             raise Exception(f'Failed to compute factors for {n}')
         else:
             return self._factors_calculator.compute_factors(n)
+
+
+class BatchFactorsCalculator:
+    def __init__(self, fail_for_numbers=(), report_failures=False):
+        self.batches = []
+        self._fail_for_numbers = fail_for_numbers
+        self._report_failures = report_failures
+        self._factors_calculator = FactorsCalculator()
+
+    def compute_factors(self, numbers):
+        self.batches.append(numbers)
+        failures = {}
+        for position, n in enumerate(numbers):
+            if n in self._fail_for_numbers:
+                if not self._report_failures:
+                    raise Exception(f'Failed to compute factors for {n}')
+                failures[position] = Exception(f'Failed to compute factors for {n}')
+            else:
+                self._factors_calculator.compute_factors(n)
+        return failures
+
+
+def multithread_pylo(task_store):
+    return Pylo(PyloLocalMultiThreadExecutor(
+        2, max_worker_failures=2, executions_before_flush=1000, store_exceptions=True), task_store)
+
+
+class CopyingExecutionStore(PyloFileSystemExecutionStore):
+    supports_parent_references = False
+
+
+class UnreadableFailedAttemptsStore(PyloFileSystemExecutionStore):
+    def load_failed_attempts(self, execution_id):
+        raise OSError('Failed to read failed attempts')
+
+
+class StoreWithoutTaskDurations(PyloFileSystemExecutionStore):
+    supports_task_durations = False
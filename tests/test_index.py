@@ -0,0 +1,53 @@
+# coding=utf-8
+from pylo.index import PyloCompletionIndex, _BloomFilter
+
+
+def test_remembers_completed_inputs_per_task_across_instances(tmpdir):
+    database_path = str(tmpdir.join('completed.sqlite3'))
+    PyloCompletionIndex(database_path).record_completed('factors', [1, 2, (3, 'three')])
+
+    under_test = PyloCompletionIndex(database_path)
+    assert under_test.split_completed('factors', [(3, 'three'), 4, 2, 5]) == ([(3, 'three'), 2], [4, 5])
+    assert under_test.split_completed('primes', [1, 2]) == ([], [1, 2])
+    assert under_test.count_completed('factors') == 3
+
+
+def test_sees_inputs_recorded_after_bloom_filter_was_built(tmpdir):
+    under_test = PyloCompletionIndex(str(tmpdir.join('completed.sqlite3')))
+    assert not under_test.is_completed('factors', 1)
+
+    under_test.record_completed('factors', [i for i in range(1, 20001)])
+
+    completed_inputs, uncompleted_inputs = under_test.split_completed('factors', [i for i in range(1, 30001)])
+    assert completed_inputs == [i for i in range(1, 20001)]
+    assert uncompleted_inputs == [i for i in range(20001, 30001)]
+
+
+def test_identifies_inputs_by_fingerprint(tmpdir):
+    under_test = PyloCompletionIndex(str(tmpdir.join('completed.sqlite3')), fingerprint=lambda row: row['id'])
+    under_test.record_completed('rows', [{'id': 1, 'updated': False}])
+
+    assert under_test.is_completed('rows', {'id': 1, 'updated': True})
+    assert not under_test.is_completed('rows', {'id': 2, 'updated': False})
+
+
+def test_clear_forgets_completed_inputs_of_task(tmpdir):
+    under_test = PyloCompletionIndex(str(tmpdir.join('completed.sqlite3')))
+    under_test.record_completed('factors', [1, 2])
+    under_test.record_completed('primes', [1, 2])
+
+    under_test.clear('factors')
+
+    assert under_test.split_completed('factors', [1, 2]) == ([], [1, 2])
+    assert under_test.split_completed('primes', [1, 2]) == ([1, 2], [])
+
+
+def test_bloom_filter_has_no_false_negatives_and_few_false_positives(tmpdir):
+    index = PyloCompletionIndex(str(tmpdir.join('completed.sqlite3')))
+    under_test = _BloomFilter(capacity=10000, false_positive_rate=0.01)
+    for i in range(10000):
+        under_test.add(index.fingerprint(i))
+
+    assert all(index.fingerprint(i) in under_test for i in range(10000))
+    false_positives = sum(index.fingerprint(i) in under_test for i in range(10000, 20000))
+    assert false_positives < 300
@@ -0,0 +1,40 @@
+# coding=utf-8
+import json
+
+from pylo.metrics import PyloMetrics
+
+
+def test_aggregates_metrics_of_workers():
+    under_test = PyloMetrics()
+    under_test.on_execution_start('e1')
+
+    under_test.on_task_start('e1', 1, [1], queue_depth=2)
+    under_test.on_task_end('e1', 1, [1], [None], seconds=0.0015)
+    under_test.on_task_start('e1', 2, [2, 3], queue_depth=0)
+    under_test.on_task_end('e1', 2, [2, 3], [None, Exception('I run out of memory')], seconds=0.3)
+    under_test.on_flush('e1', 1, seconds=0.01)
+    under_test.on_store('e1', 'store_worker_state', seconds=0.01)
+    under_test.on_store('e1', 'store_worker_state', seconds=0.03)
+    under_test.on_idle('e1', 2, seconds=0.5)
+
+    stats = under_test.stats()
+    assert (stats['tasks_completed'], stats['tasks_failed'], stats['queue_depth']) == (2, 1, 2)
+    assert stats['latency_histogram']['<=0.002'] == 1
+    assert stats['latency_histogram']['<=0.5'] == 1
+    assert stats['store_calls']['store_worker_state'] == {'calls': 2, 'total_seconds': 0.04, 'max_seconds': 0.03}
+    assert stats['workers']['1']['flushes'] == 1
+    assert stats['workers']['2']['idle_seconds'] == 0.5
+    assert stats['throughput_per_second'] > 0
+
+
+def test_dumps_metrics_when_execution_ends(tmpdir):
+    dump_path = str(tmpdir.join('stats.jsonl'))
+    under_test = PyloMetrics(dump_path=dump_path, dump_interval_seconds=60)
+
+    under_test.on_execution_start('e1')
+    under_test.on_task_end('e1', 1, [1], [None], seconds=0.1)
+    under_test.on_execution_end('e1')
+
+    with open(dump_path) as df:
+        dumped_stats = [json.loads(line) for line in df]
+    assert [(stats['execution_id'], stats['tasks_completed']) for stats in dumped_stats] == [('e1', 1)]
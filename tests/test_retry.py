@@ -0,0 +1,28 @@
+# coding=utf-8
+import pytest
+
+from pylo.retry import PyloRetryPolicy
+
+
+def test_delay_grows_exponentially_up_to_max_delay():
+    under_test = PyloRetryPolicy(delay_seconds=1.0, max_delay_seconds=5.0, jitter=0)
+
+    assert [under_test.retry_delay_seconds(attempts) for attempts in range(1, 6)] == [1.0, 2.0, 4.0, 5.0, 5.0]
+
+
+def test_jitter_shortens_delay_randomly():
+    under_test = PyloRetryPolicy(delay_seconds=4.0, jitter=0.5)
+
+    delays = [under_test.retry_delay_seconds(1) for _ in range(100)]
+    assert all(2.0 <= delay <= 4.0 for delay in delays)
+    assert len(set(delays)) > 1
+    with pytest.raises(ValueError):
+        PyloRetryPolicy(jitter=2)
+
+
+def test_stops_retrying_after_max_attempts():
+    under_test = PyloRetryPolicy(max_attempts=3)
+
+    assert under_test.should_retry(2)
+    assert not under_test.should_retry(3)
+    assert PyloRetryPolicy().should_retry(1000)
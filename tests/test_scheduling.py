@@ -0,0 +1,47 @@
+# coding=utf-8
+from pylo.scheduling import PyloTaskCosts, _DurationRecorder
+from pylo.state import PyloFileSystemExecutionStore
+
+
+def test_packs_inputs_longest_first_into_balanced_chunks():
+    under_test = PyloTaskCosts(cost_hint=lambda n: n)
+
+    chunks = under_test.pack([1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 30], into_number=3)
+
+    # split in order 1, 2, ..., the first worker would get inputs which cost 15, and the last 53
+    assert chunks == [[30, 4, 3], [12, 9, 8, 5, 2], [11, 10, 7, 6, 1]]
+    assert [sum(chunk) for chunk in chunks] == [37, 36, 35]
+    assert under_test.pack([1, 2], into_number=3) == [[2], [1]]
+    assert under_test.pack([], into_number=3) == []
+
+
+def test_recorded_durations_take_precedence_over_cost_hint():
+    under_test = PyloTaskCosts(recorded_durations={1: 10.0, (2, 'two'): 0.5}, cost_hint=lambda task_input: 2.0)
+
+    assert under_test.cost_of(1) == 10.0
+    assert under_test.cost_of((2, 'two')) == 0.5
+    assert under_test.cost_of(3) == 2.0
+    assert under_test.pack([(2, 'two'), 3, 1], into_number=1) == [[1, 3, (2, 'two')]]
+
+
+def test_inputs_without_estimates_cost_average_recorded_duration():
+    under_test = PyloTaskCosts(recorded_durations={1: 1.0, 2: 3.0})
+
+    # inputs which cost the same keep their order
+    assert under_test.pack([1, 4, 5, 2], into_number=1) == [[2, 4, 5, 1]]
+    assert PyloTaskCosts().cost_of(1) == 1.0
+
+
+def test_records_task_durations_on_flush(tmpdir):
+    store = PyloFileSystemExecutionStore(tmpdir)
+    under_test = _DurationRecorder(store, execution_id=1)
+
+    under_test.on_task_end(1, 1, [1], [None], seconds=2.0)
+    under_test.on_task_end(1, 2, [2, 3], [None, ValueError('Failed for 3')], seconds=1.0)
+    assert store.load_task_durations(execution_id=1) == {}
+
+    under_test.on_flush(1, 1, seconds=0.01)
+    under_test.on_task_end(1, 1, [1], [None], seconds=4.0)
+    under_test.on_execution_end(1)
+
+    assert store.load_task_durations(execution_id=1) == {1: 4.0, 2: 0.5, 3: 0.5}
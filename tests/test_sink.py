@@ -0,0 +1,107 @@
+# coding=utf-8
+import threading
+
+from pylo.sink import PyloExceptionSink, RepeatedException, count_repeated_exceptions
+
+
+def test_writes_when_buffer_is_full():
+    writer = RecordingWriter()
+    under_test = PyloExceptionSink(writer.write, max_buffered_exceptions=2, flush_interval_seconds=60)
+
+    under_test.add(Exception('I run out of memory'))
+    under_test.add(Exception('I run out of cookies'))
+
+    assert writer.written.wait(timeout=5)
+    assert [(index, str(e)) for index, e in writer.exceptions] == [(0, 'I run out of memory'),
+                                                                   (1, 'I run out of cookies')]
+    under_test.close()
+
+
+def test_writes_when_flush_interval_passes():
+    writer = RecordingWriter()
+    under_test = PyloExceptionSink(writer.write, max_buffered_exceptions=1000, flush_interval_seconds=0.01)
+
+    under_test.add(Exception('I run out of memory'))
+
+    assert writer.written.wait(timeout=5)
+    under_test.close()
+
+
+def test_deduplicates_exceptions():
+    writer = RecordingWriter()
+    under_test = PyloExceptionSink(writer.write, flush_interval_seconds=60, deduplicate=True)
+
+    for message in ['I run out of memory', 'I run out of cookies', 'I run out of memory', 'I run out of memory']:
+        under_test.add(Exception(message))
+    under_test.flush()
+
+    assert [str(e) for _, e in writer.exceptions] == ['I run out of memory', 'I run out of cookies']
+    assert writer.repeated_exceptions == {0: 2}
+    under_test.close()
+
+
+def test_drops_exceptions_above_max_stored():
+    writer = RecordingWriter()
+    under_test = PyloExceptionSink(writer.write, flush_interval_seconds=60, max_stored_exceptions=2, stored_exceptions=1)
+
+    for message in ['I run out of memory', 'I run out of cookies', 'I run out of milk']:
+        under_test.add(Exception(message))
+    under_test.close()
+
+    assert [(index, str(e)) for index, e in writer.exceptions] == [(1, 'I run out of memory')]
+    assert under_test.dropped_exceptions == 2
+
+
+def test_retries_exceptions_which_failed_to_be_written():
+    writer = RecordingWriter(failing_writes=1)
+    under_test = PyloExceptionSink(writer.write, flush_interval_seconds=60, deduplicate=True, max_stored_exceptions=2)
+
+    for message in ['I run out of memory', 'I run out of memory']:
+        under_test.add(Exception(message))
+    under_test.flush()
+    assert writer.exceptions == []
+    under_test.add(Exception('I run out of cookies'))
+    under_test.add(Exception('I run out of milk'))
+    under_test.flush()
+
+    assert [(index, str(e)) for index, e in writer.exceptions] == [(0, 'I run out of memory'),
+                                                                   (1, 'I run out of cookies')]
+    assert writer.repeated_exceptions == {0: 1}
+    assert under_test.dropped_exceptions == 1
+    under_test.close()
+
+
+def test_close_retries_exceptions_once():
+    writer = RecordingWriter(failing_writes=1)
+    under_test = PyloExceptionSink(writer.write, flush_interval_seconds=60)
+
+    under_test.add(Exception('I run out of memory'))
+    under_test.close()
+
+    assert [(index, str(e)) for index, e in writer.exceptions] == [(0, 'I run out of memory')]
+
+
+def test_count_repeated_exceptions():
+    exception1 = Exception('I run out of memory')
+    exception2 = Exception('I run out of cookies')
+
+    counts = count_repeated_exceptions([exception1, exception2, RepeatedException(0, 3), RepeatedException(1, 1)])
+
+    assert counts == [(exception1, 4), (exception2, 2)]
+
+
+class RecordingWriter:
+    def __init__(self, failing_writes=0):
+        self.exceptions = []
+        self.repeated_exceptions = {}
+        self.written = threading.Event()
+        self.failing_writes = failing_writes
+
+    def write(self, exceptions, repeated_exceptions):
+        if self.failing_writes:
+            self.failing_writes -= 1
+            raise IOError('I run out of disk space')
+        self.exceptions.extend(exceptions)
+        for index, count in repeated_exceptions.items():
+            self.repeated_exceptions[index] = self.repeated_exceptions.get(index, 0) + count
+        self.written.set()
@@ -1,5 +1,11 @@
 # coding=utf-8
-from pylo.state import PyloExecutionState, PyloFileSystemExecutionStore
+import pickle
+
+import pytest
+
+from pylo.scheduling import PyloTaskCosts
+from pylo.state import PyloBitmapExecutionState, PyloExecutionState, PyloFileSystemExecutionStore, PyloInputStream, \
+    PyloSqliteExecutionStore, _apply_worker_journal
 
 
 def test_join_two_states():
@@ -10,6 +16,13 @@ def test_join_two_states():
     assert joined == PyloExecutionState(execution_id=1, finished_inputs=[1, 2, 5], unfinished_inputs=[3, 4])
 
 
+def test_merge_many_states():
+    states = [PyloExecutionState(execution_id=1, finished_inputs=[i], unfinished_inputs=[-i]) for i in range(1, 4)]
+
+    merged = PyloExecutionState.merge(1, states)
+    assert merged == PyloExecutionState(execution_id=1, finished_inputs=[1, 2, 3], unfinished_inputs=[-1, -2, -3])
+
+
 def test_split_unfinished_as_many_inputs_as_splits():
     under_test = PyloExecutionState(1, finished_inputs=[1, 2, 3], unfinished_inputs=[4, 5, 6])
     finished, unfinished = under_test.split_unfinished(3)
@@ -54,6 +67,15 @@ def test_split_unfinished_inputs_not_divisible_by_splits():
                           PyloExecutionState(1, [], [9, 10])]
 
 
+def test_split_unfinished_by_task_costs():
+    under_test = PyloExecutionState(1, finished_inputs=[], unfinished_inputs=[1, 2, 3, 4, 5, 6])
+    under_test.task_costs = PyloTaskCosts(cost_hint=lambda n: n)
+    finished, unfinished = under_test.split_unfinished(2)
+    assert finished == PyloExecutionState(1, [], [])
+    assert unfinished == [PyloExecutionState(1, [], [6, 3, 2]),
+                          PyloExecutionState(1, [], [5, 4, 1])]
+
+
 def test_file_system_store_load_worker_state(tmpdir):
     state = PyloExecutionState(execution_id=1, finished_inputs=[1, 2], unfinished_inputs=[3, 4])
     under_test = PyloFileSystemExecutionStore(tmpdir)
@@ -89,3 +111,514 @@ def test_file_system_store_load_exceptions(tmpdir):
 
     loaded_exceptions = under_test.load_task_exceptions(execution_id=1)
     assert [str(e) for e in loaded_exceptions] == [str(exception1), str(exception2)]
+
+
+def test_file_system_store_deduplicates_exceptions(tmpdir):
+    under_test = PyloFileSystemExecutionStore(tmpdir, deduplicate_exceptions=True)
+
+    for message in ['I run out of memory', 'I run out of cookies', 'I run out of memory']:
+        under_test.store_task_exception(execution_id=1, exception=Exception(message))
+    under_test.finish_execution(execution_id=1)
+
+    loaded_exceptions = PyloFileSystemExecutionStore(tmpdir).load_task_exception_counts(execution_id=1)
+    assert [(str(e), count) for e, count in loaded_exceptions] == [('I run out of memory', 2),
+                                                                   ('I run out of cookies', 1)]
+
+
+def test_replay_journal_matches_worker_state():
+    state = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[1, 2, 3, 4])
+    replayed = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[1, 2, 3, 4])
+
+    state.mark_finished(state.next_unfinished())
+    state.mark_failed(state.next_unfinished())
+    state.mark_finished(state.next_unfinished())
+    replayed.replay_journal(state.take_journal())
+
+    assert replayed == state == PyloExecutionState(execution_id=1, finished_inputs=[1, 3], unfinished_inputs=[4, 2])
+
+
+def test_replay_journal_with_inputs_given_away_and_assigned():
+    victim = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[1, 2, 3, 4, 5])
+    thief = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[])
+    replayed_victim = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[1, 2, 3, 4, 5])
+    replayed_thief = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[])
+
+    thief.assign_unfinished(victim.give_away_unfinished(2))
+    replayed_victim.replay_journal(victim.take_journal())
+    replayed_thief.replay_journal(thief.take_journal())
+
+    assert replayed_victim == victim == PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[1, 2, 3])
+    assert replayed_thief == thief == PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[4, 5])
+
+
+def test_apply_worker_journal_keeps_in_flight_inputs_unfinished():
+    victim = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[1, 2, 3, 4, 5, 6])
+    thief = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[])
+    copied_victim, copied_thief = victim.snapshot(), thief.snapshot()
+
+    victim.mark_finished(victim.next_unfinished())
+    in_flight_input = victim.next_unfinished()
+    victim.mark_failed(victim.next_unfinished(), requeue=False)
+    thief.assign_unfinished(victim.give_away_unfinished(2), {5: 2})
+    _apply_worker_journal(copied_victim, victim.take_journal())
+    _apply_worker_journal(copied_thief, thief.take_journal(), {5: 2})
+
+    # the failed input is held by the victim until its retry is due, so the copy appends it like a worker does
+    assert copied_victim == PyloExecutionState(
+        execution_id=1, finished_inputs=[1], unfinished_inputs=[in_flight_input, 4, 3])
+    assert copied_victim.take_journal() == [('finished', 1), ('failed', 3), ('given_away', 5), ('given_away', 6)]
+    assert copied_thief == PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[5, 6])
+    assert copied_thief.failed_attempts == {5: 2}
+
+
+def test_snapshot_keeps_in_flight_inputs_unfinished():
+    state = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[1, 2, 3])
+    state.mark_finished(state.next_unfinished())
+    in_flight_input = state.next_unfinished()
+
+    snapshot = state.snapshot(in_flight_inputs=[in_flight_input])
+    state.mark_finished(in_flight_input)
+
+    assert snapshot == PyloExecutionState(execution_id=1, finished_inputs=[1], unfinished_inputs=[2, 3])
+    assert snapshot.take_journal() == [('finished', 1)]
+    assert state.take_journal() == [('finished', 2)]
+
+
+def test_journaled_file_system_store_appends_only_delta(tmpdir):
+    state = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[1, 2, 3, 4])
+    under_test = PyloFileSystemExecutionStore(tmpdir, journaled=True)
+
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=state)
+    base_file = tmpdir.join('1', '1')
+    base_content = base_file.read_binary()
+
+    state.mark_finished(state.next_unfinished())
+    state.mark_failed(state.next_unfinished())
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=state)
+
+    assert base_file.read_binary() == base_content
+    assert under_test.load_worker_state(execution_id=1, worker_id=1) == state
+    assert under_test.load_whole_state(execution_id=1) == state
+
+
+def test_journaled_file_system_store_ignores_partially_written_journal_record(tmpdir):
+    state = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[1, 2, 3, 4])
+    under_test = PyloFileSystemExecutionStore(tmpdir, journaled=True)
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=state)
+    state.mark_finished(state.next_unfinished())
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=state)
+    journal_file = tmpdir.join('1', '1.journal')
+    complete_journal = journal_file.read_binary()
+
+    state.mark_finished(state.next_unfinished())
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=state)
+    # a crash while appending the last record leaves only a part of it
+    journal_file.write_binary(journal_file.read_binary()[:len(complete_journal) + 3])
+
+    reloaded = PyloFileSystemExecutionStore(tmpdir, journaled=True)
+    assert reloaded.load_worker_state(execution_id=1, worker_id=1) == \
+        PyloExecutionState(execution_id=1, finished_inputs=[1], unfinished_inputs=[2, 3, 4])
+
+
+def test_journaled_file_system_store_compacts_journal(tmpdir):
+    state = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[1, 2, 3, 4])
+    under_test = PyloFileSystemExecutionStore(tmpdir, journaled=True, min_journal_entries_before_compaction=2)
+
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=state)
+    for _ in range(3):
+        state.mark_finished(state.next_unfinished())
+        under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=state)
+    assert under_test.load_worker_state(execution_id=1, worker_id=1) == state
+
+    state.mark_finished(state.next_unfinished())
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=state)
+    under_test.compact(execution_id=1)
+
+    reloaded = PyloFileSystemExecutionStore(tmpdir, journaled=True)
+    assert reloaded.load_worker_state(execution_id=1, worker_id=1) == \
+        PyloExecutionState(execution_id=1, finished_inputs=[1, 2, 3, 4], unfinished_inputs=[])
+
+
+def test_file_system_store_counts_and_pages_without_loading_state(tmpdir):
+    state1 = PyloExecutionState(execution_id=1, finished_inputs=[1, 2], unfinished_inputs=[3, 4])
+    state2 = PyloExecutionState(execution_id=1, finished_inputs=[5], unfinished_inputs=[6])
+    under_test = PyloFileSystemExecutionStore(tmpdir, journaled=True)
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=state1)
+    under_test.store_worker_state(execution_id=1, worker_id=2, task_execution_state=state2)
+
+    state1.mark_finished(state1.next_unfinished())
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=state1)
+
+    assert under_test.count_inputs(execution_id=1) == (4, 2)
+    assert list(under_test.iter_inputs(execution_id=1, finished=True)) == [1, 2, 3, 5]
+    assert list(under_test.iter_inputs(execution_id=1, finished=False)) == [4, 6]
+    assert under_test.load_inputs_page(execution_id=1, finished=True, offset=1, limit=2) == [2, 3]
+    assert under_test.load_stream_offset(execution_id=1) is None
+
+
+def test_file_system_store_writes_states_atomically(tmpdir):
+    state = PyloExecutionState(execution_id=1, finished_inputs=[1], unfinished_inputs=[2, 3])
+    under_test = PyloFileSystemExecutionStore(tmpdir, fsync_policy='always')
+
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=state)
+
+    assert sorted(path.basename for path in tmpdir.join('1').listdir()) == ['1']
+    assert under_test.load_worker_state(execution_id=1, worker_id=1) == state
+    with pytest.raises(ValueError):
+        PyloFileSystemExecutionStore(tmpdir, fsync_policy='sometimes')
+
+
+@pytest.mark.parametrize('codec', ['varint', 'int64+gzip'])
+def test_file_system_store_encodes_inputs_with_codec(tmpdir, codec):
+    state = PyloExecutionState(execution_id=1, finished_inputs=[1, 2], unfinished_inputs=[3, 4])
+    under_test = PyloFileSystemExecutionStore(tmpdir, codec=codec)
+
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=state)
+    under_test.store_task_exception(execution_id=1, exception=Exception('I run out of memory'))
+
+    assert PyloFileSystemExecutionStore(tmpdir).load_worker_state(execution_id=1, worker_id=1) == state
+    assert [str(e) for e in under_test.load_task_exceptions(execution_id=1)] == ['I run out of memory']
+
+
+def test_file_system_store_falls_back_to_pickle_for_inputs_codec_does_not_support(tmpdir):
+    state = PyloExecutionState(execution_id=1, finished_inputs=[1, 'a'], unfinished_inputs=[])
+    under_test = PyloFileSystemExecutionStore(tmpdir, codec='varint')
+
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=state)
+
+    assert under_test.load_worker_state(execution_id=1, worker_id=1) == state
+
+
+def test_file_system_store_loads_states_written_before_headers(tmpdir):
+    state = PyloExecutionState(execution_id=1, finished_inputs=[1], unfinished_inputs=[2, 3])
+    tmpdir.mkdir('1')
+    with open(tmpdir.join('1', '1'), 'wb') as sf:
+        pickle.dump(state, sf)
+
+    under_test = PyloFileSystemExecutionStore(tmpdir)
+    assert under_test.load_worker_state(execution_id=1, worker_id=1) == state
+    assert under_test.count_inputs(execution_id=1) == (1, 2)
+
+
+def test_bitmap_state_splits_and_merges():
+    state = PyloBitmapExecutionState.from_range(1, range(1, 33))
+    finished_state, unfinished_states = state.split_unfinished(into_number=2)
+    assert [list(s.unfinished_inputs) for s in unfinished_states] == [list(range(1, 17)), list(range(17, 33))]
+    assert list(finished_state.unfinished_inputs) == []
+
+    worker1, worker2 = unfinished_states
+    worker1.mark_finished(worker1.next_unfinished())
+    worker1.mark_failed(worker1.next_unfinished())
+    assert worker2.give_away_unfinished(2) == [31, 32]
+    worker1.assign_unfinished([31, 32])
+
+    assert list(worker1.unfinished_inputs) == list(range(3, 17)) + [2, 31, 32]
+    assert list(worker2.unfinished_inputs) == list(range(17, 31))
+    assert len(worker1.finished_inputs) == 1
+    assert len(worker1.unfinished_inputs) == 17
+
+    merged = PyloExecutionState.merge(1, [finished_state, worker1, worker2])
+    assert merged.finished_inputs == [1]
+    assert merged.unfinished_inputs == list(range(2, 33))
+
+    in_flight_input = worker1.next_unfinished()
+    assert worker1.snapshot(in_flight_inputs=[in_flight_input]).unfinished_inputs == \
+        list(range(4, 17)) + [3, 2, 31, 32]
+    with pytest.raises(ValueError):
+        PyloBitmapExecutionState.from_range(1, [1, 2, 3])
+
+
+def test_bitmap_state_queues_inputs_which_failed_before_after_its_part():
+    state = PyloBitmapExecutionState.from_range(1, range(1, 9))
+    state.failed_attempts = {2: 1, 5: 2}
+    _, (under_test,) = state.split_unfinished(into_number=1)
+
+    assert [under_test.next_unfinished() for _ in range(6)] == [1, 3, 4, 6, 7, 8]
+    assert under_test.give_away_unfinished(1) == [5]
+    assert under_test.next_unfinished() == 2
+
+
+def test_file_system_store_keeps_bitmap_states_in_bitmap(tmpdir):
+    state = PyloBitmapExecutionState.from_range(1, range(100, 200))
+    under_test = PyloFileSystemExecutionStore(tmpdir, fsync_policy='snapshots')
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=state)
+
+    # once the bitmap is mapped to its file, bits are persisted as soon as they are set
+    for task_input in range(100, 150):
+        state.mark_finished(task_input)
+
+    assert tmpdir.join('1').listdir() == [tmpdir.join('1', 'meta')]
+    assert under_test.count_inputs(execution_id=1) == (50, 50)
+    assert list(under_test.iter_inputs(execution_id=1, finished=False)) == list(range(150, 200))
+    assert under_test.load_inputs_page(execution_id=1, finished=True, offset=10, limit=3) == [110, 111, 112]
+    assert PyloFileSystemExecutionStore(tmpdir).load_whole_state(execution_id=1).finished_inputs == \
+        list(range(100, 150))
+
+
+def test_replay_journal_of_bitmap_state_matches_worker_state():
+    state = PyloBitmapExecutionState.from_range(1, range(1, 33))
+    _, (worker1, worker2) = state.split_unfinished(into_number=2)
+    replayed_state = PyloBitmapExecutionState(1, state.bitmap.copy())
+    _, (replayed1, replayed2) = replayed_state.split_unfinished(into_number=2)
+
+    worker1.mark_finished(worker1.next_unfinished())
+    worker1.mark_failed(worker1.next_unfinished())
+    worker1.assign_unfinished(worker2.give_away_unfinished(3))
+    worker1.mark_finished(worker1.next_unfinished())
+    worker2.mark_finished(worker2.next_unfinished())
+    replayed1.replay_journal(worker1.take_journal())
+    replayed2.replay_journal(worker2.take_journal())
+
+    assert replayed_state.bitmap.data == state.bitmap.data
+    assert sorted(replayed1.unfinished_inputs) == sorted(worker1.unfinished_inputs) == \
+        [2] + list(range(4, 17)) + [30, 31, 32]
+    assert list(replayed2.unfinished_inputs) == list(worker2.unfinished_inputs) == list(range(18, 30))
+    assert replayed1.failed_attempts == worker1.failed_attempts == {2: 1}
+
+
+def test_file_system_store_persists_failed_attempts_of_bitmap_states(tmpdir):
+    state = PyloBitmapExecutionState.from_range(1, range(1, 33))
+    _, (worker1, worker2) = state.split_unfinished(into_number=2)
+    under_test = PyloFileSystemExecutionStore(tmpdir)
+    worker1.mark_failed(worker1.next_unfinished())
+    worker1.mark_failed(worker1.next_unfinished())
+    worker2.mark_failed(worker2.next_unfinished())
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=worker1.snapshot())
+    under_test.store_worker_state(execution_id=1, worker_id=2, task_execution_state=worker2.snapshot())
+
+    worker1.mark_failed(1)
+    worker1.mark_finished(2)
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=worker1.snapshot())
+
+    assert PyloFileSystemExecutionStore(tmpdir).load_failed_attempts(execution_id=1) == {1: 2, 17: 1}
+    assert PyloFileSystemExecutionStore(tmpdir).load_whole_state(execution_id=1).failed_attempts == {1: 2, 17: 1}
+
+
+@pytest.mark.parametrize('create_store', [
+    lambda tmpdir: PyloFileSystemExecutionStore(tmpdir, journaled=True),
+    lambda tmpdir: PyloSqliteExecutionStore(str(tmpdir.join('pylo.sqlite3'))),
+])
+def test_store_persists_failed_attempts(tmpdir, create_store):
+    state = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[1, 2, 3])
+    state.mark_failed(state.next_unfinished())
+    under_test = create_store(tmpdir)
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=state)
+
+    state.mark_finished(state.next_unfinished())
+    # the input is held by the worker until its retry is due
+    state.mark_failed(state.next_unfinished(), requeue=False)
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=state.snapshot([3]))
+    state.mark_failed(state.next_unfinished())
+    state.requeue_failed(3)
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=state)
+
+    assert state.failed_attempts == {3: 1, 1: 2}
+    assert under_test.load_failed_attempts(execution_id=1) == {3: 1, 1: 2}
+    loaded_state = under_test.load_worker_state(execution_id=1, worker_id=1)
+    assert loaded_state.failed_attempts == {3: 1, 1: 2}
+    assert sorted(loaded_state.unfinished_inputs) == [1, 3]
+
+
+def test_merge_keeps_failed_attempts_of_unfinished_inputs():
+    victim = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[1, 2])
+    victim.mark_failed(victim.next_unfinished())
+    victim.mark_failed(victim.next_unfinished())
+    thief = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[])
+
+    stolen_inputs = victim.give_away_unfinished(2)
+    thief.assign_unfinished(stolen_inputs, victim.failed_attempts_of_inputs(stolen_inputs))
+    thief.mark_failed(thief.next_unfinished())
+    thief.mark_finished(thief.next_unfinished())
+
+    assert PyloExecutionState.merge(1, [victim, thief]).failed_attempts == {1: 2}
+
+
+def test_claim_from_stream_and_list_streamed_inputs():
+    state = PyloExecutionState(
+        execution_id=1, finished_inputs=[], unfinished_inputs=[], stream_offset=0,
+        input_stream=PyloInputStream(iter([1, 2, 3, 4, 5])))
+
+    assert state.claim_from_stream(3)
+    state.mark_finished(state.next_unfinished())
+    state.mark_failed(state.next_unfinished())
+
+    assert state == PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[3, 2], stream_offset=3)
+    assert state.with_streamed_inputs([1, 2, 3, 4, 5]) == \
+        PyloExecutionState(execution_id=1, finished_inputs=[1], unfinished_inputs=[3, 2])
+
+
+def test_input_stream_resumes_from_offset():
+    under_test = PyloInputStream(iter([1, 2, 3, 4, 5]), offset=2)
+
+    assert under_test.take(2) == (2, [3, 4])
+    assert under_test.take(2) == (4, [5])
+    assert under_test.take(2) == (5, [])
+
+
+def test_sqlite_store_load_execution_state(tmpdir):
+    state1 = PyloExecutionState(execution_id=1, finished_inputs=[1, 2], unfinished_inputs=[3, 4])
+    state2 = PyloExecutionState(execution_id=1, finished_inputs=[5], unfinished_inputs=[])
+
+    under_test = PyloSqliteExecutionStore(str(tmpdir.join('pylo.sqlite3')))
+
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=state1)
+    under_test.store_worker_state(execution_id=1, worker_id=2, task_execution_state=state2)
+
+    assert under_test.load_worker_state(execution_id=1, worker_id=1) == state1
+    assert under_test.load_whole_state(execution_id=1) == \
+        PyloExecutionState(execution_id=1, finished_inputs=[1, 2, 5], unfinished_inputs=[3, 4])
+
+
+def test_sqlite_store_stores_changes_since_previous_snapshot(tmpdir):
+    victim = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[1, 2, 3, 4, 5])
+    thief = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[])
+    under_test = PyloSqliteExecutionStore(str(tmpdir.join('pylo.sqlite3')))
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=victim)
+    under_test.store_worker_state(execution_id=1, worker_id=2, task_execution_state=thief)
+
+    victim.mark_finished(victim.next_unfinished())
+    victim.mark_failed(victim.next_unfinished())
+    thief.assign_unfinished(victim.give_away_unfinished(2))
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=victim)
+    under_test.store_worker_state(execution_id=1, worker_id=2, task_execution_state=thief)
+
+    reader = PyloSqliteExecutionStore(str(tmpdir.join('pylo.sqlite3')))
+    assert reader.load_worker_state(execution_id=1, worker_id=1) == \
+        PyloExecutionState(execution_id=1, finished_inputs=[1], unfinished_inputs=[3, 4])
+    assert reader.load_worker_state(execution_id=1, worker_id=2) == \
+        PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[5, 2])
+
+
+def test_sqlite_store_loads_pages_in_the_order_of_iter_inputs(tmpdir):
+    under_test = PyloSqliteExecutionStore(str(tmpdir.join('pylo.sqlite3')))
+    parent_state = PyloExecutionState(execution_id=1, finished_inputs=[1, 2], unfinished_inputs=[3])
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=parent_state)
+    for worker_id, task_inputs in [(10, [7, 8]), (2, [5, 6]), ('a', [9])]:
+        under_test.store_worker_state(execution_id=2, worker_id=worker_id, task_execution_state=PyloExecutionState(
+            execution_id=2, finished_inputs=task_inputs, unfinished_inputs=[]))
+    under_test.store_parent_execution(execution_id=2, parent_execution_id=1)
+
+    finished_inputs = list(under_test.iter_inputs(execution_id=2, finished=True))
+    assert finished_inputs == [1, 2, 5, 6, 7, 8, 9]
+    for offset in range(len(finished_inputs) + 1):
+        for limit in range(1, 4):
+            assert under_test.load_inputs_page(execution_id=2, finished=True, offset=offset, limit=limit) == \
+                finished_inputs[offset:offset + limit]
+    assert under_test.load_inputs_page(execution_id=2, finished=False, offset=0, limit=5) == []
+
+
+def test_sqlite_store_counts_and_lookups(tmpdir):
+    state = PyloExecutionState(execution_id=1, finished_inputs=['a', 'b'], unfinished_inputs=['c'])
+    under_test = PyloSqliteExecutionStore(str(tmpdir.join('pylo.sqlite3')))
+
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=state)
+    under_test.store_task_exception(execution_id=1, exception=Exception('I run out of memory'))
+
+    assert under_test.count_inputs(execution_id=1) == (2, 1)
+    assert under_test.load_inputs_page(execution_id=1, finished=True, offset=1, limit=5) == ['b']
+    assert under_test.is_finished(execution_id=1, task_input='a')
+    assert not under_test.is_finished(execution_id=1, task_input='c')
+    assert under_test.count_task_exceptions(execution_id=1) == 1
+    assert [str(e) for e in under_test.load_task_exceptions(execution_id=1)] == ['I run out of memory']
+
+
+def test_sqlite_store_deduplicates_exceptions(tmpdir):
+    under_test = PyloSqliteExecutionStore(str(tmpdir.join('pylo.sqlite3')), deduplicate_exceptions=True)
+
+    for message in ['I run out of memory', 'I run out of cookies', 'I run out of memory']:
+        under_test.store_task_exception(execution_id=1, exception=Exception(message))
+
+    assert [(str(e), count) for e, count in under_test.load_task_exception_counts(execution_id=1)] == \
+        [('I run out of memory', 2), ('I run out of cookies', 1)]
+    assert under_test.count_task_exceptions(execution_id=1) == 3
+
+
+def test_sqlite_store_appends_exceptions_of_other_processes(tmpdir):
+    database_path = str(tmpdir.join('pylo.sqlite3'))
+    # two stores stand for two processes which store exceptions of the same execution
+    first_store = PyloSqliteExecutionStore(database_path, deduplicate_exceptions=True)
+    second_store = PyloSqliteExecutionStore(database_path, deduplicate_exceptions=True)
+
+    first_store.store_task_exception(execution_id=1, exception=Exception('I run out of memory'))
+    second_store.store_task_exception(execution_id=1, exception=Exception('I run out of cookies'))
+    first_store.store_task_exception(execution_id=1, exception=Exception('I run out of memory'))
+    first_store.finish_execution(execution_id=1)
+    second_store.finish_execution(execution_id=1)
+
+    assert sorted((str(e), count) for e, count in first_store.load_task_exception_counts(execution_id=1)) == \
+        [('I run out of cookies', 1), ('I run out of memory', 2)]
+
+
+@pytest.mark.parametrize('create_store', [
+    lambda tmpdir: PyloFileSystemExecutionStore(tmpdir),
+    lambda tmpdir: PyloSqliteExecutionStore(str(tmpdir.join('pylo.sqlite3'))),
+])
+def test_store_leases_shards(tmpdir, create_store):
+    under_test = create_store(tmpdir)
+    under_test.create_leases(execution_id=1, shard_ids=[1, 2])
+
+    assert under_test.acquire_lease(execution_id=1, shard_id=1, owner='a', lease_seconds=60)
+    assert not under_test.acquire_lease(execution_id=1, shard_id=1, owner='b', lease_seconds=60)
+    # renewing
+    assert under_test.acquire_lease(execution_id=1, shard_id=1, owner='a', lease_seconds=-1)
+    # the lease expired, so it is taken over, and can no longer be renewed
+    assert under_test.acquire_lease(execution_id=1, shard_id=1, owner='b', lease_seconds=60)
+    assert not under_test.acquire_lease(execution_id=1, shard_id=1, owner='a', lease_seconds=60)
+
+    under_test.release_lease(execution_id=1, shard_id=1, owner='a', done=True)
+    assert create_store(tmpdir).load_leases(execution_id=1)[1][0] == 'b'
+    under_test.release_lease(execution_id=1, shard_id=1, owner='b', done=True)
+    assert not under_test.acquire_lease(execution_id=1, shard_id=1, owner='a', lease_seconds=60)
+
+    assert create_store(tmpdir).load_leases(execution_id=1) == {1: (None, 0.0, True), 2: (None, 0.0, False)}
+    assert under_test.load_leases(execution_id=2) == {}
+
+
+@pytest.mark.parametrize('create_store', [
+    lambda tmpdir: PyloFileSystemExecutionStore(tmpdir, journaled=True),
+    lambda tmpdir: PyloSqliteExecutionStore(str(tmpdir.join('pylo.sqlite3'))),
+])
+def test_store_walks_and_flattens_parent_executions(tmpdir, create_store):
+    under_test = create_store(tmpdir)
+    under_test.store_worker_state(execution_id=1, worker_id=0, task_execution_state=PyloExecutionState(
+        execution_id=1, finished_inputs=[1, 2], unfinished_inputs=[]))
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=PyloExecutionState(
+        execution_id=1, finished_inputs=[3], unfinished_inputs=[4, 5]))
+    under_test.store_parent_execution(execution_id=2, parent_execution_id=1)
+    under_test.store_worker_state(execution_id=2, worker_id=0, task_execution_state=PyloExecutionState(
+        execution_id=2, finished_inputs=[], unfinished_inputs=[]))
+    under_test.store_worker_state(execution_id=2, worker_id=1, task_execution_state=PyloExecutionState(
+        execution_id=2, finished_inputs=[4], unfinished_inputs=[5]))
+    expected_state = PyloExecutionState(execution_id=2, finished_inputs=[1, 2, 3, 4], unfinished_inputs=[5])
+
+    assert under_test.load_worker_state(execution_id=2, worker_id=0) == \
+        PyloExecutionState(execution_id=2, finished_inputs=[], unfinished_inputs=[])
+    assert under_test.load_whole_state(execution_id=2) == expected_state
+    assert under_test.count_inputs(execution_id=2) == (4, 1)
+    assert list(under_test.iter_inputs(execution_id=2, finished=True)) == [1, 2, 3, 4]
+    assert list(under_test.iter_inputs(execution_id=2, finished=False)) == [5]
+
+    under_test.flatten_execution(execution_id=2)
+
+    assert under_test.load_parent_execution(execution_id=2) is None
+    assert under_test.load_worker_state(execution_id=2, worker_id=0) == \
+        PyloExecutionState(execution_id=2, finished_inputs=[1, 2, 3], unfinished_inputs=[])
+    assert create_store(tmpdir).load_whole_state(execution_id=2) == expected_state
+    assert under_test.load_whole_state(execution_id=1) == \
+        PyloExecutionState(execution_id=1, finished_inputs=[1, 2, 3], unfinished_inputs=[4, 5])
+
+
+@pytest.mark.parametrize('create_store', [
+    lambda tmpdir: PyloFileSystemExecutionStore(tmpdir),
+    lambda tmpdir: PyloSqliteExecutionStore(str(tmpdir.join('pylo.sqlite3'))),
+])
+def test_store_persists_task_durations_of_execution_and_its_parents(tmpdir, create_store):
+    under_test = create_store(tmpdir)
+    under_test.store_task_durations(execution_id=1, durations={1: 0.5, 2: 3.0})
+    under_test.store_task_durations(execution_id=1, durations={2: 2.0, (3, 'three'): 1.0})
+    under_test.store_parent_execution(execution_id=2, parent_execution_id=1)
+    under_test.store_task_durations(execution_id=2, durations={1: 4.0})
+
+    assert create_store(tmpdir).load_task_durations(execution_id=1) == {1: 0.5, 2: 2.0, (3, 'three'): 1.0}
+    assert create_store(tmpdir).load_task_durations(execution_id=2) == {1: 4.0, 2: 2.0, (3, 'three'): 1.0}
+    assert under_test.load_task_durations(execution_id=3) == {}
@@ -0,0 +1,172 @@
+# coding=utf-8
+import gc
+import multiprocessing
+import os
+import signal
+import weakref
+
+import pytest
+
+from pylo.execution import Pylo
+from pylo.state import PyloExecutionState, PyloFileSystemExecutionStore, PyloSqliteExecutionStore
+from pylo.tiered import PyloTieredExecutionStore
+
+
+@pytest.mark.parametrize('create_backing_store', [
+    lambda tmpdir: PyloFileSystemExecutionStore(tmpdir),
+    lambda tmpdir: PyloFileSystemExecutionStore(tmpdir, journaled=True),
+    lambda tmpdir: PyloSqliteExecutionStore(str(tmpdir.join('pylo.sqlite3'))),
+])
+def test_serves_state_from_memory_until_spilled(tmpdir, create_backing_store):
+    backing_store = create_backing_store(tmpdir)
+    under_test = PyloTieredExecutionStore(backing_store, spill_interval_seconds=60, spill_on_signals=())
+    worker_state = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[1, 2, 3, 4])
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=worker_state)
+
+    worker_state.next_unfinished()
+    worker_state.mark_finished(1)
+    worker_state.next_unfinished()
+    worker_state.mark_failed(2)
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=worker_state)
+    under_test.store_task_exception(execution_id=1, exception=ValueError('Failed for 2'))
+
+    expected_state = PyloExecutionState(execution_id=1, finished_inputs=[1], unfinished_inputs=[3, 4, 2])
+    assert under_test.load_whole_state(execution_id=1) == expected_state
+    assert under_test.count_inputs(execution_id=1) == (1, 3)
+    assert [str(e) for e in under_test.load_task_exceptions(execution_id=1)] == ['Failed for 2']
+    # the first state of the worker was written through, so no input is only in memory
+    assert backing_store.load_whole_state(execution_id=1) == \
+        PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[1, 2, 3, 4])
+
+    under_test.spill()
+
+    assert create_backing_store(tmpdir).load_whole_state(execution_id=1) == expected_state
+    assert [str(e) for e in under_test.load_task_exceptions(execution_id=1)] == ['Failed for 2']
+    under_test.finish_execution(execution_id=1)
+    assert under_test.load_whole_state(execution_id=1) == expected_state
+    under_test.close()
+
+
+def test_spills_once_too_many_changes_are_in_memory(tmpdir):
+    backing_store = PyloFileSystemExecutionStore(tmpdir, journaled=True)
+    under_test = PyloTieredExecutionStore(backing_store, spill_interval_seconds=60, max_unspilled_changes=3,
+                                          spill_on_signals=())
+    worker_state = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[i for i in range(10)])
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=worker_state)
+
+    for i in range(6):
+        worker_state.mark_finished(worker_state.next_unfinished())
+        under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=worker_state)
+
+    # the fourth change spilled, the next two are only in memory
+    assert backing_store.load_whole_state(execution_id=1).finished_inputs == [0, 1, 2, 3]
+    assert under_test.load_whole_state(execution_id=1).finished_inputs == [0, 1, 2, 3, 4, 5]
+    under_test.close()
+    assert backing_store.load_whole_state(execution_id=1).finished_inputs == [0, 1, 2, 3, 4, 5]
+
+
+def test_applies_unspilled_changes_on_top_of_backing_store(tmpdir):
+    backing_store = PyloSqliteExecutionStore(str(tmpdir.join('pylo.sqlite3')))
+    under_test = PyloTieredExecutionStore(backing_store, spill_interval_seconds=60, spill_on_signals=())
+    worker_state = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[1, 2, 3, 4])
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=worker_state)
+
+    worker_state.mark_failed(worker_state.next_unfinished())
+    worker_state.mark_finished(worker_state.next_unfinished())
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=worker_state)
+
+    # memory holds the journal of the worker, not its inputs
+    assert under_test._executions['1']['1'].journal == [('failed', 1), ('finished', 2)]
+    loaded_state = under_test.load_worker_state(execution_id=1, worker_id=1)
+    assert (loaded_state.finished_inputs, list(loaded_state.unfinished_inputs)) == ([2], [3, 4, 1])
+    assert loaded_state.failed_attempts_of(1) == 1
+    assert under_test.load_failed_attempts(execution_id=1) == {1: 1}
+
+    under_test.spill()
+
+    assert under_test._executions['1']['1'].journal == []
+    assert backing_store.load_worker_state(execution_id=1, worker_id=1) == loaded_state
+    assert backing_store.load_failed_attempts(execution_id=1) == {1: 1}
+    under_test.close()
+
+
+def test_spills_on_signal(tmpdir):
+    store_process = multiprocessing.Process(target=store_progress_and_terminate, args=(str(tmpdir),))
+    store_process.start()
+    store_process.join()
+
+    # the process was terminated by the signal, as it would have been without the store
+    assert store_process.exitcode == -signal.SIGTERM
+    assert PyloFileSystemExecutionStore(str(tmpdir)).load_whole_state(execution_id=1) == \
+        PyloExecutionState(execution_id=1, finished_inputs=[1], unfinished_inputs=[2])
+
+
+def test_stores_closed_in_any_order_keep_spilling_on_signal(tmpdir):
+    received_signals = []
+    previous_handler = signal.signal(signal.SIGUSR1, lambda signal_number, frame: received_signals.append(signal_number))
+    try:
+        first_store = PyloTieredExecutionStore(PyloFileSystemExecutionStore(str(tmpdir.join('first'))),
+                                               spill_interval_seconds=60, spill_on_signals=(signal.SIGUSR1,))
+        second_store = PyloTieredExecutionStore(PyloFileSystemExecutionStore(str(tmpdir.join('second'))),
+                                                spill_interval_seconds=60, spill_on_signals=(signal.SIGUSR1,))
+        first_store.close()
+        worker_state = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[1, 2])
+        second_store.store_worker_state(execution_id=1, worker_id=1, task_execution_state=worker_state)
+        worker_state.mark_finished(worker_state.next_unfinished())
+        second_store.store_worker_state(execution_id=1, worker_id=1, task_execution_state=worker_state)
+
+        os.kill(os.getpid(), signal.SIGUSR1)
+
+        assert second_store.backing_store.load_whole_state(execution_id=1) == \
+            PyloExecutionState(execution_id=1, finished_inputs=[1], unfinished_inputs=[2])
+        assert received_signals == [signal.SIGUSR1]
+        second_store.close()
+    finally:
+        signal.signal(signal.SIGUSR1, previous_handler)
+
+
+def test_dropped_store_is_not_kept_alive(tmpdir):
+    under_test = PyloTieredExecutionStore(PyloFileSystemExecutionStore(tmpdir), spill_interval_seconds=0.01,
+                                          spill_on_signals=())
+    store_reference, spiller = weakref.ref(under_test), under_test._spiller
+
+    del under_test
+    gc.collect()
+
+    assert store_reference() is None
+    spiller.join(timeout=5)
+    assert not spiller.is_alive()
+
+
+@pytest.mark.parametrize('sqlite_store', [False, True])
+def test_resume_when_failed_with_tiered_store(tmpdir, sqlite_store):
+    pylo = Pylo.local_multithread(tmpdir, number_of_workers=2, max_worker_failures=2, sqlite_store=sqlite_store,
+                                  task_executions_before_flush=1, spill_interval_seconds=60)
+    execution_id = pylo.start_from_scratch([i for i in range(1, 100)], fail_for_11_and_56)
+
+    # finishing the execution spilled everything, so a new instance finds it in the local directory
+    pylo = Pylo.local_multithread(tmpdir, number_of_workers=2, sqlite_store=sqlite_store)
+    finished_inputs, unfinished_inputs = pylo.get_state(execution_id)
+    assert sorted(finished_inputs) == [i for i in range(1, 100) if i not in (11, 56)]
+    assert sorted(unfinished_inputs) == [11, 56]
+    assert len(pylo.get_exceptions(execution_id)) == 4
+
+    new_execution_id = pylo.start_from_past_execution(execution_id, lambda n: None)
+    finished_inputs, unfinished_inputs = pylo.get_state(new_execution_id)
+    assert sorted(finished_inputs) == [i for i in range(1, 100)]
+    assert unfinished_inputs == []
+
+
+def fail_for_11_and_56(n):
+    if n in (11, 56):
+        raise ValueError(f'Failed for {n}')
+
+
+def store_progress_and_terminate(store_dir):
+    under_test = PyloTieredExecutionStore(PyloFileSystemExecutionStore(store_dir), spill_interval_seconds=60)
+    worker_state = PyloExecutionState(execution_id=1, finished_inputs=[], unfinished_inputs=[1, 2])
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=worker_state)
+    worker_state.mark_finished(worker_state.next_unfinished())
+    under_test.store_worker_state(execution_id=1, worker_id=1, task_execution_state=worker_state)
+
+    os.kill(os.getpid(), signal.SIGTERM)